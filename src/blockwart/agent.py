@@ -0,0 +1,199 @@
+from base64 import b64decode, b64encode
+import json
+from struct import pack, unpack
+from threading import Lock
+
+from .exceptions import RemoteException, SessionError
+from .utils.text import mark_for_translation as _
+
+AGENT_PROTOCOL_VERSION = 1
+
+# This is run on the node with "python -c" (as root, with whatever
+# Python is available there). It reads requests from stdin and writes
+# responses to stdout. Both are JSON objects prefixed with their length
+# as a 4-byte big-endian integer.
+AGENT_SCRIPT = br'''
+import base64
+import grp
+import json
+import os
+import pwd
+import struct
+import subprocess
+import sys
+import tempfile
+
+PROTOCOL_VERSION = 1
+STDIN = getattr(sys.stdin, 'buffer', sys.stdin)
+STDOUT = getattr(sys.stdout, 'buffer', sys.stdout)
+
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def read_frame():
+    header = STDIN.read(4)
+    if len(header) < 4:
+        return None
+    length = struct.unpack(">I", header)[0]
+    return json.loads(STDIN.read(length).decode('utf-8'))
+
+
+def write_frame(obj):
+    data = json.dumps(obj).encode('utf-8')
+    STDOUT.write(struct.pack(">I", len(data)) + data)
+    STDOUT.flush()
+
+
+def op_read(request):
+    with open(request['path'], 'rb') as f:
+        return {'content': b64(f.read())}
+
+
+def op_run(request):
+    env = dict(os.environ)
+    env['LANG'] = "C"
+    process = subprocess.Popen(
+        request['command'],
+        env=env,
+        executable="/bin/bash" if os.path.exists("/bin/bash") else None,
+        shell=True,
+        stderr=subprocess.PIPE,
+        stdin=open(os.devnull),
+        stdout=subprocess.PIPE,
+    )
+    stdout, stderr = process.communicate()
+    return {
+        'return_code': process.returncode,
+        'stderr': b64(stderr),
+        'stdout': b64(stdout),
+    }
+
+
+def op_write(request):
+    path = request['path']
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".blockwart_tmp_")
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(base64.b64decode(request['content']))
+        if request.get('owner') or request.get('group'):
+            os.chown(
+                tmp_path,
+                pwd.getpwnam(request['owner']).pw_uid if request.get('owner') else -1,
+                grp.getgrnam(request['group']).gr_gid if request.get('group') else -1,
+            )
+        if request.get('mode'):
+            os.chmod(tmp_path, int(request['mode'], 8))
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return {}
+
+
+OPS = {
+    'read': op_read,
+    'run': op_run,
+    'write': op_write,
+}
+
+
+def main():
+    write_frame({'version': PROTOCOL_VERSION})
+    while True:
+        request = read_frame()
+        if request is None:
+            break
+        try:
+            response = OPS[request['op']](request)
+        except Exception as e:
+            response = {'error': "{}: {}".format(e.__class__.__name__, e)}
+        write_frame(response)
+
+
+main()
+'''
+
+
+class Agent(object):
+    """
+    Talks to an instance of AGENT_SCRIPT through a channel (anything
+    with sendall() and recv() methods, usually a Paramiko channel).
+    Requests are serialized, so a single agent can be shared by
+    multiple threads.
+    """
+    def __init__(self, channel, name):
+        self.channel = channel
+        self.lock = Lock()
+        self.name = name
+        hello = self._recv_frame()
+        if hello.get('version') != AGENT_PROTOCOL_VERSION:
+            raise RemoteException(_(
+                "unsupported agent protocol version on {}: {}"
+            ).format(self.name, hello.get('version')))
+
+    def _recv_exactly(self, length):
+        data = b""
+        while len(data) < length:
+            chunk = self.channel.recv(length - len(data))
+            if not chunk:
+                raise SessionError(_("lost connection to agent on {}").format(self.name))
+            data += chunk
+        return data
+
+    def _recv_frame(self):
+        length = unpack(">I", self._recv_exactly(4))[0]
+        return json.loads(self._recv_exactly(length).decode('utf-8'))
+
+    def _send_frame(self, obj):
+        data = json.dumps(obj).encode('utf-8')
+        self.channel.sendall(pack(">I", len(data)) + data)
+
+    def close(self):
+        self.channel.close()
+
+    def request(self, op, **kwargs):
+        kwargs['op'] = op
+        with self.lock:
+            self._send_frame(kwargs)
+            response = self._recv_frame()
+        if 'error' in response:
+            raise RemoteException(_("agent on {node} failed to {op}: {error}").format(
+                error=response['error'],
+                node=self.name,
+                op=op,
+            ))
+        return response
+
+    def read(self, path):
+        """
+        Returns the contents of the given file on the node.
+        """
+        return b64decode(self.request('read', path=path)['content'])
+
+    def run(self, command):
+        """
+        Returns return code, stdout and stderr of the given shell
+        command.
+        """
+        response = self.request('run', command=command)
+        return (
+            response['return_code'],
+            b64decode(response['stdout']),
+            b64decode(response['stderr']),
+        )
+
+    def write(self, path, content, mode=None, owner="", group=""):
+        """
+        Atomically replaces the given path on the node with content,
+        setting mode and ownership before moving it into place.
+        """
+        self.request(
+            'write',
+            content=b64encode(content).decode('ascii'),
+            group=group,
+            mode=mode,
+            owner=owner,
+            path=path,
+        )
@@ -2,6 +2,7 @@ from datetime import datetime
 
 from ..concurrency import WorkerPool
 from ..exceptions import WorkerException
+from ..history import DurationHistory
 from ..utils import LOG
 from ..utils.cmdline import get_target_nodes
 from ..utils.text import bold, green, red, yellow
@@ -33,6 +34,12 @@ def format_node_result(result):
 def bw_apply(repo, args):
     errors = []
     target_nodes = get_target_nodes(repo, args.target)
+    history = DurationHistory(repo)
+    node_estimates = history.node_estimates()
+    # Nodes are popped from the end of the list, so this starts with
+    # nodes we know nothing about and then goes from the slowest node
+    # to the fastest.
+    target_nodes.sort(key=lambda node: node_estimates.get(node.name, float('inf')))
 
     repo.hooks.apply_start(
         repo,
@@ -46,6 +53,7 @@ def bw_apply(repo, args):
     worker_count = 1 if args.interactive else args.node_workers
     with WorkerPool(workers=worker_count) as worker_pool:
         results = {}
+        node_durations = {}
         while worker_pool.keep_running():
             try:
                 msg = worker_pool.get_event()
@@ -79,8 +87,12 @@ def bw_apply(repo, args):
                         node.apply,
                         task_id=node.name,
                         kwargs={
+                            'agent': args.agent,
                             'force': args.force,
                             'interactive': args.interactive,
+                            'journal': args.journal,
+                            'shell_session': args.shell_session,
+                            'threads': args.item_threads,
                             'workers': args.item_workers,
                         },
                     )
@@ -89,6 +101,11 @@ def bw_apply(repo, args):
             elif msg['msg'] == 'FINISHED_WORK':
                 node_name = msg['task_id']
                 results[node_name] = msg['return_value']
+                result = results[node_name]
+                # locked nodes return right away and would skew the history
+                if not args.interactive and \
+                        result.correct + result.fixed + result.skipped + result.failed:
+                    node_durations[node_name] = result.duration.total_seconds()
 
                 if args.interactive:
                     yield _("{node}: run completed after {time}s ({stats})\n").format(
@@ -106,6 +123,8 @@ def bw_apply(repo, args):
                         stats=format_node_result(results[node_name]),
                     ))
 
+    history.record_nodes(node_durations)
+
     error_summary(errors)
 
     repo.hooks.apply_end(
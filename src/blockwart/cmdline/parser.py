@@ -74,6 +74,39 @@ def build_parser_bw():
         help=_("number of items to apply to simultaneously on each node"),
         type=int,
     )
+    parser_apply.add_argument(
+        "--item-threads",
+        action='store_true',
+        default=False,
+        dest='item_threads',
+        help=_("apply items in threads instead of processes (faster, but "
+               "custom items must be thread-safe)"),
+    )
+    session_group = parser_apply.add_mutually_exclusive_group()
+    session_group.add_argument(
+        "--agent",
+        action='store_true',
+        default=False,
+        dest='agent',
+        help=_("run commands on nodes through a helper process (requires "
+               "Python and passwordless sudo on nodes)"),
+    )
+    session_group.add_argument(
+        "--shell-session",
+        action='store_true',
+        default=False,
+        dest='shell_session',
+        help=_("run commands on nodes through a single root shell per "
+               "worker (requires passwordless sudo on nodes)"),
+    )
+    parser_apply.add_argument(
+        "--journal",
+        action='store_true',
+        default=False,
+        dest='journal',
+        help=_("skip items that haven't changed since the last apply with "
+               "--journal (all items are checked at least once a day)"),
+    )
 
     # bw groups
     parser_groups = subparsers.add_parser("groups")
@@ -254,6 +287,14 @@ def build_parser_bw():
         help=_("number of items to test simultaneously for each node"),
         type=int,
     )
+    parser_repo_subparsers_test.add_argument(
+        "--item-threads",
+        action='store_true',
+        default=False,
+        dest='item_threads',
+        help=_("test items in threads instead of processes (faster, but "
+               "custom items must be thread-safe)"),
+    )
 
     # bw run
     parser_run = subparsers.add_parser("run")
@@ -317,5 +358,13 @@ def build_parser_bw():
         help=_("number of items to verify to simultaneously on each node"),
         type=int,
     )
+    parser_verify.add_argument(
+        "--item-threads",
+        action='store_true',
+        default=False,
+        dest='item_threads',
+        help=_("verify items in threads instead of processes (faster, but "
+               "custom items must be thread-safe)"),
+    )
 
     return parser
@@ -81,6 +81,7 @@ def bw_repo_test(repo, args):
                         node.test,
                         task_id=node.name,
                         kwargs={
+                            'threads': args.item_threads,
                             'workers': args.item_workers,
                         },
                     )
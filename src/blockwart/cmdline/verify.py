@@ -35,6 +35,7 @@ def bw_verify(repo, args):
                         node.verify,
                         task_id=node.name,
                         kwargs={
+                            'threads': args.item_threads,
                             'workers': args.item_workers,
                         },
                     )
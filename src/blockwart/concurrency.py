@@ -1,30 +1,34 @@
+from collections import deque
 from inspect import ismethod, isgenerator
 from logging import getLogger, Handler
-from multiprocessing import Manager, Pipe, Process
+from multiprocessing import Pipe, Process
 from os import dup, fdopen
+from Queue import Empty, Queue
+from select import select
 import sys
+from threading import Thread
 from traceback import format_exception
 
-from fabric.network import disconnect_all
-
+from . import operations
 from .exceptions import WorkerException
 from .utils import LOG
 from .utils.text import mark_for_translation as _
 
 JOIN_TIMEOUT = 5
+QUEUE_TIMEOUT = 1
 
 
 class ChildLogHandler(Handler):
     """
-    Captures log events in child processes and inserts them into the
-    queue to be processed by the parent process.
+    Captures log events in child processes and sends them through the
+    pipe to be processed by the parent process.
     """
-    def __init__(self, messages):
+    def __init__(self, pipe):
         Handler.__init__(self)
-        self.messages = messages
+        self.pipe = pipe
 
     def emit(self, record):
-        self.messages.put({'msg': 'LOG_ENTRY', 'log_entry': record})
+        self.pipe.send({'msg': 'LOG_ENTRY', 'log_entry': record})
 
 
 def _patch_logger(logger, new_handler=None):
@@ -35,7 +39,7 @@ def _patch_logger(logger, new_handler=None):
     logger.setLevel(0)
 
 
-def _worker_process(wid, messages, pipe, stdin=None):
+def _worker_process(wid, pipe, stdin=None):
     """
     This is what actually runs in the child process.
     """
@@ -46,60 +50,81 @@ def _worker_process(wid, messages, pipe, stdin=None):
     # replace the child logger with one that will send logs back to the
     # parent process
     from blockwart import utils
-    child_log_handler = ChildLogHandler(messages)
+    child_log_handler = ChildLogHandler(pipe)
     _patch_logger(getLogger(), child_log_handler)
     _patch_logger(utils.LOG)
 
     while True:
-        # These two calls can block for an infinite amount of time. We
-        # request work via the public queue and, eventually, some day,
-        # we might get an answer via our private pipe.
-        messages.put({'msg': 'REQUEST_WORK', 'wid': wid})
+        # This can block for an infinite amount of time. We request
+        # work and, eventually, some day, we might get an answer.
+        pipe.send({'msg': 'REQUEST_WORK', 'wid': wid})
         msg = pipe.recv()
         if msg['msg'] == 'DIE':
             # clean up Fabric connections first...
-            disconnect_all()
+            operations.disconnect_all()
             # then die
             return
         elif msg['msg'] == 'NOOP':
             pass
         elif msg['msg'] == 'RUN':
-            exception = None
-            exception_task_id = None
-            return_value = None
-            traceback = None
+            pipe.send(_run_task(wid, msg))
 
-            try:
-                if msg['target_obj'] is None:
-                    target = msg['target']
-                else:
-                    target = getattr(msg['target_obj'], msg['target'])
-
-                return_value = target(*msg['args'], **msg['kwargs'])
-
-                if isgenerator(return_value):
-                    return_value = list(return_value)
-
-            except Exception as e:
-                if isinstance(e, WorkerException):
-                    exception = e.wrapped_exception
-                    exception_task_id = e.task_id
-                else:
-                    exception = str(e)
-                    exception_task_id = msg['task_id']
-                traceback = "".join(format_exception(*sys.exc_info()))
-                return_value = None
-
-            finally:
-                messages.put({
-                    'exception': exception,
-                    'exception_task_id': exception_task_id,
-                    'msg': 'FINISHED_WORK',
-                    'return_value': return_value,
-                    'task_id': msg['task_id'],
-                    'traceback': traceback,
-                    'wid': wid,
-                })
+
+def _worker_thread(wid, messages, tasks):
+    """
+    This is what actually runs in each thread of a ThreadWorkerPool.
+    """
+    while True:
+        messages.put({'msg': 'REQUEST_WORK', 'wid': wid})
+        msg = tasks.get()
+        if msg['msg'] == 'DIE':
+            return
+        elif msg['msg'] == 'NOOP':
+            pass
+        elif msg['msg'] == 'RUN':
+            messages.put(_run_task(wid, msg))
+
+
+def _run_task(wid, msg):
+    """
+    Runs the task from the given RUN message and returns the
+    FINISHED_WORK message to send back.
+    """
+    exception = None
+    exception_task_id = None
+    return_value = None
+    traceback = None
+
+    try:
+        if msg['target_obj'] is None:
+            target = msg['target']
+        else:
+            target = getattr(msg['target_obj'], msg['target'])
+
+        return_value = target(*msg['args'], **msg['kwargs'])
+
+        if isgenerator(return_value):
+            return_value = list(return_value)
+
+    except Exception as e:
+        if isinstance(e, WorkerException):
+            exception = e.wrapped_exception
+            exception_task_id = e.task_id
+        else:
+            exception = str(e)
+            exception_task_id = msg['task_id']
+        traceback = "".join(format_exception(*sys.exc_info()))
+        return_value = None
+
+    return {
+        'exception': exception,
+        'exception_task_id': exception_task_id,
+        'msg': 'FINISHED_WORK',
+        'return_value': return_value,
+        'task_id': msg['task_id'],
+        'traceback': traceback,
+        'wid': wid,
+    }
 
 
 class WorkerPool(object):
@@ -126,26 +151,17 @@ class WorkerPool(object):
         # job. We only need to know how many there are.
         self.jobs_open = 0
 
-        # The public message queue. Workers ask for jobs here, report
-        # finished work and log items.
-        # Note: There's (at least) two ways to organize a pool like
-        # this. One is to only open a pipe to each worker. Then, you can
-        # use select() to see which pipe can be read from. Problem is,
-        # this is not really supported by the multiprocessing module;
-        # you have to dig into the internals and that's ugly. So, we go
-        # for another option: A managed queue. Multiple processes can
-        # write to it (all the workers do) and the parent can read from
-        # it. However, this is only feasible when workers must talk to
-        # the parent. The parent can't talk to the workers using this
-        # queue. Thus, we still need a dedicated pipe to each worker
-        # (see below).
-        self.messages = Manager().Queue()
+        # Workers ask for jobs, report finished work and log items
+        # through their end of a dedicated pipe. We select() on our ends
+        # of all those pipes and queue up whatever can be read from
+        # them here.
+        self.messages = deque()
 
         stdin = fdopen(dup(sys.stdin.fileno())) if workers == 1 else None
         for i in range(workers):
             (parent_conn, child_conn) = Pipe()
             p = Process(target=_worker_process,
-                        args=(i, self.messages, child_conn, stdin,))
+                        args=(i, child_conn, stdin,))
             p.start()
             self.workers.append((p, parent_conn))
 
@@ -159,7 +175,7 @@ class WorkerPool(object):
         """
         Blocks until a message from a worker is received.
         """
-        msg = self.messages.get()
+        msg = self._next_message()
         if msg['msg'] == 'FINISHED_WORK':
             self.jobs_open -= 1
             # check for exception in child process and raise it
@@ -174,6 +190,15 @@ class WorkerPool(object):
             LOG.handle(msg['log_entry'])
         return msg
 
+    def _next_message(self):
+        while not self.messages:
+            pipes = [self.workers[wid][1] for wid in self.workers_alive]
+            for pipe in select(pipes, [], [])[0]:
+                # read everything this worker has sent so far
+                while pipe.poll():
+                    self.messages.append(pipe.recv())
+        return self.messages.popleft()
+
     def start_task(self, wid, target, task_id=None, args=None, kwargs=None):
         """
         wid         id of the worker to use
@@ -225,7 +250,6 @@ class WorkerPool(object):
             pipe.send({'msg': 'DIE'})
         except IOError:
             pass
-        pipe.close()
         process.join(JOIN_TIMEOUT)
         if process.is_alive():
             LOG.warn(_(
@@ -236,6 +260,9 @@ class WorkerPool(object):
                 )
             )
             process.terminate()
+        # close the pipe only now so the worker can still report
+        # whatever it was doing before it got to read our DIE
+        pipe.close()
         self.workers_alive.remove(wid)
 
     def shutdown(self):
@@ -261,3 +288,88 @@ class WorkerPool(object):
         Returns True if this pool is not ready to die.
         """
         return self.jobs_open > 0 or self.workers_alive
+
+
+class ThreadWorkerPool(WorkerPool):
+    """
+    Like WorkerPool, but runs tasks in threads of the current process.
+    Starting them is cheap and tasks and their results don't have to be
+    pickled. Only use this for tasks that spend most of their time
+    waiting for remote commands.
+
+    All tasks in a ThreadWorkerPool must talk to the same host: Fabric
+    keeps the host it is currently talking to (env.host_string) in
+    process-global state. That's why nodes are still handled by a
+    WorkerPool, one process per node being worked on.
+    """
+    def __init__(self, workers=4):
+        if workers < 1:
+            raise ValueError(_("at least one worker is required"))
+
+        # Just like in WorkerPool, but with a thread and a queue of
+        # tasks instead of a process and a pipe.
+        self.workers = []
+        self.idle_workers = []
+        self.workers_alive = range(workers)
+        self.jobs_open = 0
+
+        # All threads report back through this queue.
+        self.messages = Queue()
+
+        for i in range(workers):
+            tasks = Queue()
+            t = Thread(target=_worker_thread, args=(i, self.messages, tasks))
+            t.daemon = True
+            t.start()
+            self.workers.append((t, tasks))
+
+    def _next_message(self):
+        # Queue.get() without a timeout can't be interrupted by ^C
+        while True:
+            try:
+                return self.messages.get(True, QUEUE_TIMEOUT)
+            except Empty:
+                pass
+
+    def start_task(self, wid, target, task_id=None, args=None, kwargs=None):
+        (thread, tasks) = self.workers[wid]
+        tasks.put({
+            'msg': 'RUN',
+            'task_id': task_id,
+            'target': target,
+            'target_obj': None,
+            'args': [] if args is None else list(args),
+            'kwargs': {} if kwargs is None else kwargs,
+        })
+        self.jobs_open += 1
+
+    def quit(self, wid):
+        (thread, tasks) = self.workers[wid]
+        tasks.put({'msg': 'DIE'})
+        thread.join(JOIN_TIMEOUT)
+        if thread.is_alive():
+            LOG.warn(_(
+                "worker thread {wid} didn't join within {time} seconds, "
+                "leaving it behind...").format(
+                    time=JOIN_TIMEOUT,
+                    wid=wid,
+                )
+            )
+        self.workers_alive.remove(wid)
+
+    def activate_idle_workers(self):
+        for wid in self.idle_workers:
+            (thread, tasks) = self.workers[wid]
+            tasks.put({'msg': 'NOOP'})
+        self.idle_workers = []
+
+
+def get_worker_pool(workers=4, threads=False):
+    """
+    Returns a ThreadWorkerPool if threads is True, a WorkerPool
+    otherwise.
+    """
+    if threads:
+        return ThreadWorkerPool(workers=workers)
+    else:
+        return WorkerPool(workers=workers)
@@ -1,4 +1,7 @@
-from .exceptions import BundleError
+from collections import defaultdict, deque
+from heapq import heappop, heappush
+
+from .exceptions import BundleError, ItemDependencyError
 from .items import Item
 from .items.actions import Action
 from .utils import LOG
@@ -63,22 +66,307 @@ class DummyItem(object):
         pass
 
 
+class DependencyGraph(object):
+    """
+    Indexes the items of a node by ID and type so the dependency passes
+    below don't have to scan the whole list of items for every lookup.
+
+    Once all passes have run, build_edges() records the direct
+    dependencies of every item (deps) as well as the reverse direction
+    (dependents).
+    """
+    def __init__(self, items=()):
+        self.deps = {}
+        self.dependents = {}
+        self.items = []
+        self._index = {}
+        self._order = {}
+        self._first_position = 0
+        self._next_position = 0
+        self._type_index = defaultdict(list)
+        self.add(items)
+
+    def __contains__(self, item_id):
+        return item_id in self._index
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return "<DependencyGraph: {} items>".format(len(self.items))
+
+    def add(self, items, prepend=False):
+        """
+        Adds the given items to the end (or the beginning) of the graph.
+        """
+        items = list(items)
+        if prepend:
+            self._first_position -= len(items)
+            first_position = self._first_position
+        else:
+            first_position = self._next_position
+            self._next_position += len(items)
+        for position, item in enumerate(items, first_position):
+            item_id = item.id
+            if item_id in self._index:
+                item._check_bundle_collisions([self._index[item_id]])
+            self._index[item_id] = item
+            self._order[item_id] = position
+            self._type_index[item_id.split(":", 1)[0]].append(item)
+        if prepend:
+            self.items = items + self.items
+        else:
+            self.items += items
+
+    def build_edges(self):
+        """
+        Builds the adjacency sets from the current item._deps lists.
+        """
+        self.deps = {}
+        self.dependents = {}
+        for item in self.items:
+            self.deps[item.id] = set(item._deps)
+            self.dependents.setdefault(item.id, set())
+            for dep in item._deps:
+                self.dependents.setdefault(dep, set()).add(item.id)
+        return self
+
+    def find(self, item_id):
+        """
+        Returns the item with the given ID.
+        """
+        try:
+            return self._index[item_id]
+        except KeyError:
+            raise ValueError(_("item not found: {}").format(item_id))
+
+    def of_types(self, item_types, include_dummy=False):
+        """
+        Returns all items with any of the given types (each of them
+        only once, even if its type is listed more than once).
+        """
+        result = []
+        for item_type in set(item_types):
+            for item in self._type_index.get(item_type, []):
+                if include_dummy or not item.id.endswith(":"):
+                    result.append(item)
+        result.sort(key=lambda item: self._order[item.id])
+        return result
+
+
+class ItemQueue(object):
+    """
+    Hands out the items of a prepared DependencyGraph in an order that
+    satisfies their dependencies.
+
+    Every item keeps a count of its unresolved deps. Finishing an item
+    only decrements the counters of its dependents, those reaching zero
+    are moved to the ready queue.
+
+    Ready items are handed out by priority, which is the weight of the
+    heaviest chain of items depending on them (including themselves),
+    so long chains are started before items nothing else waits for.
+    weights maps item IDs to an estimate of how long it takes to apply
+    them, items not listed count as 1 (dummy items as 0).
+    """
+    def __init__(self, graph, weights=None):
+        self.graph = graph
+        self.priorities = _chain_weights(graph, weights or {})
+        self._done = set()
+        self._open_deps = {}
+        self._pushed = 0
+        self._ready = []
+        for item in graph:
+            open_deps = len(graph.deps[item.id])
+            if open_deps:
+                self._open_deps[item.id] = open_deps
+            else:
+                self._push(item)
+
+    def __repr__(self):
+        return "<ItemQueue: {} ready, {} waiting>".format(
+            len(self._ready),
+            len(self._open_deps),
+        )
+
+    def _push(self, item):
+        # the counter keeps items of equal priority in FIFO order
+        heappush(self._ready, (-self.priorities[item.id], self._pushed, item))
+        self._pushed += 1
+
+    @property
+    def items_ready(self):
+        return bool(self._ready)
+
+    @property
+    def ready_count(self):
+        return len(self._ready)
+
+    @property
+    def items_waiting(self):
+        """
+        Items that are still waiting for some of their deps.
+        """
+        return [item for item in self.graph if item.id in self._open_deps]
+
+    def batch_with(self, item, can_join, limit=None):
+        """
+        Takes all ready items accepted by can_join (but no more than
+        limit) out of the queue and returns them in graph order (without
+        the given item). All of them have to be reported back as done or
+        failed.
+
+        Items still waiting for the given item never join it, because
+        they would have to be skipped if it fails. The exception are
+        items that are only waiting for members of the batch because
+        their type may not be applied concurrently (see
+        _inject_concurrency_blockers()): those are chained to each other
+        so only one of them is ever ready. They join regardless of
+        limit, since no other worker could have taken them anyway.
+        """
+        batch = []
+        still_ready = []
+        for entry in sorted(self._ready):
+            ready_item = entry[2]
+            if (limit is None or len(batch) < limit) and can_join(ready_item):
+                batch.append(ready_item)
+            else:
+                still_ready.append(entry)
+        # a sorted list is a valid heap
+        self._ready = still_ready
+
+        batch_ids = set([item.id] + [batch_item.id for batch_item in batch])
+        queue = deque(batch_ids)
+        while queue:
+            current_id = queue.popleft()
+            for dependent_id in self.graph.dependents.get(current_id, ()):
+                if dependent_id not in self._open_deps:
+                    continue
+                dependent = self.graph.find(dependent_id)
+                open_deps = self.graph.deps[dependent_id] - self._done
+                if (
+                    open_deps <= batch_ids and
+                    open_deps <= set(getattr(dependent, '_concurrency_deps', ())) and
+                    can_join(dependent)
+                ):
+                    del self._open_deps[dependent_id]
+                    batch.append(dependent)
+                    batch_ids.add(dependent_id)
+                    queue.append(dependent_id)
+
+        batch.sort(key=lambda batch_item: self.graph._order[batch_item.id])
+        return batch
+
+    def item_done(self, item_id):
+        """
+        Marks the given item as finished, resolving the deps on it.
+        """
+        self._done.add(item_id)
+        for dependent_id in self.graph.dependents.get(item_id, ()):
+            if dependent_id not in self._open_deps:
+                continue
+            self._open_deps[dependent_id] -= 1
+            if self._open_deps[dependent_id] == 0:
+                del self._open_deps[dependent_id]
+                self._push(self.graph.find(dependent_id))
+
+    def item_failed(self, item_id):
+        """
+        Removes all items depending (directly or not) on the given item
+        from the queue. Returns the removed items.
+        """
+        removed_items = []
+        queue = deque([item_id])
+        while queue:
+            current_id = queue.popleft()
+            direct_dependents = []
+            for dependent_id in self.graph.dependents.get(current_id, ()):
+                if dependent_id in self._open_deps:
+                    del self._open_deps[dependent_id]
+                    direct_dependents.append(self.graph.find(dependent_id))
+            if direct_dependents:
+                LOG.debug(
+                    "skipped these items because they depend on {item}, which was "
+                    "skipped previously: {skipped}".format(
+                        item=current_id,
+                        skipped=", ".join([item.id for item in direct_dependents]),
+                    )
+                )
+            removed_items += direct_dependents
+            queue.extend([item.id for item in direct_dependents])
+        return removed_items
+
+    def pop(self):
+        """
+        Returns the next item that is ready to be processed.
+        """
+        return heappop(self._ready)[2]
+
+
+def _chain_weights(graph, weights):
+    """
+    Returns a dict mapping the ID of every item in the graph to its own
+    weight plus the weight of the heaviest chain of its dependents.
+    Items in dependency loops only get their own weight.
+    """
+    def own_weight(item):
+        if item.ITEM_TYPE_NAME == 'dummy':
+            return weights.get(item.id, 0)
+        return weights.get(item.id, 1)
+
+    downstream = {}
+    open_dependents = {}
+    priorities = {}
+    queue = deque()
+    for item in graph:
+        downstream[item.id] = 0
+        open_dependents[item.id] = len(
+            [dep_id for dep_id in graph.dependents.get(item.id, ()) if dep_id in graph]
+        )
+        if not open_dependents[item.id]:
+            queue.append(item)
+    # walk the graph backwards, starting with items nothing depends on
+    while queue:
+        item = queue.popleft()
+        priorities[item.id] = own_weight(item) + downstream[item.id]
+        for dep_id in graph.deps.get(item.id, ()):
+            if dep_id not in open_dependents:
+                continue
+            downstream[dep_id] = max(downstream[dep_id], priorities[item.id])
+            open_dependents[dep_id] -= 1
+            if not open_dependents[dep_id]:
+                queue.append(graph.find(dep_id))
+    for item in graph:
+        if item.id not in priorities:
+            priorities[item.id] = own_weight(item)
+    return priorities
+
+
 def find_item(item_id, items):
     """
     Returns the first item with the given ID within the given list of
     items.
     """
-    try:
-        item = filter(lambda item: item.id == item_id, items)[0]
-    except IndexError:
-        raise ValueError(_("item not found: {}").format(item_id))
-    return item
+    if isinstance(items, DependencyGraph):
+        return items.find(item_id)
+    for item in items:
+        if item.id == item_id:
+            return item
+    raise ValueError(_("item not found: {}").format(item_id))
 
 
 def _find_items_of_types(item_types, items, include_dummy=False):
     """
     Returns a subset of items with any of the given types.
     """
+    if isinstance(items, DependencyGraph):
+        return items.of_types(item_types, include_dummy=include_dummy)
     return filter(
         lambda item:
             item.id.split(":", 1)[0] in item_types and (
@@ -88,61 +376,71 @@ def _find_items_of_types(item_types, items, include_dummy=False):
     )
 
 
-def _flatten_dependencies(items):
+def _flatten_dependencies(graph):
     """
     This will cause all dependencies - direct AND inherited - to be
-    listed in item._deps.
-    """
-    for item in items:
-        item._flattened_deps = list(set(
-            item._deps + _get_deps_for_item(item, items)
-        ))
-    return items
-
-
-def _get_deps_for_item(item, items, deps_found=None):
-    """
-    Recursively retrieves and returns a list of all inherited
-    dependencies of the given item.
+    listed in item._flattened_deps.
 
-    Note: This can handle loops, but won't detect them.
+    Items are flattened depth-first so every item can reuse the
+    flattened deps of the items it depends on. Raises
+    ItemDependencyError if a loop is found.
     """
-    if deps_found is None:
-        deps_found = []
-    deps = []
-    for dep in item._deps:
-        if dep not in deps_found:
-            deps.append(dep)
-            deps_found.append(dep)
-            deps += _get_deps_for_item(
-                find_item(dep, items),
-                items,
-                deps_found,
-            )
-    return deps
+    flattened = {}
+    for root_item in graph:
+        if root_item.id in flattened:
+            continue
+        path = [root_item.id]
+        path_ids = set(path)
+        stack = [(root_item, iter(root_item._deps))]
+        while stack:
+            item, unvisited_deps = stack[-1]
+            for dep in unvisited_deps:
+                if dep in flattened:
+                    continue
+                if dep in path_ids:
+                    loop = path[path.index(dep):] + [dep]
+                    raise ItemDependencyError(_(
+                        "dependency loop between these items: {}"
+                    ).format(" -> ".join(loop)))
+                dep_item = graph.find(dep)
+                path.append(dep)
+                path_ids.add(dep)
+                stack.append((dep_item, iter(dep_item._deps)))
+                break
+            else:
+                # all deps of this item have been flattened already
+                stack.pop()
+                path_ids.remove(path.pop())
+                deps = set(item._deps)
+                for dep in item._deps:
+                    deps.update(flattened[dep])
+                flattened[item.id] = deps
+                item._flattened_deps = list(deps)
+    return graph
 
 
-def _inject_bundle_items(items):
+def _inject_bundle_items(graph):
     """
     Adds virtual items that depend on every item in a bundle.
     """
     bundle_items = {}
-    for item in items:
+    for item in graph:
         if item.bundle is None:
             continue
         if item.bundle.name not in bundle_items:
             bundle_items[item.bundle.name] = BundleItem(item.bundle)
         bundle_items[item.bundle.name]._deps.append(item.id)
-    return list(bundle_items.values()) + items
+    graph.add(bundle_items.values(), prepend=True)
+    return graph
 
 
-def _inject_canned_actions(items):
+def _inject_canned_actions(graph):
     """
     Looks for canned actions like "svc_upstart:mysql:reload" in item
-    triggers and adds them to the list of items.
+    triggers and adds them to the graph.
     """
     added_actions = {}
-    for item in items:
+    for item in graph:
         for triggered_item_id in item.triggers:
             if triggered_item_id in added_actions:
                 continue
@@ -155,7 +453,7 @@ def _inject_canned_actions(items):
             target_item_id = "{}:{}".format(type_name, item_name)
 
             try:
-                target_item = find_item(target_item_id, items)
+                target_item = graph.find(target_item_id)
             except ValueError:
                 raise BundleError(_(
                     "{item} in bundle '{bundle}' triggers unknown item '{target_item}'"
@@ -185,20 +483,21 @@ def _inject_canned_actions(items):
                 action_attrs,
                 skip_name_validation=True,
             )
-            action._prepare_deps(items)
+            action._prepare_deps(graph)
             added_actions[triggered_item_id] = action
 
-    return items + list(added_actions.values())
+    graph.add(added_actions.values())
+    return graph
 
 
-def _inject_concurrency_blockers(items):
+def _inject_concurrency_blockers(graph):
     """
     Looks for items with PARALLEL_APPLY set to False and inserts
     dependencies to force a sequential apply.
     """
     # find every item type that cannot be applied in parallel
     item_types = []
-    for item in items:
+    for item in graph:
         item._concurrency_deps = []
         if (
             item.ITEM_TYPE_NAME == 'dummy' or
@@ -213,31 +512,33 @@ def _inject_concurrency_blockers(items):
     # blocked types while respecting existing dependencies between them
     for item_type in item_types:
         blocked_types = item_type.BLOCK_CONCURRENT + [item_type.ITEM_TYPE_NAME]
-        type_items = _find_items_of_types(
-            blocked_types,
-            items,
-        )
-        processed_items = []
-        for item in type_items:
-            # disregard deps to items of other types
-            item.__deps = filter(
-                lambda dep: dep.split(":", 1)[0] in blocked_types,
-                item._flattened_deps,
-            )
+        type_items = graph.of_types(blocked_types)
+        positions = {}
+        for position, item in enumerate(type_items):
+            positions[item.id] = position
+
+        # count deps to items of the blocked types, disregarding deps
+        # to items of other types
+        open_deps = []
+        waiting_items = defaultdict(list)
+        ready = []
+        for position, item in enumerate(type_items):
+            same_type_deps = [
+                dep for dep in item._flattened_deps
+                if dep.split(":", 1)[0] in blocked_types
+            ]
+            open_deps.append(len(same_type_deps))
+            for dep in same_type_deps:
+                waiting_items[dep].append(position)
+            if not same_type_deps:
+                heappush(ready, position)
+
+        # always continue with the first item (in graph order) without
+        # open same-type deps -- items that still have deps once the
+        # heap runs dry already depend on another item of this type
         previous_item = None
-        while len(processed_items) < len(type_items):
-            # find the first item without same-type deps we haven't
-            # processed yet
-            try:
-                item = filter(
-                    lambda item: not item.__deps and item not in processed_items,
-                    type_items,
-                )[0]
-            except IndexError:
-                # this can happen if the flattened deps of all items of
-                # this type already contain a dependency on another
-                # item of this type
-                break
+        while ready:
+            item = type_items[heappop(ready)]
             if previous_item is not None:  # unless we're at the first item
                 # add dep to previous item -- unless it's already in there
                 if not previous_item.id in item._deps:
@@ -245,24 +546,21 @@ def _inject_concurrency_blockers(items):
                     item._concurrency_deps.append(previous_item.id)
                     item._flattened_deps.append(previous_item.id)
             previous_item = item
-            processed_items.append(item)
-            for other_item in type_items:
-                try:
-                    other_item.__deps.remove(item.id)
-                except ValueError:
-                    pass
-    return items
+            for position in waiting_items.get(item.id, []):
+                open_deps[position] -= 1
+                if open_deps[position] == 0:
+                    heappush(ready, position)
+    return graph
 
 
-def _inject_dummy_items(items):
+def _inject_dummy_items(graph):
     """
-    Takes a list of items and adds dummy items depending on each type of
-    item in the list. Returns the appended list.
+    Adds dummy items to the given graph that depend on each type of
+    item in it.
     """
     # first, find all types of items and add dummy deps
     dummy_items = {}
-    items = list(items)
-    for item in items:
+    for item in graph:
         # create dummy items that depend on each item of their type
         item_type = item.id.split(":")[0]
         if item_type not in dummy_items:
@@ -274,10 +572,11 @@ def _inject_dummy_items(items):
             item_type = dep.split(":")[0]
             if item_type not in dummy_items:
                 dummy_items[item_type] = DummyItem(item_type)
-    return list(dummy_items.values()) + items
+    graph.add(dummy_items.values(), prepend=True)
+    return graph
 
 
-def _inject_reverse_dependencies(items):
+def _inject_reverse_dependencies(graph):
     """
     Looks for 'needed_by' deps and creates standard dependencies
     accordingly.
@@ -287,40 +586,41 @@ def _inject_reverse_dependencies(items):
             item._deps.append(dep)
             item._reverse_deps.append(dep)
 
-    for item in items:
+    for item in graph:
         item._reverse_deps = []
 
-    for item in items:
+    for item in graph:
         for depending_item_id in item.needed_by:
             # bundle items
             if depending_item_id.startswith("bundle:"):
                 depending_bundle_name = depending_item_id.split(":")[1]
-                for depending_item in items:
-                    if depending_item.bundle.name == depending_bundle_name:
+                for depending_item in graph:
+                    if depending_item.bundle is not None and \
+                            depending_item.bundle.name == depending_bundle_name:
                         add_dep(depending_item, item.id)
 
             # dummy items
             if depending_item_id.endswith(":"):
                 target_type = depending_item_id[:-1]
-                for depending_item in _find_items_of_types([target_type], items):
+                for depending_item in graph.of_types([target_type]):
                     add_dep(depending_item, item.id)
 
             # single items
             else:
-                depending_item = find_item(depending_item_id, items)
+                depending_item = graph.find(depending_item_id)
                 add_dep(depending_item, item.id)
-    return items
+    return graph
 
 
-def _inject_trigger_dependencies(items):
+def _inject_trigger_dependencies(graph):
     """
     Injects dependencies from all triggered items to their triggering
     items.
     """
-    for item in items:
+    for item in graph:
         for triggered_item_id in item.triggers:
             try:
-                triggered_item = find_item(triggered_item_id, items)
+                triggered_item = graph.find(triggered_item_id)
             except ValueError:
                 raise BundleError(_(
                     "unable to find definition of '{item1}' triggered "
@@ -342,82 +642,24 @@ def _inject_trigger_dependencies(items):
                     bundle2=item.bundle.name,
                 ))
             triggered_item._deps.append(item.id)
-    return items
+    return graph
 
 
 def prepare_dependencies(items):
     """
-    Performs all dependency preprocessing on a list of items.
-    """
-    items = list(items)
-
-    for item in items:
-        item._check_bundle_collisions(items)
-        item._prepare_deps(items)
-
-    items = _inject_dummy_items(items)
-    items = _inject_bundle_items(items)
-    items = _inject_canned_actions(items)
-    items = _inject_reverse_dependencies(items)
-    items = _inject_trigger_dependencies(items)
-    items = _flatten_dependencies(items)
-    items = _inject_concurrency_blockers(items)
-    return items
-
-
-def remove_dep_from_items(items, dep):
-    """
-    Removes the given item id (dep) from the temporary list of
-    dependencies of all items in the given list.
-    """
-    for item in items:
-        try:
-            item._deps.remove(dep)
-        except ValueError:
-            pass
-    return items
-
-
-def remove_item_dependents(items, dep):
-    """
-    Removes the items depending on the given id from the list of items.
+    Performs all dependency preprocessing on a list of items. Returns
+    a DependencyGraph.
     """
-    removed_items = []
-    for item in items:
-        if dep in item._deps:
-            removed_items.append(item)
-
-    for item in removed_items:
-        items.remove(item)
-
-    if removed_items:
-        LOG.debug(
-            "skipped these items because they depend on {item}, which was "
-            "skipped previously: {skipped}".format(
-                item=dep,
-                skipped=", ".join([item.id for item in removed_items]),
-            )
-        )
-
-    all_recursively_removed_items = []
-    for removed_item in removed_items:
-        items, recursively_removed_items = \
-            remove_item_dependents(items, removed_item.id)
-        all_recursively_removed_items += recursively_removed_items
+    graph = DependencyGraph(items)
 
-    return (items, removed_items + all_recursively_removed_items)
+    for item in graph:
+        item._prepare_deps(graph)
 
-
-def split_items_without_deps(items):
-    """
-    Takes a list of items and extracts the ones that don't have any
-    dependencies. The extracted deps are returned as a list.
-    """
-    items = list(items)  # make sure we're not returning a generator
-    removed_items = []
-    for item in items:
-        if not item._deps:
-            removed_items.append(item)
-    for item in removed_items:
-        items.remove(item)
-    return (items, removed_items)
+    graph = _inject_dummy_items(graph)
+    graph = _inject_bundle_items(graph)
+    graph = _inject_canned_actions(graph)
+    graph = _inject_reverse_dependencies(graph)
+    graph = _inject_trigger_dependencies(graph)
+    graph = _flatten_dependencies(graph)
+    graph = _inject_concurrency_blockers(graph)
+    return graph.build_edges()
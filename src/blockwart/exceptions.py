@@ -26,6 +26,14 @@ class RemoteException(Exception):
     pass
 
 
+class SessionError(RemoteException):
+    """
+    Raised when an agent or shell session on a node breaks down (e.g.
+    because the remote process died) and can no longer be used.
+    """
+    pass
+
+
 class RepositoryError(Exception):
     """
     Indicates that somethings is wrong with the current repository.
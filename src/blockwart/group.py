@@ -1,5 +1,3 @@
-import re
-
 from .exceptions import RepositoryError
 from .utils import cached_property
 from .utils.text import mark_for_translation as _, validate_name
@@ -56,32 +54,7 @@ class Group(object):
         """
         List of all nodes in this group.
         """
-        result = []
-        result += list(self._nodes_from_static_members)
-        result += list(self._nodes_from_subgroups)
-        result += list(self._nodes_from_patterns)
-        result = list(set(result))
-        result.sort()
-        return result
-
-    @property
-    def _nodes_from_static_members(self):
-        for node_name in self.static_member_names:
-            yield self.repo.get_node(node_name)
-
-    @property
-    def _nodes_from_subgroups(self):
-        for subgroup in self.subgroups:
-            for node in subgroup.nodes:
-                yield node
-
-    @property
-    def _nodes_from_patterns(self):
-        for pattern in self.patterns:
-            compiled_pattern = re.compile(pattern)
-            for node in self.repo.nodes:
-                if not compiled_pattern.search(node.name) is None:
-                    yield node
+        return self.repo.nodes_in_group(self.name)
 
     def _check_subgroup_names(self, visited_names):
         """
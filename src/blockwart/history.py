@@ -0,0 +1,134 @@
+from os import environ, makedirs
+from os.path import abspath, isdir, join
+import sqlite3
+from time import time
+
+from .utils import LOG, sha1
+
+# how much a new duration counts towards the estimate (the rest is
+# made up by earlier applies)
+HISTORY_WEIGHT = 0.3
+HISTORY_TIMEOUT = 30  # seconds to wait for other processes writing
+
+KIND_ITEM = "item"
+KIND_NODE = "node"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS durations (
+    kind TEXT NOT NULL,
+    node TEXT NOT NULL,
+    name TEXT NOT NULL,
+    estimate REAL NOT NULL,
+    samples INTEGER NOT NULL,
+    recorded REAL NOT NULL,
+    PRIMARY KEY (kind, node, name)
+)
+"""
+
+
+class DurationHistory(object):
+    """
+    Keeps a moving average of how long it took to apply items and
+    nodes in an SQLite database below $BWHISTORYCACHE (one per repo),
+    so the schedulers can start the longest jobs first. Does nothing
+    unless $BWHISTORYCACHE is set.
+
+    All durations are in seconds. Since this is only used to speed
+    things up, failing to read or write the database is never fatal.
+    """
+    def __init__(self, repo):
+        self.cache_dir = environ.get("BWHISTORYCACHE")
+        self.repo_path = repo.path
+
+    def _connect(self):
+        if not self.cache_dir:
+            return None
+        if not isdir(self.cache_dir):
+            try:
+                makedirs(self.cache_dir)
+            except OSError:
+                if not isdir(self.cache_dir):
+                    LOG.debug("unable to create cache dir {}".format(self.cache_dir))
+                    return None
+        try:
+            connection = sqlite3.connect(
+                join(self.cache_dir, "{}.sqlite".format(
+                    sha1(abspath(self.repo_path).encode('utf-8')),
+                )),
+                timeout=HISTORY_TIMEOUT,
+            )
+            connection.execute(SCHEMA)
+        except sqlite3.Error as e:
+            LOG.debug("unable to open duration history: {}".format(e))
+            return None
+        return connection
+
+    def _estimates(self, kind, node_name):
+        connection = self._connect()
+        if connection is None:
+            return {}
+        try:
+            return dict(connection.execute(
+                "SELECT name, estimate FROM durations WHERE kind = ? AND node = ?",
+                (kind, node_name),
+            ))
+        except sqlite3.Error as e:
+            LOG.debug("unable to read duration history: {}".format(e))
+            return {}
+        finally:
+            connection.close()
+
+    def _record(self, kind, node_name, durations):
+        if not durations:
+            return
+        connection = self._connect()
+        if connection is None:
+            return
+        now = time()
+        try:
+            with connection:
+                for name, duration in durations.items():
+                    cursor = connection.execute(
+                        "UPDATE durations SET "
+                        "estimate = estimate + (? - estimate) * ?, "
+                        "samples = samples + 1, "
+                        "recorded = ? "
+                        "WHERE kind = ? AND node = ? AND name = ?",
+                        (duration, HISTORY_WEIGHT, now, kind, node_name, name),
+                    )
+                    if not cursor.rowcount:
+                        connection.execute(
+                            "INSERT INTO durations VALUES (?, ?, ?, ?, 1, ?)",
+                            (kind, node_name, name, duration, now),
+                        )
+        except sqlite3.Error as e:
+            LOG.debug("unable to write duration history: {}".format(e))
+        finally:
+            connection.close()
+
+    def item_estimates(self, node_name):
+        """
+        Returns a dict mapping item IDs to the estimated duration of
+        applying them to the given node.
+        """
+        return self._estimates(KIND_ITEM, node_name)
+
+    def node_estimates(self):
+        """
+        Returns a dict mapping node names to the estimated duration of
+        applying them.
+        """
+        return self._estimates(KIND_NODE, "")
+
+    def record_items(self, node_name, durations):
+        """
+        Adds the given dict of item IDs and durations to the history
+        of the given node.
+        """
+        self._record(KIND_ITEM, node_name, durations)
+
+    def record_nodes(self, durations):
+        """
+        Adds the given dict of node names and durations to the history.
+        """
+        self._record(KIND_NODE, "", durations)
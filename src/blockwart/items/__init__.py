@@ -6,10 +6,11 @@ Repository.item_classes loads them as files.
 from __future__ import unicode_literals
 from copy import copy
 from datetime import datetime
+import json
 from os.path import join
 
 from blockwart.exceptions import BundleError
-from blockwart.utils import LOG
+from blockwart.utils import LOG, sha1
 from blockwart.utils.text import mark_for_translation as _
 from blockwart.utils.text import bold, wrap_question
 from blockwart.utils.ui import ask_interactively
@@ -202,32 +203,37 @@ class Item(object):
             return self.name
         return "{}:{}".format(self.ITEM_TYPE_NAME, self.name)
 
+    def _status_before_apply(self):
+        """
+        Returns a tuple of the status code determined before fixing
+        anything (None if the item needs fixing) and the current status
+        (None if the item is skipped without looking at it).
+        """
+        if self.triggered and not self.has_been_triggered:
+            LOG.debug(_("skipping {} because it wasn't triggered").format(self.id))
+            return (self.STATUS_SKIPPED, None)
+
+        status_before = self.get_status()
+        if self.unless and not status_before.correct:
+            unless_result = self.node.run(self.unless, may_fail=True)
+            if unless_result.return_code == 0:
+                LOG.debug(_("'unless' for {} succeeded, not fixing").format(self.id))
+                return (self.STATUS_SKIPPED, status_before)
+
+        if status_before.correct:
+            return (self.STATUS_OK, status_before)
+        return (None, status_before)
+
     def apply(self, interactive=False, interactive_default=True):
         self.node.repo.hooks.item_apply_start(
             self.node.repo,
             self.node,
             self,
         )
-        status_code = None
-        status_before = None
         status_after = None
         start_time = datetime.now()
 
-        if self.triggered and not self.has_been_triggered:
-            LOG.debug(_("skipping {} because it wasn't triggered").format(self.id))
-            status_code = self.STATUS_SKIPPED
-
-        if status_code is None:
-            status_before = self.get_status()
-            if self.unless and not status_before.correct:
-                unless_result = self.node.run(self.unless, may_fail=True)
-                if unless_result.return_code == 0:
-                    LOG.debug(_("'unless' for {} succeeded, not fixing").format(self.id))
-                    status_code = self.STATUS_SKIPPED
-
-        if status_code is None:
-            if status_before.correct:
-                status_code = self.STATUS_OK
+        status_code, status_before = self._status_before_apply()
 
         if status_code is None:
             if not interactive:
@@ -264,6 +270,61 @@ class Item(object):
 
         return status_code
 
+    @classmethod
+    def apply_batch(cls, items):
+        """
+        Non-interactively applies the given items (all of this class and
+        with the same batch key) using a single call to fix_batch().
+        Returns their status codes in the same order.
+        """
+        # every item is charged for its own status checks and an equal
+        # share of fix_batch()
+        durations = []
+        statuses_before = []
+        status_codes = []
+        items_to_fix = []
+        for item in items:
+            item.node.repo.hooks.item_apply_start(
+                item.node.repo,
+                item.node,
+                item,
+            )
+            start_time = datetime.now()
+            status_code, status_before = item._status_before_apply()
+            if status_code is None:
+                items_to_fix.append((item, status_before))
+            durations.append(datetime.now() - start_time)
+            statuses_before.append(status_before)
+            status_codes.append(status_code)
+
+        if items_to_fix:
+            start_time = datetime.now()
+            cls.fix_batch(items_to_fix)
+            fix_duration = (datetime.now() - start_time) / len(items_to_fix)
+
+        for index, item in enumerate(items):
+            status_after = None
+            if status_codes[index] is None:
+                start_time = datetime.now()
+                status_after = item.get_status()
+                if status_after.correct:
+                    status_codes[index] = item.STATUS_FIXED
+                else:
+                    status_codes[index] = item.STATUS_FAILED
+                durations[index] += fix_duration + (datetime.now() - start_time)
+
+            item.node.repo.hooks.item_apply_end(
+                item.node.repo,
+                item.node,
+                item,
+                duration=durations[index],
+                status_code=status_codes[index],
+                status_before=statuses_before[index],
+                status_after=status_after,
+            )
+
+        return status_codes
+
     def ask(self, status):
         """
         Returns a string asking the user if this item should be
@@ -281,6 +342,17 @@ class Item(object):
         """
         raise NotImplementedError()
 
+    @classmethod
+    def fix_batch(cls, items_with_status):
+        """
+        Fixes all items in the given list of (item, status) tuples. This
+        is where items returning a batch key can save round trips.
+
+        MAY be overridden by subclasses.
+        """
+        for item, status in items_with_status:
+            item.fix(status)
+
     def get_auto_deps(self, items):
         """
         Return a list of item IDs this item should have dependencies on.
@@ -294,6 +366,17 @@ class Item(object):
         """
         return []
 
+    def get_batch_key(self):
+        """
+        Return a hashable value or None. Non-triggered items of the same
+        type with equal batch keys that become ready together may be
+        applied together by apply_batch(). None means the item is
+        always applied on its own.
+
+        MAY be overridden by subclasses.
+        """
+        return None
+
     def get_canned_actions(self):
         """
         Return a dictionary of action definitions (mapping action names
@@ -303,6 +386,37 @@ class Item(object):
         """
         return {}
 
+    def get_journal_fingerprint(self):
+        """
+        Return a string that changes whenever the desired state of this
+        item changes or None if it can't be determined (in which case
+        the item will never be skipped because of the journal). The
+        default implementation returns None unless all attributes can
+        be serialized as JSON (anything else has no reliable string
+        representation).
+
+        MAY be overridden by subclasses.
+        """
+        try:
+            return sha1(json.dumps(
+                [self.__class__.__name__, self.id, self.attributes],
+                sort_keys=True,
+            ).encode('utf-8'))
+        except (TypeError, ValueError):
+            return None
+
+    def get_prefetch_paths(self):
+        """
+        Return a list of (path, hash_content) tuples for paths on the
+        node this item will look at using PathInfo in get_status().
+        They will be probed in bulk for all items before the first call
+        to get_status(). Set hash_content to True if you need
+        PathInfo.sha1 as well.
+
+        MAY be overridden by subclasses.
+        """
+        return []
+
     def get_status(self):
         """
         Returns an ItemStatus instance describing the current status of
@@ -312,6 +426,18 @@ class Item(object):
         """
         raise NotImplementedError()
 
+    def get_witness_paths(self):
+        """
+        Return a list of paths on the node that will change (as in
+        inode, size, mtime or ctime) whenever something changes the
+        status of this item behind our back. Items with no witness
+        paths are never skipped because of the journal. Defaults to
+        the paths returned by get_prefetch_paths().
+
+        MAY be overridden by subclasses.
+        """
+        return [path for path, hash_content in self.get_prefetch_paths()]
+
     def patch_attributes(self, attributes):
         """
         Allows an item to preprocess the attributes it is initialized
@@ -166,6 +166,9 @@ class Directory(Item):
                     deps.append(item.id)
         return deps
 
+    def get_prefetch_paths(self):
+        return [(self.name, False)]
+
     def get_status(self):
         correct = True
         path_info = PathInfo(self.node, self.name)
@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from copy import copy
 from datetime import datetime
 from difflib import unified_diff
-from os import remove
-from os.path import dirname, exists, join, normpath
+from io import BytesIO
+import json
+from os import environ, fdopen, makedirs, rename
+from os.path import dirname, exists, isdir, join, normpath
 from pipes import quote
+import tarfile
 from sys import exc_info
 from tempfile import mkstemp
+from threading import Lock
+from time import time
 from traceback import format_exception
 
 from blockwart.exceptions import BundleError, TemplateError
@@ -17,19 +22,99 @@ from blockwart.items.directories import validator_mode
 from blockwart.utils import cached_property, LOG, sha1
 from blockwart.utils.remote import PathInfo
 from blockwart.utils.text import mark_for_translation as _
-from blockwart.utils.text import bold, green, is_subdirectory, red
+from blockwart.utils.text import bold, green, is_subdirectory, randstr, red
 
 
-DIFF_MAX_FILE_SIZE = 1024 * 1024 * 5  # bytes
+# Remote files are transferred in changed blocks only (see
+# get_remote_file_contents_by_delta()), so this is mostly about the
+# time it takes to diff them locally.
+DIFF_MAX_FILE_SIZE = 1024 * 1024 * 20  # bytes
 DIFF_MAX_LINE_LENGTH = 128
+DIFF_BLOCK_LINES = 32
+TEMPLATE_CACHE_SIZE = 256
 
+_TEMPLATE_CACHE = OrderedDict()
+# items may be applied by several threads at once (see --item-threads)
+_TEMPLATE_CACHE_LOCK = Lock()
 
-def content_processor_mako(item):
+
+def _mako_module_dir():
+    """
+    Returns the directory compiled Mako templates should be kept in
+    (below $BWCODECACHE) or None if there is no such directory.
+    """
+    cache_dir = environ.get("BWCODECACHE")
+    if not cache_dir:
+        return None
+    module_dir = join(cache_dir, "mako")
+    if not isdir(module_dir):
+        try:
+            makedirs(module_dir)
+        except OSError:
+            if not isdir(module_dir):
+                LOG.debug("unable to create Mako cache in {}".format(module_dir))
+                return None
+    return module_dir
+
+
+def _compile_mako_template(content, encoding):
     from mako.template import Template
-    template = Template(
+    kwargs = {
+        'input_encoding': 'utf-8',
+        'output_encoding': encoding,
+    }
+    module_dir = _mako_module_dir()
+    if module_dir is None:
+        return Template(content, **kwargs)
+
+    # Mako only writes compiled modules for templates it reads from
+    # files, so we keep a copy named after the content hash in the
+    # cache. That copy never changes, which means Mako will always find
+    # an up-to-date module for it after the first render.
+    content_hash = sha1(content)
+    filename = join(module_dir, content_hash + ".mako")
+    if not exists(filename):
+        handle, tmp_filename = mkstemp(dir=module_dir)
+        with fdopen(handle, 'wb') as f:
+            f.write(content)
+        rename(tmp_filename, filename)
+    return Template(
+        filename=filename,
+        module_directory=module_dir,
+        uri=content_hash,
+        **kwargs
+    )
+
+
+def get_mako_template(content, encoding):
+    """
+    Returns a compiled Mako template for the given content. The last
+    TEMPLATE_CACHE_SIZE templates are kept in memory, so rendering the
+    same template for many nodes compiles it only once.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    key = (sha1(content), encoding)
+    with _TEMPLATE_CACHE_LOCK:
+        template = _TEMPLATE_CACHE.pop(key, None)
+        if template is not None:
+            _TEMPLATE_CACHE[key] = template
+            return template
+    # compiling outside the lock, another thread might do the same in
+    # the meantime, which is wasteful, but harmless
+    template = _compile_mako_template(content, encoding)
+    with _TEMPLATE_CACHE_LOCK:
+        _TEMPLATE_CACHE.pop(key, None)
+        if len(_TEMPLATE_CACHE) >= TEMPLATE_CACHE_SIZE:
+            _TEMPLATE_CACHE.popitem(last=False)
+        _TEMPLATE_CACHE[key] = template
+    return template
+
+
+def content_processor_mako(item):
+    template = get_mako_template(
         item._template_content,
-        input_encoding='utf-8',
-        output_encoding=item.attributes['encoding'],
+        item.attributes['encoding'],
     )
     LOG.debug("{}:{}: rendering with Mako...".format(item.node.name, item.id))
     start = datetime.now()
@@ -64,6 +149,79 @@ def content_processor_mako(item):
     return content
 
 
+def _render_hash_path(item):
+    """
+    Returns the path at which the hash of the rendered content of the
+    given item is stored in $BWRENDERCACHE or None if it can't be
+    stored (e.g. because the attributes or metadata contain objects
+    that can't be serialized as JSON).
+
+    The key covers the template and everything a template usually
+    depends on: the item's attributes (including its context) and the
+    node's metadata. Templates that look at other nodes or repo-wide
+    data should not be used with $BWRENDERCACHE.
+    """
+    cache_dir = environ.get("BWRENDERCACHE")
+    if not cache_dir or item.attributes['content_type'] != 'mako':
+        # other content types are cheap to produce
+        return None
+    template_content = item._template_content
+    if isinstance(template_content, unicode):
+        template_content = template_content.encode('utf-8')
+    try:
+        fingerprint = json.dumps(
+            [
+                item.node.name,
+                item.bundle.name,
+                item.id,
+                item.attributes,
+                item.node.metadata,
+            ],
+            sort_keys=True,
+        )
+    except (TypeError, ValueError):
+        return None
+    return join(cache_dir, sha1("{}:{}".format(
+        sha1(template_content),
+        sha1(fingerprint.encode('utf-8')),
+    )))
+
+
+def get_render_hash(item):
+    """
+    Returns the known hash of the rendered content of the given item or
+    None if it has not been stored.
+    """
+    path = _render_hash_path(item)
+    if path is None:
+        return None
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def store_render_hash(item, content_hash):
+    path = _render_hash_path(item)
+    if path is None:
+        return
+    try:
+        if not isdir(dirname(path)):
+            try:
+                makedirs(dirname(path))
+            except OSError:
+                # might have been created by another process just now
+                if not isdir(dirname(path)):
+                    raise
+        handle, tmp_path = mkstemp(dir=dirname(path))
+        with fdopen(handle, 'w') as f:
+            f.write(content_hash)
+        rename(tmp_path, path)
+    except (IOError, OSError):
+        LOG.debug("unable to store render hash for {}".format(item.id))
+
+
 def content_processor_text(item):
     content = copy(item._template_content)
     if item.attributes['encoding'].lower() != "utf-8":
@@ -130,12 +288,88 @@ def get_remote_file_contents(node, path):
     """
     Returns the contents of the given path as a string.
     """
-    handle, tmp_file = mkstemp()
-    node.download(path, tmp_file)
-    with open(tmp_file) as f:
-        content = f.read()
-    remove(tmp_file)
-    return content
+    content = BytesIO()
+    node.download(path, content)
+    return content.getvalue()
+
+
+def _split_lines(content):
+    """
+    Like str.splitlines(True), but only splits at newlines (like split
+    and sed on the node do).
+    """
+    lines = content.split(b"\n")
+    last_line = lines.pop()
+    lines = [line + b"\n" for line in lines]
+    if last_line:
+        lines.append(last_line)
+    return lines
+
+
+def get_remote_file_contents_by_delta(node, path, basis):
+    """
+    Returns the contents of the given path as a string, transferring
+    only those parts of it that can't be found in basis (a string that
+    is expected to be similar to the remote file, e.g. the content it
+    is about to be replaced with).
+
+    The node sends a SHA1 hash for every block of DIFF_BLOCK_LINES
+    lines in the file. Blocks are looked up in basis at every line
+    offset, so inserted or deleted lines don't throw off the remaining
+    blocks. Only unknown blocks are fetched from the node.
+    """
+    result = node.run(
+        "split -l {} --filter=sha1sum -- {}".format(DIFF_BLOCK_LINES, quote(path)),
+        may_fail=True,
+    )
+    if result.return_code != 0:
+        # probably not GNU split
+        return get_remote_file_contents(node, path)
+    remote_hashes = [line.split()[0] for line in result.stdout.splitlines() if line.strip()]
+
+    basis_lines = _split_lines(basis)
+    known_blocks = {}
+    for start in range(len(basis_lines)):
+        block = b"".join(basis_lines[start:start + DIFF_BLOCK_LINES])
+        known_blocks.setdefault(sha1(block), block)
+    blocks = [known_blocks.get(block_hash) for block_hash in remote_hashes]
+
+    missing = [index for index, block in enumerate(blocks) if block is None]
+    if missing:
+        ranges = []
+        for index in missing:
+            if ranges and ranges[-1][1] == index - 1:
+                ranges[-1][1] = index
+            else:
+                ranges.append([index, index])
+        # the selected lines are transferred like any other file (over
+        # SFTP or the agent) instead of as base64 on stdout
+        temp_filename = ".blockwart_tmp_" + randstr()
+        try:
+            node.run(
+                "sed -n {ranges} -- {path} > {tmp} && "
+                "chown \"$SUDO_USER\" {tmp} && chmod 0400 {tmp}".format(
+                    path=quote(path),
+                    ranges=" ".join([
+                        "-e {},{}p".format(
+                            first * DIFF_BLOCK_LINES + 1,
+                            (last + 1) * DIFF_BLOCK_LINES,
+                        )
+                        for first, last in ranges
+                    ]),
+                    tmp=quote(temp_filename),
+                ),
+            )
+            fetched = get_remote_file_contents(node, temp_filename)
+        finally:
+            node.run("rm -f -- {}".format(quote(temp_filename)), may_fail=True)
+        fetched_lines = _split_lines(fetched)
+        for index in missing:
+            # only the last block can be shorter than DIFF_BLOCK_LINES
+            blocks[index] = b"".join(fetched_lines[:DIFF_BLOCK_LINES])
+            fetched_lines = fetched_lines[DIFF_BLOCK_LINES:]
+
+    return b"".join(blocks)
 
 
 def hash_local_file(path):
@@ -147,6 +381,60 @@ def hash_local_file(path):
     return sha1_hash
 
 
+def push_content_archive(node, items):
+    """
+    Uploads the content of the given file items to the node as a single
+    tar archive. Every file is unpacked to a temporary file next to its
+    target and then moved into place after setting owner, group and
+    mode, so nobody ever sees a partially written file.
+    """
+    archive = BytesIO()
+    tar = tarfile.open(fileobj=archive, mode='w')
+    commands = []
+    temp_paths = []
+    try:
+        for item in items:
+            content = item._encoded_content
+            temp_path = join(dirname(item.name), ".blockwart_tmp_" + randstr())
+            temp_paths.append(temp_path)
+            tarinfo = tarfile.TarInfo(temp_path.lstrip("/"))
+            tarinfo.size = len(content)
+            # ownership and mode are set explicitly below
+            tarinfo.mode = 0o600
+            tarinfo.mtime = time()
+            tar.addfile(tarinfo, BytesIO(content))
+
+            if item.attributes['owner'] or item.attributes['group']:
+                commands.append("chown {}:{} -- {}".format(
+                    quote(item.attributes['owner']),
+                    quote(item.attributes['group']),
+                    quote(temp_path),
+                ))
+            if item.attributes['mode']:
+                commands.append("chmod {} -- {}".format(
+                    item.attributes['mode'],
+                    quote(temp_path),
+                ))
+            commands.append("mv -f -- {} {}".format(
+                quote(temp_path),
+                quote(item.name),
+            ))
+    finally:
+        tar.close()
+    archive.seek(0)
+
+    remote_archive = ".blockwart_archive_" + randstr()
+    node.upload(archive, remote_archive)
+    node.run(
+        "tar --no-same-owner -xf {archive} -C / && {commands} ; "
+        "result=$? ; rm -f -- {archive} {temp_paths} ; exit $result".format(
+            archive=quote(remote_archive),
+            commands=" && ".join(commands),
+            temp_paths=" ".join([quote(temp_path) for temp_path in temp_paths]),
+        ),
+    )
+
+
 def validator_content(item_id, value):
     if value is not None:
         try:
@@ -218,8 +506,20 @@ class File(Item):
     def content_hash(self):
         if self.attributes['content_type'] == 'binary':
             return hash_local_file(self.template)
-        else:
-            return sha1(self.content)
+        # avoid rendering if we already know what it will look like
+        content_hash = get_render_hash(self)
+        if content_hash is not None:
+            return content_hash
+        content_hash = sha1(self.content)
+        store_render_hash(self, content_hash)
+        return content_hash
+
+    @property
+    def _encoded_content(self):
+        content = self.content
+        if isinstance(content, unicode):
+            content = content.encode(self.attributes['encoding'])
+        return content
 
     @cached_property
     def template(self):
@@ -258,7 +558,11 @@ class File(Item):
                         DIFF_MAX_FILE_SIZE,
                     )
                 else:
-                    content_is = get_remote_file_contents(self.node, self.name)
+                    content_is = get_remote_file_contents_by_delta(
+                        self.node,
+                        self.name,
+                        self._encoded_content,
+                    )
                     content_should = self.content
                     question += "\n" + diff(
                         content_is,
@@ -318,24 +622,39 @@ class File(Item):
                         node=self.node.name, item=self.id))
                 getattr(self, "_fix_" + fix_type)(status)
 
+    @classmethod
+    def fix_batch(cls, items_with_status):
+        archive_items = []
+        for item, status in items_with_status:
+            if 'content' in status.info['needs_fixing'] and \
+                    'type' not in status.info['needs_fixing']:
+                archive_items.append((item, status))
+            else:
+                item.fix(status)
+
+        if len(archive_items) == 1:
+            # not worth the archive
+            item, status = archive_items[0]
+            item.fix(status)
+        elif archive_items:
+            node = archive_items[0][0].node
+            for item, status in archive_items:
+                LOG.info(_("{node}:{item}: fixing {type}...").format(
+                    node=node.name, item=item.id, type="content"))
+            push_content_archive(node, [item for item, status in archive_items])
+
     def _fix_content(self, status):
         if self.attributes['content_type'] == 'binary':
-            local_path = self.template
+            source = self.template
         else:
-            handle, local_path = mkstemp()
-            with open(local_path, 'w') as f:
-                f.write(self.content)
-        try:
-            self.node.upload(
-                local_path,
-                self.name,
-                mode=self.attributes['mode'],
-                owner=self.attributes['owner'],
-                group=self.attributes['group'],
-            )
-        finally:
-            if self.attributes['content_type'] != 'binary':
-                remove(local_path)
+            source = BytesIO(self._encoded_content)
+        self.node.upload(
+            source,
+            self.name,
+            mode=self.attributes['mode'],
+            owner=self.attributes['owner'],
+            group=self.attributes['group'],
+        )
 
     def _fix_mode(self, status):
         self.node.run("chmod {} -- {}".format(
@@ -376,6 +695,28 @@ class File(Item):
                     deps.append(item.id)
         return deps
 
+    def get_batch_key(self):
+        # binary files might be too large to be put into an archive in
+        # memory
+        if self.attributes['delete'] or \
+                self.attributes['content_type'] in ('any', 'binary'):
+            return None
+        return "content"
+
+    def get_journal_fingerprint(self):
+        fingerprint = super(File, self).get_journal_fingerprint()
+        if fingerprint is None or self.attributes['delete'] or \
+                self.attributes['content_type'] == 'any':
+            return fingerprint
+        # the attributes only tell us where the content comes from
+        return sha1("{}:{}".format(fingerprint, self.content_hash))
+
+    def get_prefetch_paths(self):
+        return [(
+            self.name,
+            self.attributes['content_type'] != 'any' and not self.attributes['delete'],
+        )]
+
     def get_status(self):
         correct = True
         path_info = PathInfo(self.node, self.name)
@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 
 from blockwart.exceptions import BundleError
 from blockwart.items import BUILTIN_ITEM_ATTRIBUTES, Item, ItemStatus
-from blockwart.items.users import _USERNAME_VALID_CHARACTERS
+from blockwart.items.users import _ACCOUNT_FILES, _USERNAME_VALID_CHARACTERS, _accounts, _accounts_changed
 from blockwart.utils import LOG
 from blockwart.utils.text import mark_for_translation as _
 from blockwart.utils.text import bold
@@ -69,24 +69,25 @@ class Group(Item):
                 gid=self.attributes['gid'],
                 groupname=self.name,
             ))
+        _accounts_changed(self.node)
 
     def get_status(self):
         # verify content of /etc/group
-        grep_result = self.node.run(
-            "grep -e '^{}:' /etc/group".format(self.name),
-            may_fail=True,
-        )
-        if grep_result.return_code != 0:
+        group_lines = _accounts(self.node)['group']
+        if self.name not in group_lines:
             return ItemStatus(correct=self.attributes['delete'], info={'exists': False})
 
         status = ItemStatus(correct=not self.attributes['delete'], info={'exists': True})
-        status.info.update(_parse_group_line(grep_result.stdout))
+        status.info.update(_parse_group_line(group_lines[self.name]))
 
         if status.info['gid'] != self.attributes['gid']:
             status.correct = False
 
         return status
 
+    def get_witness_paths(self):
+        return ["/etc/" + filename for filename in _ACCOUNT_FILES]
+
     @classmethod
     def validate_attributes(cls, bundle, item_id, attributes):
         if attributes.get('delete', False):
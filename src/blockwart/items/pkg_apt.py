@@ -5,17 +5,29 @@ from pipes import quote
 from blockwart.exceptions import BundleError
 from blockwart.items import Item, ItemStatus
 from blockwart.utils import LOG
+from blockwart.utils.remote import node_cache
 from blockwart.utils.text import bold, green, red
 from blockwart.utils.text import mark_for_translation as _
 
 
-def pkg_install(node, pkgname):
-    return node.run("DEBIAN_FRONTEND=noninteractive "
-                    "apt-get -qy --no-install-recommends "
-                    "install {}".format(quote(pkgname)))
+def pkg_install(node, *pkgnames):
+    result = node.run("DEBIAN_FRONTEND=noninteractive "
+                      "apt-get -qy --no-install-recommends "
+                      "install {}".format(" ".join([quote(p) for p in pkgnames])))
+    node_cache(node).pop('pkg_apt', None)
+    return result
 
 
 def pkg_installed(node, pkgname):
+    cache = node_cache(node)
+    if 'pkg_apt' not in cache:
+        cache['pkg_apt'] = pkg_list_installed(node)
+    if cache['pkg_apt'] is None:
+        return pkg_installed_single(node, pkgname)
+    return pkgname in cache['pkg_apt']
+
+
+def pkg_installed_single(node, pkgname):
     result = node.run(
         "dpkg -s {} | grep '^Status: '".format(quote(pkgname)),
         may_fail=True,
@@ -26,9 +38,38 @@ def pkg_installed(node, pkgname):
         return True
 
 
-def pkg_remove(node, pkgname):
-    return node.run("DEBIAN_FRONTEND=noninteractive "
-                    "apt-get -qy purge {}".format(quote(pkgname)))
+def pkg_list_installed(node):
+    """
+    Returns a set of all installed packages (with and without
+    architecture suffix) or None if dpkg-query is unavailable.
+    """
+    result = node.run(
+        "dpkg-query -W -f='${Package}:${Architecture} ${Status}\\n'",
+        may_fail=True,
+    )
+    if result.return_code != 0:
+        LOG.debug(_("unable to list installed packages on {node}").format(
+            node=node.name,
+        ))
+        return None
+    installed = set()
+    for line in result.stdout.splitlines():
+        try:
+            pkgname, status = line.strip().split(" ", 1)
+        except ValueError:
+            continue
+        if status.split()[-1] != "installed":
+            continue
+        installed.add(pkgname)
+        installed.add(pkgname.split(":", 1)[0])
+    return installed
+
+
+def pkg_remove(node, *pkgnames):
+    result = node.run("DEBIAN_FRONTEND=noninteractive "
+                      "apt-get -qy purge {}".format(" ".join([quote(p) for p in pkgnames])))
+    node_cache(node).pop('pkg_apt', None)
+    return result
 
 
 class AptPkg(Item):
@@ -73,6 +114,27 @@ class AptPkg(Item):
             ))
             pkg_install(self.node, self.name)
 
+    @classmethod
+    def fix_batch(cls, items_with_status):
+        items = [item for item, status in items_with_status]
+        node = items[0].node
+        pkgnames = [item.name for item in items]
+        if items[0].attributes['installed'] is False:
+            LOG.info(_("{node}: removing {pkgs}...").format(
+                node=node.name,
+                pkgs=", ".join(pkgnames),
+            ))
+            pkg_remove(node, *pkgnames)
+        else:
+            LOG.info(_("{node}: installing {pkgs}...").format(
+                node=node.name,
+                pkgs=", ".join(pkgnames),
+            ))
+            pkg_install(node, *pkgnames)
+
+    def get_batch_key(self):
+        return self.attributes['installed']
+
     def get_status(self):
         install_status = pkg_installed(self.node, self.name)
         item_status = (install_status == self.attributes['installed'])
@@ -81,6 +143,9 @@ class AptPkg(Item):
             info={'installed': install_status},
         )
 
+    def get_witness_paths(self):
+        return ["/var/lib/dpkg/status"]
+
     @classmethod
     def validate_attributes(cls, bundle, item_id, attributes):
         if not isinstance(attributes.get('installed', True), bool):
@@ -6,13 +6,16 @@ from pipes import quote
 from blockwart.exceptions import BundleError
 from blockwart.items import Item, ItemStatus
 from blockwart.utils import LOG
+from blockwart.utils.remote import node_cache
 from blockwart.utils.text import bold, green, red
 from blockwart.utils.text import mark_for_translation as _
 
 
 def pkg_install(node, pkgname, operation='S'):
-    return node.run("pacman --noconfirm -{} {}".format(operation,
-                                                       quote(pkgname)))
+    result = node.run("pacman --noconfirm -{} {}".format(operation,
+                                                         quote(pkgname)))
+    node_cache(node).pop('pkg_pacman', None)
+    return result
 
 
 def pkg_install_tarball(node, local_file):
@@ -23,6 +26,15 @@ def pkg_install_tarball(node, local_file):
 
 
 def pkg_installed(node, pkgname):
+    cache = node_cache(node)
+    if 'pkg_pacman' not in cache:
+        cache['pkg_pacman'] = pkg_list_installed(node)
+    if cache['pkg_pacman'] is None:
+        return pkg_installed_single(node, pkgname)
+    return pkgname in cache['pkg_pacman']
+
+
+def pkg_installed_single(node, pkgname):
     result = node.run(
         "pacman -Q {}".format(quote(pkgname)),
         may_fail=True,
@@ -33,8 +45,28 @@ def pkg_installed(node, pkgname):
         return True
 
 
+def pkg_list_installed(node):
+    """
+    Returns a set of all installed packages or None if pacman is
+    unavailable.
+    """
+    result = node.run("pacman -Q", may_fail=True)
+    if result.return_code != 0:
+        LOG.debug(_("unable to list installed packages on {node}").format(
+            node=node.name,
+        ))
+        return None
+    installed = set()
+    for line in result.stdout.splitlines():
+        if line.strip():
+            installed.add(line.split()[0])
+    return installed
+
+
 def pkg_remove(node, pkgname):
-    return node.run("pacman --noconfirm -Rs {}".format(quote(pkgname)))
+    result = node.run("pacman --noconfirm -Rs {}".format(quote(pkgname)))
+    node_cache(node).pop('pkg_pacman', None)
+    return result
 
 
 class PacmanPkg(Item):
@@ -97,6 +129,9 @@ class PacmanPkg(Item):
             info={'installed': install_status},
         )
 
+    def get_witness_paths(self):
+        return ["/var/lib/pacman/local"]
+
     @classmethod
     def validate_attributes(cls, bundle, item_id, attributes):
         if not isinstance(attributes.get('installed', True), bool):
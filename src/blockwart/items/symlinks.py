@@ -133,6 +133,9 @@ class Symlink(Item):
                     deps.append(item.id)
         return deps
 
+    def get_prefetch_paths(self):
+        return [(self.name, False)]
+
     def get_status(self):
         correct = True
         path_info = PathInfo(self.node, self.name)
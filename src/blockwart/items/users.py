@@ -9,6 +9,7 @@ from passlib.hash import md5_crypt, sha256_crypt, sha512_crypt
 from blockwart.exceptions import BundleError
 from blockwart.items import BUILTIN_ITEM_ATTRIBUTES, Item, ItemStatus
 from blockwart.utils import LOG
+from blockwart.utils.remote import node_cache
 from blockwart.utils.text import mark_for_translation as _
 from blockwart.utils.text import bold
 
@@ -34,14 +35,59 @@ HASH_METHODS = {
 
 _USERNAME_VALID_CHARACTERS = ascii_lowercase + digits + "-_"
 
+_ACCOUNT_FILES = ('passwd', 'shadow', 'group')
+
+
+def _accounts(node):
+    """
+    Returns a dictionary mapping 'passwd', 'shadow' and 'group' to
+    dictionaries of the lines in the respective files in /etc, keyed by
+    account name. All three files are read with a single command and
+    kept in the node cache until an item changes accounts on the node.
+    """
+    cache = node_cache(node)
+    if 'accounts' not in cache:
+        result = node.run(
+            "cat /etc/passwd; printf '\\0'; "
+            "cat /etc/shadow 2>/dev/null; printf '\\0'; "
+            "cat /etc/group"
+        )
+        accounts = {}
+        for filename, content in zip(_ACCOUNT_FILES, result.stdout.split("\0")):
+            accounts[filename] = {}
+            for line in content.splitlines():
+                if ":" in line:
+                    accounts[filename][line.split(":", 1)[0]] = line.strip()
+        cache['accounts'] = accounts
+    return cache['accounts']
+
+
+def _accounts_changed(node):
+    """
+    Drops the cached result of _accounts() once accounts have been
+    changed.
+    """
+    node_cache(node).pop('accounts', None)
+
 
 def _groups_for_user(node, username):
     """
     Returns the list of group names for the given username on the given
-    node.
+    node (primary group first, like `id -Gn`).
     """
-    idcmd = node.run("id -Gn {}".format(username))
-    return idcmd.stdout.strip().split(" ")
+    accounts = _accounts(node)
+    gid = _parse_passwd_line(accounts['passwd'][username])['gid']
+    primary_group = str(gid)
+    groups = []
+    for groupname, line in sorted(accounts['group'].items()):
+        fields = line.split(":")
+        if len(fields) < 4:
+            continue
+        if fields[2] == str(gid):
+            primary_group = groupname
+        elif username in fields[3].split(","):
+            groups.append(groupname)
+    return [primary_group] + groups
 
 
 def _parse_passwd_line(line):
@@ -174,14 +220,13 @@ class User(Item):
                     username=self.name,
                 )
             )
+        _accounts_changed(self.node)
 
     def get_status(self):
+        accounts = _accounts(self.node)
+
         # verify content of /etc/passwd
-        passwd_grep_result = self.node.run(
-            "grep -e '^{}:' /etc/passwd".format(self.name),
-            may_fail=True,
-        )
-        if passwd_grep_result.return_code != 0:
+        if self.name not in accounts['passwd']:
             return ItemStatus(
                 correct=self.attributes['delete'],
                 info={'exists': False},
@@ -190,22 +235,18 @@ class User(Item):
             return ItemStatus(correct=False, info={'exists': True})
 
         status = ItemStatus(correct=True, info={'exists': True})
-        status.info.update(_parse_passwd_line(passwd_grep_result.stdout))
+        status.info.update(_parse_passwd_line(accounts['passwd'][self.name]))
 
-        if passwd_grep_result.stdout.strip() != self.line_passwd:
+        if accounts['passwd'][self.name] != self.line_passwd:
             status.correct = False
 
         if self.attributes['use_shadow']:
             # verify content of /etc/shadow
-            shadow_grep_result = self.node.run(
-                "grep -e '^{}:' /etc/shadow".format(self.name),
-                may_fail=True,
-            )
-            if shadow_grep_result.return_code != 0:
+            if self.name not in accounts['shadow']:
                 status.correct = False
                 status.info['shadow_hash'] = None
             else:
-                status.info['shadow_hash'] = shadow_grep_result.stdout.split(":")[1]
+                status.info['shadow_hash'] = accounts['shadow'][self.name].split(":")[1]
                 if status.info['shadow_hash'] != self.attributes['password_hash']:
                     status.correct = False
         else:
@@ -219,6 +260,9 @@ class User(Item):
 
         return status
 
+    def get_witness_paths(self):
+        return ["/etc/" + filename for filename in _ACCOUNT_FILES]
+
     @property
     def line_passwd(self):
         return ':'.join([
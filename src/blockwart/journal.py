@@ -0,0 +1,117 @@
+from io import BytesIO
+import json
+from pipes import quote
+from time import time
+
+from .utils import LOG
+from .utils.remote import stat_paths
+from .utils.text import mark_for_translation as _
+
+JOURNAL_DIR = "/var/lib/blockwart"
+JOURNAL_FILE = JOURNAL_DIR + "/journal"
+# the journal is ignored (and all items are checked) if the last apply
+# that did so is older than this
+JOURNAL_SWEEP_INTERVAL = 60 * 60 * 24  # seconds
+
+
+def _fingerprint(item):
+    try:
+        return item.get_journal_fingerprint()
+    except Exception as e:
+        LOG.debug("unable to fingerprint {item}: {error}".format(error=e, item=item.id))
+        return None
+
+
+def _journaled_items(items):
+    for item in items:
+        if (
+            item.ITEM_TYPE_NAME not in ('action', 'dummy') and
+            not item.triggered and
+            not item.unless and
+            item.get_witness_paths()
+        ):
+            yield item
+
+
+class Journal(object):
+    """
+    Records the state of items on a node after an apply, so the next
+    apply can skip items that neither have changed in the repo nor on
+    the node (as told by the inode, size, mtime and ctime of their
+    witness paths, see Item.get_witness_paths()).
+    """
+    def __init__(self, node):
+        self.node = node
+        self.entries = {}
+        self.swept = None
+        self.unchanged = set()
+
+    def load(self, items):
+        """
+        Reads the journal from the node and figures out which of the
+        given items are unchanged.
+        """
+        content = BytesIO()
+        self.node.download(JOURNAL_FILE, content, ignore_failure=True)
+        try:
+            journal = json.loads(content.getvalue())
+            self.entries = journal['items']
+            self.swept = journal['swept']
+            sweep_due = time() - self.swept > JOURNAL_SWEEP_INTERVAL
+        except (KeyError, TypeError, ValueError):
+            LOG.debug("no usable journal on {}".format(self.node.name))
+            self.entries = {}
+            self.swept = None
+            return
+
+        if sweep_due:
+            LOG.info(_("{}: journal is due for a full sweep").format(self.node.name))
+            return
+
+        candidates = [item for item in _journaled_items(items) if item.id in self.entries]
+        witnesses = self._witnesses(candidates)
+        for item in candidates:
+            fingerprint, witness = self.entries[item.id]
+            if fingerprint is not None and \
+                    fingerprint == _fingerprint(item) and \
+                    witness == witnesses[item.id]:
+                self.unchanged.add(item.id)
+        LOG.debug(_("{node}: {count} items unchanged according to journal").format(
+            count=len(self.unchanged),
+            node=self.node.name,
+        ))
+
+    def save(self, items, results, skipped_any):
+        """
+        Writes the journal for the given items to the node. Only items
+        that ended up correct are recorded.
+        """
+        items = [
+            item for item in _journaled_items(items)
+            if results.get(item.id) in (item.STATUS_OK, item.STATUS_FIXED)
+        ]
+        witnesses = self._witnesses(items)
+        entries = {}
+        for item in items:
+            entries[item.id] = [_fingerprint(item), witnesses[item.id]]
+        self.node.run("mkdir -p {}".format(quote(JOURNAL_DIR)))
+        self.node.upload(
+            BytesIO(json.dumps({
+                'items': entries,
+                'swept': self.swept if skipped_any else time(),
+            }).encode('utf-8')),
+            JOURNAL_FILE,
+            mode="0600",
+        )
+
+    def _witnesses(self, items):
+        paths = set()
+        for item in items:
+            paths.update(item.get_witness_paths())
+        path_stats = stat_paths(self.node, sorted(paths))
+        witnesses = {}
+        for item in items:
+            witnesses[item.id] = [
+                [path, path_stats[path]] for path in sorted(item.get_witness_paths())
+            ]
+        return witnesses
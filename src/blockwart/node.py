@@ -3,20 +3,22 @@ from __future__ import unicode_literals
 
 from datetime import datetime
 from getpass import getuser
+from io import BytesIO
 import json
 from pipes import quote
 from socket import gethostname
-from tempfile import mkstemp
 from time import time
 
 from . import operations
 from .bundle import Bundle
-from .concurrency import WorkerPool
-from .deps import find_item, prepare_dependencies, remove_item_dependents, remove_dep_from_items, \
-    split_items_without_deps
+from .concurrency import get_worker_pool
+from .deps import ItemQueue, prepare_dependencies
 from .exceptions import ItemDependencyError, NodeAlreadyLockedException, RepositoryError
+from .history import DurationHistory
 from .items import Item
+from .journal import Journal
 from .utils import cached_property, LOG, graph_for_items
+from .utils.remote import expire_node_cache, prefetch_path_info, probe_paths
 from .utils.text import mark_for_translation as _
 from .utils.text import bold, green, red, validate_name, yellow
 from .utils.ui import ask_interactively
@@ -64,13 +66,101 @@ class ApplyResult(object):
         return self.end - self.start
 
 
-def apply_items(node, workers=1, interactive=False):
-    items = prepare_dependencies(node.items)
+def _apply_item(item, interactive=False, probe_results=None, node_changes=None,
+                unchanged=False):
+    """
+    Runs in a worker process. Hands the results of probing the item's
+    paths in advance over to PathInfo before applying the item and
+    drops cached node state if other items have changed the node since
+    it was cached. Items found to be unchanged by the journal are not
+    looked at.
+    """
+    if unchanged:
+        LOG.debug(_("{} unchanged according to journal").format(item.id))
+        return item.STATUS_OK
+    if item.ITEM_TYPE_NAME != 'dummy':
+        expire_node_cache(item.node, generation=node_changes)
+    if probe_results:
+        for path, probe_result in probe_results.iteritems():
+            prefetch_path_info(item.node, path, probe_result)
+    return item.apply(interactive=interactive)
+
+
+def _apply_batch(items, probe_results=None, node_changes=None):
+    """
+    Runs in a worker process. Like _apply_item(), but applies all given
+    items at once (see ItemQueue.batch_with()). Returns a list of
+    status codes.
+    """
+    expire_node_cache(items[0].node, generation=node_changes)
+    if probe_results:
+        for path, probe_result in probe_results.iteritems():
+            prefetch_path_info(items[0].node, path, probe_result)
+    return items[0].apply_batch(items)
 
-    with WorkerPool(workers=workers) as worker_pool:
-        items_with_deps, items_without_deps = \
-            split_items_without_deps(items)
 
+def _batch_filter(item, exclude=()):
+    """
+    Returns a callable telling which items may be applied together with
+    the given item. Items whose IDs are in exclude never may.
+    """
+    batch_key = item.get_batch_key()
+
+    def can_join(other_item):
+        return (
+            other_item.__class__ is item.__class__ and
+            not other_item.triggered and
+            other_item.id not in exclude and
+            other_item.get_batch_key() == batch_key
+        )
+    return can_join
+
+
+def _probe_item_paths(node, items):
+    """
+    Probes the paths of all given items with as few commands as
+    possible. Returns a dict mapping paths to probe results.
+    """
+    paths = []
+    hash_paths = []
+    for item in items:
+        if item.ITEM_TYPE_NAME == 'dummy':
+            continue
+        for path, hash_content in item.get_prefetch_paths():
+            paths.append(path)
+            if hash_content:
+                hash_paths.append(path)
+    if not paths:
+        return {}
+    return probe_paths(node, paths, hash_paths=hash_paths)
+
+
+def apply_items(node, workers=1, interactive=False, threads=False, journal=False):
+    items = prepare_dependencies(node.items)
+    history = DurationHistory(node.repo)
+    item_queue = ItemQueue(items, weights=history.item_estimates(node.name))
+    # maps task IDs to the time they were started at, only for tasks
+    # whose duration is worth recording
+    task_starts = {}
+    item_durations = {}
+
+    # Like probe results, the journal is only good until the first item
+    # changes something on the node.
+    node_journal = None
+    journal_skipped = 0
+    status_codes = {}
+    if journal:
+        node_journal = Journal(node)
+        node_journal.load(items)
+
+    # Probe results are only valid until the first item changes
+    # something on the node. From then on, items have to look for
+    # themselves.
+    probe_results = _probe_item_paths(node, items)
+    node_changes = 0
+    batches = {}
+
+    with get_worker_pool(workers=workers, threads=threads) as worker_pool:
         # This whole thing is set in motion because every worker
         # initially asks for work. He also reports back when he finished
         # a job. Actually, all these conditions are internal to
@@ -79,21 +169,65 @@ def apply_items(node, workers=1, interactive=False):
             msg = worker_pool.get_event()
 
             if msg['msg'] == 'REQUEST_WORK':
-                if items_without_deps:
+                if item_queue.items_ready:
                     # There's work! Do it.
-                    item = items_without_deps.pop()
+                    item = item_queue.pop()
+                    unchanged_items = set()
+                    if node_journal is not None and not node_changes:
+                        unchanged_items = node_journal.unchanged
+                    batch = []
+                    if (
+                        not interactive and
+                        item.id not in unchanged_items and
+                        item.ITEM_TYPE_NAME not in ('action', 'dummy') and
+                        not item.triggered and
+                        item.get_batch_key() is not None
+                    ):
+                        # leave enough ready items for the other
+                        # workers to keep them busy
+                        batch = item_queue.batch_with(
+                            item,
+                            _batch_filter(item, exclude=unchanged_items),
+                            limit=(item_queue.ready_count + workers) // workers - 1,
+                        )
 
                     if item.ITEM_TYPE_NAME == 'action':
                         target = item.get_result
+                        args = []
+                        kwargs = {'interactive': interactive}
                     else:
-                        target = item.apply
+                        item_probe_results = {}
+                        if not node_changes and item.ITEM_TYPE_NAME != 'dummy':
+                            for batch_item in [item] + batch:
+                                for path, hash_content in batch_item.get_prefetch_paths():
+                                    if path in probe_results:
+                                        item_probe_results[path] = probe_results.pop(path)
+                        target = _apply_item
+                        args = [item]
+                        kwargs = {
+                            'interactive': interactive,
+                            'node_changes': node_changes,
+                            'probe_results': item_probe_results,
+                        }
+                        if item.id in unchanged_items:
+                            journal_skipped += 1
+                            kwargs['unchanged'] = True
+                        if batch:
+                            batches[item.id] = [item] + batch
+                            target = _apply_batch
+                            args = [batches[item.id]]
+                            del kwargs['interactive']
+
+                    if not interactive and item.id not in unchanged_items:
+                        task_starts[item.id] = time()
 
                     # start_task() increases jobs_open.
                     worker_pool.start_task(
                         msg['wid'],
                         target,
                         task_id=item.id,
-                        kwargs={'interactive': interactive},
+                        args=args,
+                        kwargs=kwargs,
                     )
                 else:
                     if worker_pool.jobs_open > 0:
@@ -110,74 +244,80 @@ def apply_items(node, workers=1, interactive=False):
                 # worker_pool automatically decreases jobs_open when it
                 # sees a 'FINISHED_WORK' message.
 
-                # The task's id is the item we just processed.
-                item_id = msg['task_id']
-                item = find_item(item_id, items)
-
-                status_code = msg['return_value']
-
-                if interactive:
-                    formatted_result = format_item_result(status_code, item_id)
-                    if formatted_result is not None:
-                        print(formatted_result)
-
-                if status_code in (
-                    Item.STATUS_FAILED,
-                    Item.STATUS_SKIPPED,
-                    Item.STATUS_ACTION_FAILED,
-                    Item.STATUS_ACTION_SKIPPED,
-                ) and item.cascade_skip:
-                    # if an item fails or is skipped, all items that depend on
-                    # it shall be removed from the queue
-                    items_with_deps, skipped_items = remove_item_dependents(
-                        items_with_deps,
-                        item.id,
-                    )
-                    # since we removed them from further processing, we
-                    # fake the status of the removed items so they still
-                    # show up in the result statistics
-                    for skipped_item in skipped_items:
-                        if skipped_item.ITEM_TYPE_NAME == 'dummy':
-                            continue
-                        if interactive:
-                            print(format_item_result(skipped_item.STATUS_SKIPPED, skipped_item))
-                        yield (skipped_item.id, skipped_item.STATUS_SKIPPED)
+                # The task's id is the item we just processed (or the
+                # first one of a batch).
+                if msg['task_id'] in batches:
+                    results = zip(batches.pop(msg['task_id']), msg['return_value'])
                 else:
-                    # if an item is applied successfully, all
-                    # dependencies on it can be removed from the
-                    # remaining items
-                    items_with_deps = remove_dep_from_items(
-                        items_with_deps,
-                        item.id,
-                    )
-
-                # now that we removed some deps from items_with_deps, we
-                # again need to look for items that don't have any deps
-                # left and can be processed next
-                items_with_deps, items_without_deps = \
-                    split_items_without_deps(items_with_deps + items_without_deps)
-
-                if status_code in (Item.STATUS_FIXED, Item.STATUS_ACTION_OK) or (
-                    status_code in (Item.STATUS_SKIPPED, Item.STATUS_ACTION_SKIPPED) and
-                    not item.cascade_skip
-                ):
-                    # action succeeded or item was fixed
-                    for triggered_item_id in item.triggers:
-                        triggered_item = find_item(
-                            triggered_item_id,
-                            items_with_deps + items_without_deps,
-                        )
-                        triggered_item.has_been_triggered = True
-
-                if item.ITEM_TYPE_NAME != 'dummy':
-                    yield (item.id, status_code)
+                    results = [(items.find(msg['task_id']), msg['return_value'])]
+
+                if msg['task_id'] in task_starts:
+                    # items in a batch share the duration of the batch
+                    duration = (time() - task_starts.pop(msg['task_id'])) / len(results)
+                    for item, status_code in results:
+                        if item.ITEM_TYPE_NAME != 'dummy':
+                            item_durations[item.id] = duration
+
+                for item, status_code in results:
+                    if status_code not in (
+                        Item.STATUS_OK,
+                        Item.STATUS_SKIPPED,
+                        Item.STATUS_ACTION_SKIPPED,
+                    ):
+                        node_changes += 1
+
+                    if interactive:
+                        formatted_result = format_item_result(status_code, item.id)
+                        if formatted_result is not None:
+                            print(formatted_result)
+
+                    if status_code in (
+                        Item.STATUS_FAILED,
+                        Item.STATUS_SKIPPED,
+                        Item.STATUS_ACTION_FAILED,
+                        Item.STATUS_ACTION_SKIPPED,
+                    ) and item.cascade_skip:
+                        # if an item fails or is skipped, all items that depend on
+                        # it shall be removed from the queue
+                        skipped_items = item_queue.item_failed(item.id)
+                        # since we removed them from further processing, we
+                        # fake the status of the removed items so they still
+                        # show up in the result statistics
+                        for skipped_item in skipped_items:
+                            if skipped_item.ITEM_TYPE_NAME == 'dummy':
+                                continue
+                            if interactive:
+                                print(format_item_result(skipped_item.STATUS_SKIPPED, skipped_item))
+                            status_codes[skipped_item.id] = skipped_item.STATUS_SKIPPED
+                            yield (skipped_item.id, skipped_item.STATUS_SKIPPED)
+                    else:
+                        # if an item is applied successfully, all
+                        # dependencies on it are resolved and the items
+                        # waiting for it might be ready now
+                        item_queue.item_done(item.id)
+
+                    if status_code in (Item.STATUS_FIXED, Item.STATUS_ACTION_OK) or (
+                        status_code in (Item.STATUS_SKIPPED, Item.STATUS_ACTION_SKIPPED) and
+                        not item.cascade_skip
+                    ):
+                        # action succeeded or item was fixed
+                        for triggered_item_id in item.triggers:
+                            triggered_item = items.find(triggered_item_id)
+                            triggered_item.has_been_triggered = True
+
+                    if item.ITEM_TYPE_NAME != 'dummy':
+                        status_codes[item.id] = status_code
+                        yield (item.id, status_code)
 
                 # Finally, we have a new job queue. Thus, tell all idle
                 # workers to ask for work again.
                 worker_pool.activate_idle_workers()
 
+    history.record_items(node.name, item_durations)
+
     # we have no items without deps left and none are processing
     # there must be a loop
+    items_with_deps = item_queue.items_waiting
     if items_with_deps:
         LOG.debug(_(
             "There was a dependency problem. Look at the debug.svg generated "
@@ -191,6 +331,9 @@ def apply_items(node, workers=1, interactive=False):
             )
         )
 
+    if node_journal is not None:
+        node_journal.save(items, status_codes, skipped_any=journal_skipped > 0)
+
 
 def format_item_result(result, item_id):
     if result in (Item.STATUS_ACTION_FAILED, Item.STATUS_FAILED):
@@ -235,18 +378,25 @@ class Node(object):
     def __repr__(self):
         return "<Node '{}'>".format(self.name)
 
-    @cached_property
-    def bundles(self):
-        added_bundles = []
-        found_bundles = []
+    @property
+    def bundle_names(self):
+        """
+        Names of all bundles of this node (from its groups first).
+        """
+        bundle_names = []
         for group in self.groups:
             for bundle_name in group.bundle_names:
-                found_bundles.append(bundle_name)
+                if bundle_name not in bundle_names:
+                    bundle_names.append(bundle_name)
+        for bundle_name in self._bundles:
+            if bundle_name not in bundle_names:
+                bundle_names.append(bundle_name)
+        return bundle_names
 
-        for bundle_name in found_bundles + list(self._bundles):
-            if bundle_name not in added_bundles:
-                added_bundles.append(bundle_name)
-                yield Bundle(self, bundle_name)
+    @cached_property
+    def bundles(self):
+        for bundle_name in self.bundle_names:
+            yield Bundle(self, bundle_name)
 
     @cached_property
     def groups(self):
@@ -282,7 +432,8 @@ class Node(object):
             for item in bundle.items:
                 yield item
 
-    def apply(self, interactive=False, force=False, workers=4):
+    def apply(self, interactive=False, force=False, workers=4, threads=False,
+              agent=False, shell_session=False, journal=False):
         self.repo.hooks.node_apply_start(
             self.repo,
             self,
@@ -291,11 +442,19 @@ class Node(object):
         start = datetime.now()
         worker_count = 1 if interactive else workers
         try:
-            with NodeLock(self, interactive, ignore=force):
+            with NodeLock(
+                self,
+                interactive,
+                ignore=force,
+                agent=agent,
+                shell_session=shell_session,
+            ):
                 item_results = list(apply_items(
                     self,
                     workers=worker_count,
                     interactive=interactive,
+                    journal=journal,
+                    threads=threads,
                 ))
         except NodeAlreadyLockedException as e:
             if not interactive:
@@ -337,10 +496,11 @@ class Node(object):
             pty=pty,
         )
 
-    def test(self, workers=4):
+    def test(self, workers=4, threads=False):
         test_items(
             self.items,
             workers=workers,
+            threads=threads,
         )
 
     def upload(self, local_path, remote_path, mode=None, owner="", group=""):
@@ -353,31 +513,33 @@ class Node(object):
             group=group,
         )
 
-    def verify(self, workers=4):
+    def verify(self, workers=4, threads=False):
         verify_items(
             self.items,
             workers=workers,
+            threads=threads,
         )
 
 
 class NodeLock(object):
-    def __init__(self, node, interactive, ignore=False):
+    def __init__(self, node, interactive, ignore=False, agent=False,
+                 shell_session=False):
+        self.agent = agent
         self.node = node
+        self.shell_session = shell_session
         self.ignore = ignore
         self.interactive = interactive
 
     def __enter__(self):
-        handle, local_path = mkstemp()
-
         result = self.node.run("mkdir " + quote(LOCK_PATH), may_fail=True)
         if result.return_code != 0:
-            self.node.download(LOCK_FILE, local_path, ignore_failure=True)
-            with open(local_path, 'r') as f:
-                try:
-                    info = json.loads(f.read())
-                except:
-                    LOG.warn(_("unable to read or parse lock file contents"))
-                    info = {}
+            lock_file = BytesIO()
+            self.node.download(LOCK_FILE, lock_file, ignore_failure=True)
+            try:
+                info = json.loads(lock_file.getvalue())
+            except:
+                LOG.warn(_("unable to read or parse lock file contents"))
+                info = {}
             if self.ignore or (self.interactive and ask_interactively(
                 self._warning_message(info),
                 False,
@@ -386,27 +548,25 @@ class NodeLock(object):
             else:
                 raise NodeAlreadyLockedException(info)
 
-        with open(local_path, 'w') as f:
-            f.write(json.dumps({
-                'date': time(),
-                'user': getuser(),
-                'host': gethostname(),
-            }))
-        self.node.upload(local_path, LOCK_FILE)
+        self.node.upload(BytesIO(json.dumps({
+            'date': time(),
+            'user': getuser(),
+            'host': gethostname(),
+        }).encode('utf-8')), LOCK_FILE)
+
+        if self.agent:
+            operations.enable_agent(self.node.hostname)
+        elif self.shell_session:
+            operations.enable_shell_session(self.node.hostname)
 
-        # See issue #19. We've just opened an SSH connection to the node,
-        # but before we can fork(), all connections *MUST* be closed!
-        # XXX: Revise this once we're using Fabric 2.0.
-        operations.disconnect_all()
+        # See issue #19. We've just opened an SSH connection to the node
+        # and are about to fork() item workers. We can keep it open for
+        # releasing the lock since operations won't let the workers
+        # touch connections they inherited from us.
 
     def __exit__(self, type, value, traceback):
         result = self.node.run("rm -R {}".format(quote(LOCK_PATH)), may_fail=True)
-
-        # See __enter__(). Most likely we won't fork() again now.
-        # Nevertheless, clean up the state so a future code change won't
-        # cause chaos.
-        # XXX: Revise this once we're using Fabric 2.0.
-        operations.disconnect_all()
+        operations.disable_session(self.node.hostname)
 
         if result.return_code != 0:
             LOG.error(_("Could not release lock for node '{node}'").format(
@@ -438,10 +598,10 @@ class NodeLock(object):
         )
 
 
-def test_items(items, workers=1):
-    items = prepare_dependencies(items)
+def test_items(items, workers=1, threads=False):
+    items = list(prepare_dependencies(items))
 
-    with WorkerPool(workers=workers) as worker_pool:
+    with get_worker_pool(workers=workers, threads=threads) as worker_pool:
         while worker_pool.keep_running():
             msg = worker_pool.get_event()
             if msg['msg'] == 'REQUEST_WORK':
@@ -467,13 +627,20 @@ def test_items(items, workers=1):
                 ))
 
 
-def verify_items(items_with_actions, workers=1):
+def verify_items(items_with_actions, workers=1, threads=False):
     items = []
     for item in items_with_actions:
         if not item.ITEM_TYPE_NAME == 'action':
             items.append(item)
 
-    with WorkerPool(workers=workers) as worker_pool:
+    # Nothing will change on the node while verifying, so we can probe
+    # all paths now and let worker processes inherit the results.
+    if items:
+        node = items[0].node
+        for path, probe_result in _probe_item_paths(node, items).iteritems():
+            prefetch_path_info(node, path, probe_result)
+
+    with get_worker_pool(workers=workers, threads=threads) as worker_pool:
         while worker_pool.keep_running():
             msg = worker_pool.get_event()
             if msg['msg'] == 'REQUEST_WORK':
@@ -1,42 +1,180 @@
-from base64 import b64decode
+from errno import ENOENT
+from io import BytesIO
+from os import getpid
 from pipes import quote
 from stat import S_IRUSR, S_IWUSR
+from threading import Lock
 
-from fabric.api import prefix
 from fabric.api import put as _fabric_put
 from fabric.api import run as _fabric_run
 from fabric.api import sudo as _fabric_sudo
 from fabric.network import disconnect_all as _fabric_disconnect_all
-from fabric.state import env, output
+from fabric.state import connections, env, output
 
-from .exceptions import RemoteException
+from .agent import Agent, AGENT_SCRIPT
+from .exceptions import RemoteException, SessionError
+from .shell import ShellSession
 from .utils import LOG
 from .utils.text import mark_for_translation as _, randstr
 from .utils.ui import LineBuffer
 
 env.use_ssh_config = True
 env.warn_only = True
-# silence fabric
+# Silence Fabric, except for the output of commands. That is only
+# printed to the streams passed to run() and sudo(), which discard it
+# unless the caller asked for it. Toggling the global output settings
+# per command would race between threads (see --item-threads).
 for key in output:
-    output[key] = False
+    output[key] = key in ('stderr', 'stdout')
+
+# PID of the process owning the connections in Fabric's cache
+_CONNECTIONS_PID = getpid()
+# connections inherited from a parent process, see _claim_connections()
+_INHERITED_CONNECTIONS = []
+# callables starting sessions for hosts, see enable_agent() and
+# enable_shell_session()
+_SESSION_FACTORIES = {}
+# sessions started by this process (None if starting one failed)
+_SESSIONS = {}
+_SESSIONS_LOCK = Lock()
+# raised by sessions that can't be used anymore, see _session_failed()
+_SESSION_ERRORS = (EnvironmentError, EOFError, SessionError)
+
+
+def _claim_connections():
+    """
+    Fabric keeps one long-lived connection per host in its connection
+    cache. When a worker process is forked, it inherits that cache
+    including the sockets owned by the parent. Using (or closing) them
+    from the child would break the parent's sessions, so the child
+    sets them aside and lazily opens its own connections, which it
+    will then reuse for every task it runs on the same host.
+    """
+    global _CONNECTIONS_PID
+    pid = getpid()
+    if pid != _CONNECTIONS_PID:
+        # keep references around so they are never garbage collected
+        # (and thus closed) in the child
+        _INHERITED_CONNECTIONS.extend(connections.values())
+        _INHERITED_CONNECTIONS.extend(_SESSIONS.values())
+        connections.clear()
+        _SESSIONS.clear()
+        _CONNECTIONS_PID = pid
+
+
+def _get_session(hostname):
+    """
+    Returns the session (an Agent or ShellSession) for the given host,
+    starting it if necessary, or None if no session should or could be
+    used.
+    """
+    if hostname not in _SESSION_FACTORIES:
+        return None
+    with _SESSIONS_LOCK:
+        if hostname not in _SESSIONS:
+            env.host_string = hostname
+            channel = connections[env.host_string].get_transport().open_session()
+            try:
+                _SESSIONS[hostname] = _SESSION_FACTORIES[hostname](hostname, channel)
+            except (RemoteException, ValueError) as e:
+                LOG.warn(_("unable to start session on {host}: {error}").format(
+                    error=e,
+                    host=hostname,
+                ))
+                channel.close()
+                _SESSIONS[hostname] = None
+        return _SESSIONS[hostname]
 
 
-class FabricOutput(object):
-    def __init__(self, silent=False):
-        self.silent = silent
+def _session_failed(hostname, session, error):
+    """
+    Stops using the given session after it broke down. This process
+    will use Fabric for the host from now on.
+    """
+    LOG.warn(_("session on {host} failed, falling back to SSH: {error}").format(
+        error=error,
+        host=hostname,
+    ))
+    with _SESSIONS_LOCK:
+        if _SESSIONS.get(hostname) is session:
+            _SESSIONS[hostname] = None
+    try:
+        session.close()
+    except _SESSION_ERRORS:
+        pass
+
+
+def _start_agent(hostname, channel):
+    # The script is passed on the command line instead of being
+    # uploaded first, so there is no file anyone could swap out before
+    # root runs it.
+    channel.exec_command("sudo -n -- sh -c {}".format(quote(
+        "exec \"$(command -v python3 || command -v python)\" -c {}".format(
+            quote(AGENT_SCRIPT),
+        )
+    )))
+    return Agent(channel, hostname)
 
-    def __enter__(self):
-        output['stderr'] = not self.silent
-        output['stdout'] = not self.silent
 
-    def __exit__(self, type, value, traceback):
-        output['stderr'] = False
-        output['stdout'] = False
+def _start_shell_session(hostname, channel):
+    channel.exec_command("sudo -n -- sh")
+    return ShellSession(channel, hostname)
+
+
+def disable_session(hostname):
+    """
+    Stops using an agent or shell session for the given host.
+    """
+    _SESSION_FACTORIES.pop(hostname, None)
+    session = _SESSIONS.pop(hostname, None)
+    if session is not None:
+        session.close()
+
+
+def enable_agent(hostname):
+    """
+    Makes this process and worker processes forked from it run
+    commands and transfer in-memory files through an agent on the
+    given host (see blockwart.agent).
+    """
+    _SESSION_FACTORIES[hostname] = _start_agent
+
+
+def enable_shell_session(hostname):
+    """
+    Makes this process and worker processes forked from it run
+    commands through a single root shell on the given host (see
+    blockwart.shell).
+    """
+    _SESSION_FACTORIES[hostname] = _start_shell_session
+
+
+def _sftp_get(hostname, remote_path, local_path):
+    """
+    Transfers a file readable by the login user over SFTP. Raises
+    IOError if it can't be read.
+    """
+    env.host_string = hostname
+    sftp = connections[env.host_string].open_sftp()
+    try:
+        if hasattr(local_path, 'write'):
+            sftp.getfo(remote_path, local_path)
+        else:
+            sftp.get(remote_path, local_path)
+    finally:
+        sftp.close()
 
 
 def download(hostname, remote_path, local_path, ignore_failure=False):
     """
-    Download a file.
+    Download a file. local_path may also be a file-like object.
+
+    The file is transferred over SFTP directly if the login user may
+    read it. Otherwise it is first copied to a temporary file owned by
+    the login user with a single remote command and that copy is
+    transferred instead. Either way, the file is transferred in chunks,
+    so it is never held in memory as a whole (unless you pass an
+    in-memory file-like object).
     """
 
     # See issue #39.
@@ -44,24 +182,76 @@ def download(hostname, remote_path, local_path, ignore_failure=False):
 
     LOG.debug(_("downloading {host}:{path} -> {target}").format(
         host=hostname, path=remote_path, target=local_path))
-    env.host_string = hostname
-    fabric_result = _fabric_sudo(
-        "base64 {}".format(quote(remote_path)),
-        shell=True,
-        pty=False,
-        combine_stderr=False,
-    )
-    if fabric_result.succeeded:
-        with open(local_path, "w") as f:
-            f.write(b64decode(fabric_result.stdout))
-    elif not ignore_failure:
+    _claim_connections()
+
+    session = _get_session(hostname) if hasattr(local_path, 'write') else None
+    if hasattr(session, 'read'):
+        try:
+            local_path.write(session.read(remote_path))
+            return
+        except _SESSION_ERRORS as e:
+            _session_failed(hostname, session, e)
+        except RemoteException:
+            if not ignore_failure:
+                raise
+            return
+
+    try:
+        _sftp_get(hostname, remote_path, local_path)
+        return
+    except IOError as e:
+        if e.errno == ENOENT:
+            # root won't find it either
+            if ignore_failure:
+                return
             raise RemoteException(_(
                 "reading file '{path}' on {host} failed: {error}").format(
-                    error=fabric_result.stderr,
+                    error=e,
                     host=hostname,
                     path=remote_path,
                 )
             )
+        LOG.debug("unable to read {host}:{path} as login user: {error}".format(
+            error=e,
+            host=hostname,
+            path=remote_path,
+        ))
+
+    temp_filename = ".blockwart_tmp_" + randstr()
+
+    copy_result = run(
+        hostname,
+        "cp -- {src} {tmp} && chown \"$SUDO_USER\" {tmp} && chmod 0400 {tmp}".format(
+            src=quote(remote_path),
+            tmp=quote(temp_filename),
+        ),
+        ignore_failure=True,
+    )
+    if copy_result.return_code != 0:
+        run(hostname, "rm -f -- {}".format(quote(temp_filename)), ignore_failure=True)
+        if ignore_failure:
+            return
+        raise RemoteException(_(
+            "reading file '{path}' on {host} failed: {error}").format(
+                error=copy_result.stderr,
+                host=hostname,
+                path=remote_path,
+            )
+        )
+
+    try:
+        _sftp_get(hostname, temp_filename, local_path)
+    except IOError as e:
+        if not ignore_failure:
+            raise RemoteException(_(
+                "download from {host} failed for {path}: {error}").format(
+                    error=e,
+                    host=hostname,
+                    path=remote_path,
+                )
+            )
+    finally:
+        run(hostname, "rm -f -- {}".format(quote(temp_filename)), ignore_failure=True)
 
 
 class RunResult(object):
@@ -76,8 +266,9 @@ class RunResult(object):
 
 def disconnect_all():
     """
-    Close all open connections.
+    Close all open connections owned by this process.
     """
+    _claim_connections()
     _fabric_disconnect_all()
 
 
@@ -86,10 +277,9 @@ def run(hostname, command, ignore_failure=False, stderr=None,
     """
     Runs a command on a remote system.
     """
+    _claim_connections()
     env.host_string = hostname
 
-    silent_fabric = stderr is None and stdout is None
-
     if stderr is None:
         stderr = LineBuffer(lambda s: None)
     if stdout is None:
@@ -97,45 +287,105 @@ def run(hostname, command, ignore_failure=False, stderr=None,
 
     LOG.debug("running on {host}: {command}".format(command=command, host=hostname))
 
-    runner = _fabric_sudo if sudo else _fabric_run
-
-    with FabricOutput(silent=silent_fabric):
-        with prefix("export LANG=C"):
-            fabric_result = runner(
+    session = _get_session(hostname) if sudo else None
+    if session is not None:
+        try:
+            return_code, stdout_data, stderr_data = session.run(command)
+        except _SESSION_ERRORS as e:
+            _session_failed(hostname, session, e)
+        else:
+            stdout.write(stdout_data)
+            stderr.write(stderr_data)
+            return _run_result(
+                hostname,
                 command,
-                shell=True,
-                pty=pty,
-                combine_stderr=False,
-                stdout=stdout,
-                stderr=stderr,
+                return_code,
+                stdout_data.strip(),
+                stderr_data.strip(),
+                ignore_failure,
             )
 
-    LOG.debug("command finished with return code {}".format(fabric_result.return_code))
+    runner = _fabric_sudo if sudo else _fabric_run
+
+    # not using fabric.api.prefix() here since it modifies global
+    # state that might be shared with other threads
+    fabric_result = runner(
+        "export LANG=C && " + command,
+        shell=True,
+        pty=pty,
+        combine_stderr=False,
+        stdout=stdout,
+        stderr=stderr,
+    )
+
+    return _run_result(
+        hostname,
+        command,
+        fabric_result.return_code,
+        str(fabric_result),
+        fabric_result.stderr,
+        ignore_failure,
+    )
+
+
+def _run_result(hostname, command, return_code, stdout, stderr, ignore_failure):
+    LOG.debug("command finished with return code {}".format(return_code))
 
-    if not fabric_result.succeeded and not ignore_failure:
+    if return_code != 0 and not ignore_failure:
         raise RemoteException(_(
             "Non-zero return code ({rcode}) running '{command}' on '{host}':\n\n{result}"
         ).format(
             command=command,
             host=hostname,
-            rcode=fabric_result.return_code,
-            result=str(fabric_result) + fabric_result.stderr,
+            rcode=return_code,
+            result=stdout + stderr,
         ))
 
     result = RunResult()
-    result.stdout = str(fabric_result)
-    result.stderr = fabric_result.stderr
-    result.return_code = fabric_result.return_code
+    result.stdout = stdout
+    result.stderr = stderr
+    result.return_code = return_code
     return result
 
 
 def upload(hostname, local_path, remote_path, mode=None, owner="",
            group="", ignore_failure=False):
     """
-    Upload a file.
+    Upload a file. local_path may also be a file-like object, which
+    will be streamed to the node without touching the local disk.
+
+    The file is written to a temporary location first and then moved
+    into place, setting ownership and mode along the way, with a single
+    remote command.
     """
+    if hasattr(local_path, 'read'):
+        source = _("<blockwart content>")
+    else:
+        source = local_path
     LOG.debug(_("uploading {path} -> {host}:{target}").format(
-        host=hostname, path=local_path, target=remote_path))
+        host=hostname, path=source, target=remote_path))
+    _claim_connections()
+
+    session = _get_session(hostname) if hasattr(local_path, 'read') else None
+    if hasattr(session, 'write'):
+        content = local_path.read()
+        try:
+            session.write(
+                remote_path,
+                content,
+                mode=mode,
+                owner=owner,
+                group=group,
+            )
+            return
+        except _SESSION_ERRORS as e:
+            _session_failed(hostname, session, e)
+            local_path = BytesIO(content)
+        except RemoteException:
+            if not ignore_failure:
+                raise
+            return
+
     env.host_string = hostname
     temp_filename = ".blockwart_tmp_" + randstr()
 
@@ -153,29 +403,20 @@ def upload(hostname, local_path, remote_path, mode=None, owner="",
             )
         )
 
+    commands = []
     if owner or group:
-        run(
-            hostname,
-            "chown {}:{} {}".format(
-                quote(owner),
-                quote(group),
-                quote(temp_filename),
-            ),
-        )
-
+        commands.append("chown {}:{} {}".format(
+            quote(owner),
+            quote(group),
+            quote(temp_filename),
+        ))
     if mode:
-        run(
-            hostname,
-            "chmod {} {}".format(
-                mode,
-                quote(temp_filename),
-            ),
-        )
-
-    run(
-        hostname,
-        "mv -f {} {}".format(
+        commands.append("chmod {} {}".format(
+            mode,
             quote(temp_filename),
-            quote(remote_path),
-        ),
-    )
+        ))
+    commands.append("mv -f {} {}".format(
+        quote(temp_filename),
+        quote(remote_path),
+    ))
+    run(hostname, " && ".join(commands))
@@ -1,6 +1,8 @@
+from collections import defaultdict
 from imp import load_source
 from os import listdir, mkdir
 from os.path import isdir, isfile, join
+import re
 
 from . import items
 from .exceptions import NoSuchGroup, NoSuchNode, NoSuchRepository, RepositoryError
@@ -236,8 +238,9 @@ class Repository(object):
 
         self.bundle_names = []
         self.group_dict = {}
-        self.item_classes = []
         self.node_dict = {}
+        self._item_classes = None
+        self._clear_membership()
 
         if repo_path is not None:
             self.populate_from_path(repo_path)
@@ -245,15 +248,16 @@ class Repository(object):
     def __getstate__(self):
         """
         Removes cached item classes prior to pickling because they are loaded
-        dynamically and can't be pickled.
+        dynamically and can't be pickled. They will be loaded again on
+        first use.
         """
-        self.item_classes = []
-        return self.__dict__
-
-    def __setstate__(self, dict):
-        self.__dict__ = dict
-        for item_class in items_from_path(self.items_dir):
-            self.item_classes.append(item_class)
+        state = self.__dict__.copy()
+        state['_item_classes'] = None
+        # cheap to rebuild and potentially huge
+        state['_bundle_members'] = None
+        state['_group_members'] = None
+        state['_node_groups'] = None
+        return state
 
     def __repr__(self):
         return "<Repository at '{}'>".format(self.path)
@@ -275,27 +279,29 @@ class Repository(object):
         """
         Adds the given group object to this repo.
         """
-        if group.name in utils.names(self.nodes):
+        if group.name in self.node_dict:
             raise RepositoryError(_("you cannot have a node and a group "
                                     "both named '{}'").format(group.name))
-        if group.name in utils.names(self.groups):
+        if group.name in self.group_dict:
             raise RepositoryError(_("you cannot have two groups "
                                     "both named '{}'").format(group.name))
         group.repo = self
         self.group_dict[group.name] = group
+        self._clear_membership()
 
     def add_node(self, node):
         """
         Adds the given node object to this repo.
         """
-        if node.name in utils.names(self.groups):
+        if node.name in self.group_dict:
             raise RepositoryError(_("you cannot have a node and a group "
                                     "both named '{}'").format(node.name))
-        if node.name in utils.names(self.nodes):
+        if node.name in self.node_dict:
             raise RepositoryError(_("you cannot have two nodes "
                                     "both named '{}'").format(node.name))
         node.repo = self
         self.node_dict[node.name] = node
+        self._clear_membership()
 
     @classmethod
     def create(cls, path):
@@ -347,9 +353,19 @@ class Repository(object):
         return result
 
     def groups_for_node(self, node):
-        for group in self.groups:
-            if node in group.nodes:
-                yield group
+        self._build_membership()
+        for group_name in sorted(self._node_groups[node.name]):
+            yield self.group_dict[group_name]
+
+    @property
+    def item_classes(self):
+        """
+        All item classes shipping with blockwart and those from the
+        repo's items dir, imported on first use.
+        """
+        if self._item_classes is None:
+            self._item_classes = list(items_from_path(self.items_dir))
+        return self._item_classes
 
     @property
     def nodes(self):
@@ -357,6 +373,33 @@ class Repository(object):
         result.sort()
         return result
 
+    def nodes_in_group(self, group_name):
+        """
+        Returns a sorted list of all nodes in the given group (including
+        its subgroups).
+        """
+        self.get_group(group_name)  # raise NoSuchGroup if necessary
+        self._build_membership()
+        return sorted([
+            self.node_dict[node_name]
+            for node_name in self._group_members[group_name]
+        ])
+
+    def nodes_with_bundle(self, bundle_name):
+        """
+        Returns a sorted list of all nodes that have the given bundle.
+        """
+        if self._bundle_members is None:
+            bundle_members = defaultdict(set)
+            for node in self.node_dict.values():
+                for node_bundle_name in node.bundle_names:
+                    bundle_members[node_bundle_name].add(node.name)
+            self._bundle_members = bundle_members
+        return sorted([
+            self.node_dict[node_name]
+            for node_name in self._bundle_members.get(bundle_name, ())
+        ])
+
     def populate_from_path(self, path):
         if not self.is_repo(path):
             raise NoSuchRepository(
@@ -377,10 +420,8 @@ class Repository(object):
         for group in groups_from_file(self.groups_file):
             self.add_group(group)
 
-        # populate items
-        self.item_classes = []
-        for item_class in items_from_path(self.items_dir):
-            self.item_classes.append(item_class)
+        # item classes will be imported once they are needed
+        self._item_classes = None
 
         # populate nodes
         self.node_dict = {}
@@ -391,6 +432,47 @@ class Repository(object):
     def revision(self):
         return get_rev()
 
+    def _build_membership(self):
+        """
+        Resolves static members, member patterns and subgroups of all
+        groups at once and indexes the result in both directions.
+        """
+        if self._group_members is not None:
+            return
+
+        direct_members = {}
+        patterns = []
+        for group in self.group_dict.values():
+            direct_members[group.name] = set([
+                self.get_node(node_name).name
+                for node_name in group.static_member_names
+            ])
+            for pattern in group.patterns:
+                patterns.append((group.name, re.compile(pattern)))
+
+        for node_name in self.node_dict:
+            for group_name, compiled_pattern in patterns:
+                if compiled_pattern.search(node_name) is not None:
+                    direct_members[group_name].add(node_name)
+
+        group_members = {}
+        node_groups = defaultdict(set)
+        for group in self.group_dict.values():
+            members = set(direct_members[group.name])
+            for subgroup in group.subgroups:
+                members.update(direct_members[subgroup.name])
+            group_members[group.name] = members
+            for node_name in members:
+                node_groups[node_name].add(group.name)
+
+        self._group_members = group_members
+        self._node_groups = node_groups
+
+    def _clear_membership(self):
+        self._bundle_members = None
+        self._group_members = None
+        self._node_groups = None
+
     def _set_path(self, path):
         self.path = path
         self.bundles_dir = join(self.path, DIRNAME_BUNDLES)
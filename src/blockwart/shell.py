@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from pipes import quote
+from threading import Lock
+
+from .exceptions import RemoteException, SessionError
+from .utils.text import mark_for_translation as _, randstr
+
+SESSION_SETUP = (
+    "export LANG=C\n"
+    "if [ -x /bin/bash ]; then BW_SHELL=/bin/bash; else BW_SHELL=/bin/sh; fi\n"
+    "printf '%s:ready\\n' {marker}\n"
+)
+
+# Output of commands is collected in temporary files on the node and
+# then sent after a header line giving the return code and the length
+# of stdout and stderr. That way both can be told apart on a single
+# stream and neither of them can be confused with the header.
+SESSION_COMMAND = (
+    "if bw_out=$(mktemp) && bw_err=$(mktemp); then "
+    "$BW_SHELL -c {command} >\"$bw_out\" 2>\"$bw_err\" </dev/null; "
+    "printf '%s:%d:%d:%d\\n' {marker} $? $(wc -c <\"$bw_out\") $(wc -c <\"$bw_err\"); "
+    "cat \"$bw_out\" \"$bw_err\"; "
+    "rm -f \"$bw_out\" \"$bw_err\"; "
+    "else printf '%s:error\\n' {marker}; fi\n"
+)
+
+
+class ShellSession(object):
+    """
+    Runs commands through a single long-running shell on the node,
+    which is read from and written to through a channel (anything with
+    sendall() and recv() methods, usually a Paramiko channel running
+    'sudo sh'). Commands are serialized, so a single session can be
+    shared by multiple threads.
+    """
+    def __init__(self, channel, name):
+        self.buffer = b""
+        self.channel = channel
+        self.lock = Lock()
+        self.marker = "BLOCKWART_" + randstr()
+        self.name = name
+        self.channel.sendall(SESSION_SETUP.format(marker=self.marker).encode('utf-8'))
+        if self._recv_line() != "{}:ready".format(self.marker):
+            raise RemoteException(_("unexpected output from shell on {}").format(self.name))
+
+    def _recv(self):
+        chunk = self.channel.recv(65536)
+        if not chunk:
+            raise SessionError(_("lost connection to shell on {}").format(self.name))
+        self.buffer += chunk
+
+    def _recv_exactly(self, length):
+        while len(self.buffer) < length:
+            self._recv()
+        data, self.buffer = self.buffer[:length], self.buffer[length:]
+        return data
+
+    def _recv_line(self):
+        while b"\n" not in self.buffer:
+            self._recv()
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line.decode('utf-8', 'replace')
+
+    def close(self):
+        self.channel.close()
+
+    def run(self, command):
+        """
+        Returns return code, stdout and stderr of the given shell
+        command.
+        """
+        if isinstance(command, bytes):
+            command = command.decode('utf-8')
+        with self.lock:
+            self.channel.sendall(SESSION_COMMAND.format(
+                command=quote(command),
+                marker=self.marker,
+            ).encode('utf-8'))
+            header = self._recv_line().split(":")
+            if header[0] != self.marker or len(header) != 4:
+                raise SessionError(_(
+                    "unable to run '{command}' in shell on {node}"
+                ).format(command=command, node=self.name))
+            return_code, stdout_length, stderr_length = [int(value) for value in header[1:]]
+            stdout = self._recv_exactly(stdout_length)
+            stderr = self._recv_exactly(stderr_length)
+        return return_code, stdout, stderr
@@ -1,9 +1,15 @@
 import cProfile
 import hashlib
+from imp import get_magic
 from inspect import isgenerator
 import logging
+import marshal
+from os import environ, fdopen, makedirs, remove, rename
+from os.path import dirname, isdir, join
 import pstats
+from tempfile import mkstemp
 
+__COMPILE_CACHE = {}
 __GETATTR_CACHE = {}
 __GETATTR_NODEFAULT = "very_unlikely_default_value"
 
@@ -53,22 +59,90 @@ def get_file_contents(path):
     return content
 
 
+def _load_code_cache(path, source):
+    """
+    Returns the code object for the given source file from the on-disk
+    cache in $BWCODECACHE (or None) and the path it should be cached at.
+    """
+    cache_dir = environ.get("BWCODECACHE")
+    if not cache_dir:
+        return None, None
+    cache_path = join(cache_dir, sha1("{}:{}".format(path, sha1(source))))
+    try:
+        with open(cache_path, 'rb') as f:
+            if f.read(len(get_magic())) == get_magic():
+                return marshal.load(f), cache_path
+    except (EOFError, IOError, TypeError, ValueError):
+        pass
+    return None, cache_path
+
+
+def _write_code_cache(cache_path, code):
+    """
+    Atomically writes the given code object to cache_path, so other
+    processes reading the cache never see half-written files.
+    """
+    if not isdir(dirname(cache_path)):
+        try:
+            makedirs(dirname(cache_path))
+        except OSError:
+            # might have been created by another process just now
+            if not isdir(dirname(cache_path)):
+                raise
+    handle, tmp_path = mkstemp(dir=dirname(cache_path), prefix=".tmp_")
+    try:
+        with fdopen(handle, 'wb') as f:
+            f.write(get_magic())
+            marshal.dump(code, f)
+        rename(tmp_path, cache_path)
+    except:
+        remove(tmp_path)
+        raise
+
+
+def compile_file(path, cache_read=True, cache_write=True):
+    """
+    Returns a code object for the given source file. Files are only
+    compiled once per process and, if $BWCODECACHE points to a
+    directory, once per version of the file. Cached code is keyed by
+    the path and a hash of the content of the file.
+    """
+    if path in __COMPILE_CACHE and cache_read:
+        return __COMPILE_CACHE[path]
+
+    source = get_file_contents(path)
+    code = None
+    cache_path = None
+    if cache_read:
+        code, cache_path = _load_code_cache(path, source)
+    if code is None:
+        code = compile(source, path, 'exec')
+        if cache_write and cache_path is not None:
+            try:
+                _write_code_cache(cache_path, code)
+            except (IOError, OSError):
+                LOG.debug("unable to write code cache for {}".format(path))
+    if cache_write:
+        __COMPILE_CACHE[path] = code
+    return code
+
+
 def get_all_attrs_from_file(path, cache_read=True, cache_write=True,
                             base_env=None):
     """
     Reads all 'attributes' (if it were a module) from a source
     file.
+
+    If base_env is given, the file is executed again on every call
+    because the result depends on base_env (only compiling it is
+    cached).
     """
-    if base_env is None:
-        base_env = {}
-    if path not in __GETATTR_CACHE or not cache_read:
-        source = get_file_contents(path)
-        env = base_env.copy()
-        exec(source, env)
-        if cache_write:
-            __GETATTR_CACHE[path] = env
-    else:
-        env = __GETATTR_CACHE[path]
+    if base_env is None and path in __GETATTR_CACHE and cache_read:
+        return __GETATTR_CACHE[path]
+    env = {} if base_env is None else base_env.copy()
+    exec(compile_file(path, cache_read=cache_read, cache_write=cache_write), env)
+    if base_env is None and cache_write:
+        __GETATTR_CACHE[path] = env
     return env
 
 
@@ -1,5 +1,4 @@
 from ..exceptions import NoSuchNode, NoSuchGroup, UsageException
-from . import names
 from .text import mark_for_translation as _
 
 
@@ -17,18 +16,21 @@ def get_target_nodes(repo, target_string):
         name = name.strip()
         if name.startswith("bundle:"):
             bundle_name = name.split(":", 1)[1]
-            for node in repo.nodes:
-                if bundle_name in names(node.bundles):
-                    targets.append(node)
+            targets += repo.nodes_with_bundle(bundle_name)
         elif name.startswith("!bundle:"):
             bundle_name = name.split(":", 1)[1]
+            excluded = set(repo.nodes_with_bundle(bundle_name))
             for node in repo.nodes:
-                if bundle_name not in names(node.bundles):
+                if node not in excluded:
                     targets.append(node)
         elif name.startswith("!group:"):
             group_name = name.split(":", 1)[1]
+            try:
+                excluded = set(repo.nodes_in_group(group_name))
+            except NoSuchGroup:
+                excluded = set()
             for node in repo.nodes:
-                if group_name not in names(node.groups):
+                if node not in excluded:
                     targets.append(node)
         else:
             try:
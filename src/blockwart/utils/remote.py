@@ -1,8 +1,67 @@
 from pipes import quote
+from threading import local
 
 from . import cached_property, LOG
 from .text import mark_for_translation as _
 
+# number of paths probed by a single command in probe_paths()
+PROBE_BATCH_SIZE = 256
+
+# maps (node name, path) to probe results that will be used by the
+# next PathInfo for that path
+_PREFETCHED = {}
+
+# Prints five NUL-terminated fields for every path: the path itself,
+# the return code and output of 'file', the output of 'stat' and
+# (if requested by the second positional parameter) the SHA1 hash.
+_PROBE_SCRIPT = (
+    "while [ $# -gt 0 ]; do "
+    "printf '%s\\0' \"$1\"; "
+    "desc=$(file -bh -- \"$1\"); "
+    "printf '%s\\0%s\\0' \"$?\" \"$desc\"; "
+    "stat --printf '%U:%G:%a:%s' -- \"$1\" 2>/dev/null; "
+    "printf '\\0'; "
+    "if [ \"$2\" = 1 ] && [ -f \"$1\" ]; then sha1sum -- \"$1\"; fi; "
+    "printf '\\0'; "
+    "shift 2; "
+    "done"
+)
+
+
+class _NodeCaches(local):
+    """
+    Maps node names to [generation, cache dict], see node_cache().
+    Every worker thread gets its own, just like worker processes do, so
+    items never see what an item in another thread is in the middle of
+    changing.
+    """
+    def __init__(self):
+        self.caches = {}
+
+
+_NODE_CACHES = _NodeCaches()
+
+
+def expire_node_cache(node, generation=None):
+    """
+    Clears the cache returned by node_cache() unless it was filled
+    during the given generation. Generations are counted up by
+    apply_items() whenever an item has changed something on the node.
+    """
+    cached_generation = _NODE_CACHES.caches.get(node.name, [None])[0]
+    if generation is None or generation != cached_generation:
+        _NODE_CACHES.caches[node.name] = [generation, {}]
+
+
+def node_cache(node):
+    """
+    Returns a dictionary items can use to cache information about the
+    given node (e.g. installed packages) within the current process (or
+    thread). Whoever changes the cached state on the node must remove
+    the affected key once the change is done.
+    """
+    return _NODE_CACHES.caches.setdefault(node.name, [None, {}])[1]
+
 
 def _parse_file_output(file_output):
     if file_output.startswith("cannot open `"):
@@ -33,16 +92,94 @@ def get_path_type(node, path):
     return _parse_file_output(file_output)
 
 
-def stat(node, path):
-    result = node.run("stat --printf '%U:%G:%a:%s' -- {}".format(quote(path)))
-    owner, group, mode, size = result.stdout.split(":")
+def _parse_stat_output(stat_output):
+    owner, group, mode, size = stat_output.split(":")
     mode = mode.zfill(4)
-    file_stat = {
+    return {
         'owner': owner,
         'group': group,
         'mode': mode,
         'size': int(size),
     }
+
+
+def prefetch_path_info(node, path, probe_result):
+    """
+    Makes the next PathInfo for the given path use the given result
+    from probe_paths() instead of querying the node.
+    """
+    _PREFETCHED[(node.name, path)] = probe_result
+
+
+def probe_paths(node, paths, hash_paths=()):
+    """
+    Collects everything PathInfo needs to know about the given paths
+    using one command per PROBE_BATCH_SIZE paths. SHA1 hashes are only
+    computed for regular files in hash_paths.
+
+    Returns a dict mapping paths to results that can be passed to
+    prefetch_path_info().
+    """
+    hash_paths = set(hash_paths)
+    paths = list(paths)
+    results = {}
+    for batch_start in range(0, len(paths), PROBE_BATCH_SIZE):
+        args = []
+        for path in paths[batch_start:batch_start + PROBE_BATCH_SIZE]:
+            args.append(quote(path))
+            args.append("1" if path in hash_paths else "0")
+        result = node.run(
+            "set -- {}; {}".format(" ".join(args), _PROBE_SCRIPT),
+        )
+        fields = result.stdout.split("\0")
+        for i in range(0, len(fields) - 4, 5):
+            path, file_rcode, file_output, stat_output, sha1_output = \
+                fields[i:i + 5]
+            if file_rcode != "0":
+                path_type, desc = ('nonexistent', "")
+            else:
+                path_type, desc = _parse_file_output(file_output.strip())
+            if path_type == 'nonexistent':
+                file_stat = {}
+            elif stat_output:
+                file_stat = _parse_stat_output(stat_output)
+            else:
+                # let PathInfo figure this one out by itself
+                continue
+            sha1 = sha1_output.strip().split()[0] if sha1_output.strip() else None
+            results[path] = (path_type, desc, file_stat, sha1)
+    LOG.debug(_("probed {count} paths on {node}").format(
+        count=len(results),
+        node=node.name,
+    ))
+    return results
+
+
+def stat_paths(node, paths):
+    """
+    Returns a dict mapping each of the given paths to a string that
+    changes whenever the path is replaced, written to, chmod'ed or
+    chown'ed (inode, size, mtime and ctime) or None if the path does
+    not exist. Uses one command per PROBE_BATCH_SIZE paths.
+    """
+    paths = list(paths)
+    results = dict.fromkeys(paths)
+    for batch_start in range(0, len(paths), PROBE_BATCH_SIZE):
+        result = node.run(
+            "stat --printf '%n\\0%i:%s:%y:%z\\0' -- {} 2>/dev/null".format(" ".join([
+                quote(path) for path in paths[batch_start:batch_start + PROBE_BATCH_SIZE]
+            ])),
+            may_fail=True,
+        )
+        fields = result.stdout.split("\0")
+        for i in range(0, len(fields) - 1, 2):
+            results[fields[i]] = fields[i + 1]
+    return results
+
+
+def stat(node, path):
+    result = node.run("stat --printf '%U:%G:%a:%s' -- {}".format(quote(path)))
+    file_stat = _parse_stat_output(result.stdout)
     LOG.debug(_("stat for '{path}' on {node}: {result}".format(
         node=node.name,
         path=path,
@@ -58,8 +195,14 @@ class PathInfo(object):
     def __init__(self, node, path):
         self.node = node
         self.path = path
-        self.path_type, self.desc = get_path_type(node, path)
-        self.stat = stat(node, path) if self.path_type != 'nonexistent' else {}
+        prefetched = _PREFETCHED.pop((node.name, path), None)
+        if prefetched is None:
+            self.path_type, self.desc = get_path_type(node, path)
+            self.stat = stat(node, path) if self.path_type != 'nonexistent' else {}
+        else:
+            self.path_type, self.desc, self.stat, sha1 = prefetched
+            if sha1 is not None:
+                self._cache = {'sha1': sha1}
 
     def __repr__(self):
         return "<PathInfo for {}:{}>".format(self.node.name, quote(self.path))
@@ -0,0 +1,70 @@
+from os import stat
+from os.path import exists, join
+from shutil import rmtree
+from subprocess import PIPE, Popen
+from sys import executable
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from blockwart.agent import Agent, AGENT_SCRIPT
+from blockwart.exceptions import RemoteException
+
+
+class PipeChannel(object):
+    """
+    Provides the parts of Paramiko's channel API used by Agent for a
+    local process.
+    """
+    def __init__(self, process):
+        self.process = process
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+    def recv(self, length):
+        return self.process.stdout.read(length)
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+
+class AgentTest(TestCase):
+    """
+    Tests blockwart.agent.Agent against a local instance of the agent
+    script.
+    """
+    def setUp(self):
+        self.agent = Agent(
+            PipeChannel(Popen([executable, "-c", AGENT_SCRIPT], stdin=PIPE, stdout=PIPE)),
+            "localhost",
+        )
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        self.agent.close()
+        rmtree(self.tmpdir)
+
+    def test_error(self):
+        with self.assertRaises(RemoteException):
+            self.agent.read(join(self.tmpdir, "missing"))
+        # agent must still be usable after an error
+        self.assertEqual(self.agent.run("true")[0], 0)
+
+    def test_read_write(self):
+        path = join(self.tmpdir, "foo")
+        self.agent.write(path, b"47\x00\n", mode="0640")
+        self.assertEqual(self.agent.read(path), b"47\x00\n")
+        self.assertEqual(stat(path).st_mode & 0o777, 0o640)
+
+    def test_run(self):
+        self.assertEqual(
+            self.agent.run("echo $LANG; echo err >&2; exit 3"),
+            (3, b"C\n", b"err\n"),
+        )
+
+    def test_write_failure(self):
+        with self.assertRaises(RemoteException):
+            self.agent.write(join(self.tmpdir, "foo"), b"", owner="no_such_user_47")
+        self.assertFalse(exists(join(self.tmpdir, "foo")))
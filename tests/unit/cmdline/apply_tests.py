@@ -1,16 +1,18 @@
 from datetime import datetime
 from unittest import TestCase
 
-from mock import MagicMock
+from mock import MagicMock, patch
 
 from blockwart.cmdline.apply import bw_apply, format_node_result
+from blockwart.items import Item
 from blockwart.node import ApplyResult
 
 
 class FakeNode(object):
     name = "nodename"
 
-    def apply(self, interactive=False, workers=4, force=False):
+    def apply(self, interactive=False, workers=4, force=False, threads=False,
+              agent=False, shell_session=False, journal=False):
         assert interactive
         result = ApplyResult(self, ())
         result.start = datetime(2013, 8, 10, 0, 0)
@@ -18,17 +20,47 @@ class FakeNode(object):
         return result
 
 
+class TimedNode(object):
+    def __init__(self, name):
+        self.name = name
+
+    def apply(self, **kwargs):
+        result = ApplyResult(self, [("type1:name1", Item.STATUS_OK)])
+        result.start = datetime(2013, 8, 10, 0, 0)
+        result.end = datetime(2013, 8, 10, 0, 1)
+        return result
+
+
+def get_args(interactive):
+    args = MagicMock()
+    args.agent = False
+    args.force = False
+    args.interactive = interactive
+    args.journal = False
+    args.item_threads = False
+    args.shell_session = False
+    args.item_workers = 4
+    args.node_workers = 2
+    args.target = "node1"
+    return args
+
+
 class ApplyTest(TestCase):
     """
     Tests blockwart.cmdline.apply.bw_apply.
     """
-    def test_interactive(self):
+    @patch('blockwart.cmdline.apply.DurationHistory')
+    def test_interactive(self, DurationHistory):
         node1 = FakeNode()
         repo = MagicMock()
         repo.get_node.return_value = node1
         args = MagicMock()
+        args.agent = False
         args.force = False
         args.interactive = True
+        args.journal = False
+        args.item_threads = False
+        args.shell_session = False
         args.item_workers = 4
         args.target = "node1"
         output = list(bw_apply(repo, args))
@@ -36,6 +68,34 @@ class ApplyTest(TestCase):
         self.assertTrue(output[1].startswith("nodename: run completed after "))
         self.assertTrue(output[1].endswith("(0 OK, 0 fixed, 0 skipped, 0 failed)\n"))
         self.assertEqual(len(output), 2)
+        DurationHistory.return_value.record_nodes.assert_called_once_with({})
+
+    @patch('blockwart.cmdline.apply.get_target_nodes')
+    @patch('blockwart.cmdline.apply.DurationHistory')
+    def test_slowest_first(self, DurationHistory, get_target_nodes):
+        get_target_nodes.return_value = [
+            TimedNode("fast"),
+            TimedNode("new"),
+            TimedNode("slow"),
+        ]
+        DurationHistory.return_value.node_estimates.return_value = {
+            'fast': 10,
+            'slow': 100,
+        }
+        output = list(bw_apply(MagicMock(), get_args(True)))
+        self.assertTrue(output[0].startswith("new: run started at "))
+        self.assertTrue(output[2].startswith("slow: run started at "))
+        self.assertTrue(output[4].startswith("fast: run started at "))
+
+    @patch('blockwart.cmdline.apply.get_target_nodes')
+    @patch('blockwart.cmdline.apply.DurationHistory')
+    def test_history(self, DurationHistory, get_target_nodes):
+        get_target_nodes.return_value = [TimedNode("node1"), TimedNode("node2")]
+        DurationHistory.return_value.node_estimates.return_value = {}
+        list(bw_apply(MagicMock(), get_args(False)))
+        DurationHistory.return_value.record_nodes.assert_called_once_with(
+            {'node1': 60, 'node2': 60},
+        )
 
 
 class FormatNodeItemResultTest(TestCase):
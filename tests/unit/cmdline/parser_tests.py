@@ -0,0 +1,18 @@
+from unittest import TestCase
+
+from mock import patch
+
+from blockwart.cmdline.parser import build_parser_bw
+
+
+class ParserTest(TestCase):
+    """
+    Tests blockwart.cmdline.parser.build_parser_bw.
+    """
+    def test_sessions_exclusive(self):
+        parser = build_parser_bw()
+        args = parser.parse_args(["apply", "--agent", "node1"])
+        self.assertTrue(args.agent)
+        self.assertFalse(args.shell_session)
+        with patch('sys.stderr'), self.assertRaises(SystemExit):
+            parser.parse_args(["apply", "--agent", "--shell-session", "node1"])
@@ -161,14 +161,14 @@ class PlotTest(TestCase):
 class FakeNode(object):
     name = "nodename"
 
-    def test(self, workers=4):
+    def test(self, workers=4, threads=False):
         return
 
 
 class FailNode(object):
     name = "nodename"
 
-    def test(self, workers=4):
+    def test(self, workers=4, threads=False):
         raise RuntimeError("I accidentally")
 
 
@@ -181,6 +181,7 @@ class TestTest(TestCase):
         repo_obj = MagicMock()
         repo_obj.nodes = (node1,)
         args = MagicMock()
+        args.item_threads = False
         args.item_workers = 4
         args.node_workers = 1
         args.target = None
@@ -192,6 +193,7 @@ class TestTest(TestCase):
         repo_obj = MagicMock()
         repo_obj.get_node.return_value = node1
         args = MagicMock()
+        args.item_threads = False
         args.item_workers = 4
         args.node_workers = 1
         args.target = "node1"
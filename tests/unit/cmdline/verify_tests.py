@@ -8,7 +8,7 @@ from blockwart.cmdline import verify
 class FakeNode(object):
     name = "nodename"
 
-    def verify(self, workers=4):
+    def verify(self, workers=4, threads=False):
         return ()
 
 
@@ -21,6 +21,7 @@ class ApplyTest(TestCase):
         repo = MagicMock()
         repo.get_node.return_value = node1
         args = MagicMock()
+        args.item_threads = False
         args.item_workers = 4
         args.target = "node1"
         verify.bw_verify(repo, args)
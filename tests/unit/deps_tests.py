@@ -3,8 +3,9 @@ from unittest import TestCase
 from mock import MagicMock
 
 from blockwart import deps
-from blockwart.exceptions import BundleError
+from blockwart.exceptions import BundleError, ItemDependencyError
 from blockwart.items import Item
+from blockwart.items.pkg_apt import AptPkg
 
 
 class MockItem(Item):
@@ -20,6 +21,49 @@ class MockItem(Item):
         }
 
 
+class DependencyGraphTest(TestCase):
+    """
+    Tests blockwart.deps.DependencyGraph.
+    """
+    def test_edges(self):
+        bundle = MagicMock()
+        item1 = MockItem(bundle, "name1", {}, skip_validation=True)
+        item2 = MockItem(bundle, "name2", {}, skip_validation=True)
+        item1._deps = []
+        item2._deps = ["mock:name1"]
+        graph = deps.DependencyGraph([item1, item2]).build_edges()
+        self.assertEqual(graph.deps["mock:name2"], set(["mock:name1"]))
+        self.assertEqual(graph.dependents["mock:name1"], set(["mock:name2"]))
+        self.assertEqual(graph.dependents["mock:name2"], set())
+
+    def test_duplicate(self):
+        bundle = MagicMock()
+        item1 = MockItem(bundle, "name1", {}, skip_validation=True)
+        item2 = MockItem(bundle, "name1", {}, skip_validation=True)
+        with self.assertRaises(BundleError):
+            deps.DependencyGraph([item1, item2])
+
+    def test_find(self):
+        item = MockItem(MagicMock(), "name1", {}, skip_validation=True)
+        graph = deps.DependencyGraph([item])
+        self.assertEqual(graph.find("mock:name1"), item)
+        with self.assertRaises(ValueError):
+            graph.find("mock:name2")
+
+    def test_of_types(self):
+        bundle = MagicMock()
+        item1 = MockItem(bundle, "name1", {}, skip_validation=True)
+        item2 = MockItem(bundle, "name2", {}, skip_validation=True)
+        dummy = deps.DummyItem("mock")
+        graph = deps.DependencyGraph([item1, item2, dummy])
+        self.assertEqual(graph.of_types(["mock"]), [item1, item2])
+        self.assertEqual(graph.of_types(["mock", "mock"]), [item1, item2])
+        self.assertEqual(
+            graph.of_types(["mock"], include_dummy=True),
+            [item1, item2, dummy],
+        )
+
+
 class FlattenDependenciesTest(TestCase):
     """
     Tests blockwart.deps._flatten_dependencies.
@@ -44,7 +88,7 @@ class FlattenDependenciesTest(TestCase):
         item5._deps = ["type1:name1", "type1:name2"]
         items = [item1, item2, item3, item4, item5]
 
-        items = deps._flatten_dependencies(items)
+        items = deps._flatten_dependencies(deps.DependencyGraph(items))
 
         deps_should = {
             item1: [],
@@ -57,6 +101,28 @@ class FlattenDependenciesTest(TestCase):
         for item in items:
             self.assertEqual(set(item._flattened_deps), set(deps_should[item]))
 
+    def test_loop(self):
+        class FakeItem(object):
+            pass
+
+        def make_item(item_id, item_deps):
+            item = FakeItem()
+            item._deps = item_deps
+            item.id = item_id
+            return item
+
+        item1 = make_item("type1:name1", ["type1:name2"])
+        item2 = make_item("type1:name2", ["type1:name3"])
+        item3 = make_item("type1:name3", ["type1:name2"])
+        graph = deps.DependencyGraph([item1, item2, item3])
+
+        with self.assertRaises(ItemDependencyError) as context:
+            deps._flatten_dependencies(graph)
+        self.assertIn(
+            "type1:name2 -> type1:name3 -> type1:name2",
+            str(context.exception),
+        )
+
 
 class InjectCannedActionsTest(TestCase):
     """
@@ -75,11 +141,11 @@ class InjectCannedActionsTest(TestCase):
             {'triggers': ["mock:triggered", "mock:triggered:action1"]},
         )
         triggered_item = MockItem(bundle, "triggered", {})
-        items = deps._inject_canned_actions([
+        items = deps._inject_canned_actions(deps.DependencyGraph([
             triggering_item1,
             triggering_item2,
             triggered_item,
-        ])
+        ]))
         action = items[3]
         self.assertEqual(action.ITEM_TYPE_NAME, 'action')
         self.assertEqual(len(items), 4)
@@ -93,7 +159,10 @@ class InjectCannedActionsTest(TestCase):
         )
         not_triggered_item = MockItem(bundle, "not_triggered", {})
         with self.assertRaises(BundleError):
-            deps._inject_canned_actions([triggering_item, not_triggered_item])
+            deps._inject_canned_actions(deps.DependencyGraph([
+                triggering_item,
+                not_triggered_item,
+            ]))
 
     def test_unknown_action(self):
         bundle = MagicMock()
@@ -104,7 +173,10 @@ class InjectCannedActionsTest(TestCase):
         )
         triggered_item = MockItem(bundle, "triggered", {})
         with self.assertRaises(BundleError):
-            deps._inject_canned_actions([triggering_item, triggered_item])
+            deps._inject_canned_actions(deps.DependencyGraph([
+                triggering_item,
+                triggered_item,
+            ]))
 
 
 class InjectDummyItemsTest(TestCase):
@@ -129,7 +201,7 @@ class InjectDummyItemsTest(TestCase):
         item4 = make_item("type3:name1")
         items = [item1, item2, item3, item4]
 
-        injected = deps._inject_dummy_items(items)
+        injected = deps._inject_dummy_items(deps.DependencyGraph(items))
 
         dummy_counter = 0
         for item in injected:
@@ -176,7 +248,7 @@ class InjectConcurrencyBlockersTest(TestCase):
         item32 = make_item(FakeItem3, "type3:name2")
 
         items = [item11, item32, item22, item12, item21, item23, item31]
-        injected = deps._inject_concurrency_blockers(items)
+        injected = deps._inject_concurrency_blockers(deps.DependencyGraph(items))
 
         deps_should = {
             item11: [],
@@ -193,6 +265,18 @@ class InjectConcurrencyBlockersTest(TestCase):
         for item in injected:
             self.assertEqual(item._deps, deps_should[item])
 
+    def test_blocking_own_type(self):
+        bundle = MagicMock()
+        bundle.name = "bundle1"
+        items = [
+            AptPkg(bundle, "pkg{}".format(i), {}, skip_validation=True)
+            for i in range(3)
+        ]
+        graph = deps.prepare_dependencies(items)
+        self.assertEqual(graph.find("pkg_apt:pkg0")._deps, [])
+        self.assertEqual(graph.find("pkg_apt:pkg1")._deps, ["pkg_apt:pkg0"])
+        self.assertEqual(graph.find("pkg_apt:pkg2")._deps, ["pkg_apt:pkg1"])
+
     def test_noop(self):
         class FakeItem(object):
             pass
@@ -214,7 +298,7 @@ class InjectConcurrencyBlockersTest(TestCase):
         item32 = make_item("type3:name2")
 
         items = [item11, item32, item22, item12, item21, item23, item31]
-        injected = deps._inject_concurrency_blockers(items)
+        injected = deps._inject_concurrency_blockers(deps.DependencyGraph(items))
 
         deps_should = {
             item11: [],
@@ -232,87 +316,154 @@ class InjectConcurrencyBlockersTest(TestCase):
             self.assertEqual(item._deps, deps_should[item])
 
 
-class ItemSplitWithoutDepTest(TestCase):
+class ItemQueueTest(TestCase):
     """
-    Tests blockwart.deps.split_items_without_deps.
+    Tests blockwart.deps.ItemQueue.
     """
-    def test_all_deps(self):
-        class FakeItem(object):
-            pass
-        item1 = FakeItem()
-        item1._deps = ["type1:name1"]
-        item2 = FakeItem()
-        item2._deps = ["type1:", "type2:name2"]
-        item3 = FakeItem()
-        item3._deps = ["type2:"]
-        items = [item1, item2, item3]
-        items, removed_items = deps.split_items_without_deps(items)
-        self.assertEqual(removed_items, [])
-        self.assertEqual(items, [item1, item2, item3])
-
-    def test_no_deps(self):
-        class FakeItem(object):
-            pass
-        item1 = FakeItem()
-        item1._deps = []
-        item2 = FakeItem()
-        item2._deps = []
-        item3 = FakeItem()
-        item3._deps = []
-        items = [item1, item2, item3]
-        items, removed_items = deps.split_items_without_deps(items)
-        self.assertEqual(items, [])
-        self.assertEqual(removed_items, [item1, item2, item3])
-
-    def test_some_deps(self):
-        class FakeItem(object):
-            pass
-        item1 = FakeItem()
+    def _make_graph(self):
+        bundle = MagicMock()
+        item1 = MockItem(bundle, "name1", {}, skip_validation=True)
+        item2 = MockItem(bundle, "name2", {}, skip_validation=True)
+        item3 = MockItem(bundle, "name3", {}, skip_validation=True)
+        item4 = MockItem(bundle, "name4", {}, skip_validation=True)
         item1._deps = []
-        item2 = FakeItem()
-        item2._deps = []
-        item3 = FakeItem()
-        item3._deps = ["type2:"]
-        items = [item1, item2, item3]
-        items, removed_items = deps.split_items_without_deps(items)
-        self.assertEqual(removed_items, [item1, item2])
-        self.assertEqual(items, [item3])
-
-
-class ItemsRemoveDepTest(TestCase):
-    """
-    Tests blockwart.deps.remove_dep_from_items.
-    """
-    def test_remove(self):
-        item1 = MagicMock()
-        item1._deps = ["foo", "bar"]
-        item2 = MagicMock()
-        item2._deps = ["foo"]
-        items = deps.remove_dep_from_items([item1, item2], "foo")
-        self.assertEqual(items[0]._deps, ["bar"])
-        self.assertEqual(items[1]._deps, [])
-
+        item2._deps = ["mock:name1"]
+        item3._deps = ["mock:name1", "mock:name2"]
+        item4._deps = []
+        graph = deps.DependencyGraph([item1, item2, item3, item4])
+        return graph.build_edges()
+
+    def test_order(self):
+        queue = deps.ItemQueue(self._make_graph())
+        processed = []
+        while queue.items_ready:
+            item = queue.pop()
+            processed.append(item.id)
+            queue.item_done(item.id)
+        self.assertEqual(
+            processed,
+            ["mock:name1", "mock:name2", "mock:name4", "mock:name3"],
+        )
+        self.assertEqual(queue.items_waiting, [])
 
-class RemoveItemDependentsTest(TestCase):
-    """
-    Tests blockwart.deps.remove_item_dependents.
-    """
-    def test_remove_empty(self):
-        self.assertEqual(deps.remove_item_dependents([], "foo"), ([], []))
-
-    def test_recursive_removal(self):
-        item1 = MagicMock()
-        item1.id = "item1"
-        item1._deps = ["item2"]
-        item2 = MagicMock()
-        item2.id = "item2"
-        item2._deps = ["item3"]
-        item3 = MagicMock()
-        item3.id = "item3"
-        item3._deps = []
-        items = [item1, item2, item3]
+    def test_critical_path_first(self):
+        bundle = MagicMock()
+        leaf1 = MockItem(bundle, "leaf1", {}, skip_validation=True)
+        leaf2 = MockItem(bundle, "leaf2", {}, skip_validation=True)
+        chain1 = MockItem(bundle, "chain1", {}, skip_validation=True)
+        chain2 = MockItem(bundle, "chain2", {}, skip_validation=True)
+        chain3 = MockItem(bundle, "chain3", {}, skip_validation=True)
+        leaf1._deps = []
+        leaf2._deps = []
+        chain1._deps = []
+        chain2._deps = ["mock:chain1"]
+        chain3._deps = ["mock:chain2"]
+        graph = deps.DependencyGraph([leaf1, leaf2, chain1, chain2, chain3]).build_edges()
+        queue = deps.ItemQueue(graph)
+        self.assertEqual(queue.priorities["mock:chain1"], 3)
+        self.assertEqual(queue.pop().id, "mock:chain1")
+        self.assertEqual(queue.pop().id, "mock:leaf1")
+
+    def test_weights(self):
+        queue = deps.ItemQueue(self._make_graph(), weights={"mock:name4": 10})
+        self.assertEqual(queue.pop().id, "mock:name4")
+        self.assertEqual(queue.pop().id, "mock:name1")
+
+    def test_failed(self):
+        queue = deps.ItemQueue(self._make_graph())
+        item = queue.pop()
+        self.assertEqual(item.id, "mock:name1")
+        removed = queue.item_failed(item.id)
+        self.assertEqual(
+            set([removed_item.id for removed_item in removed]),
+            set(["mock:name2", "mock:name3"]),
+        )
+        self.assertEqual(queue.pop().id, "mock:name4")
+        self.assertFalse(queue.items_ready)
+        self.assertEqual(queue.items_waiting, [])
+
+    def test_batch_with(self):
+        queue = deps.ItemQueue(self._make_graph())
+        item = queue.pop()
+        batch = queue.batch_with(
+            item,
+            lambda other: other.id in ("mock:name2", "mock:name4"),
+        )
+        # name2 depends on name1 and has to wait for it to succeed
+        self.assertEqual([batch_item.id for batch_item in batch], ["mock:name4"])
+        self.assertFalse(queue.items_ready)
+        for batch_item in [item] + batch:
+            queue.item_done(batch_item.id)
+        self.assertEqual(queue.pop().id, "mock:name2")
+
+    def test_batch_with_failed(self):
+        queue = deps.ItemQueue(self._make_graph())
+        item = queue.pop()
+        batch = queue.batch_with(item, lambda other: True)
+        self.assertEqual([batch_item.id for batch_item in batch], ["mock:name4"])
+        removed = queue.item_failed(item.id)
+        self.assertEqual(
+            set([removed_item.id for removed_item in removed]),
+            set(["mock:name2", "mock:name3"]),
+        )
+        queue.item_done("mock:name4")
+        self.assertFalse(queue.items_ready)
+        self.assertEqual(queue.items_waiting, [])
 
+    def test_batch_with_limit(self):
+        bundle = MagicMock()
+        items = [
+            MockItem(bundle, "name{}".format(i), {}, skip_validation=True)
+            for i in range(5)
+        ]
+        for item in items:
+            item._deps = []
+        queue = deps.ItemQueue(deps.DependencyGraph(items).build_edges())
+        item = queue.pop()
+        batch = queue.batch_with(item, lambda other: True, limit=2)
         self.assertEqual(
-            deps.remove_item_dependents(items, "item3"),
-            ([item3], [item2, item1]),
+            [batch_item.id for batch_item in batch],
+            ["mock:name1", "mock:name2"],
         )
+        self.assertEqual(queue.ready_count, 2)
+
+    def test_batch_with_concurrency_blockers(self):
+        bundle = MagicMock()
+        bundle.name = "bundle1"
+        items = [
+            AptPkg(bundle, "pkg0", {}, skip_validation=True),
+            AptPkg(bundle, "pkg1", {}, skip_validation=True),
+            AptPkg(bundle, "pkg2", {'installed': False}, skip_validation=True),
+            AptPkg(bundle, "pkg3", {}, skip_validation=True),
+        ]
+        queue = deps.ItemQueue(deps.prepare_dependencies(items))
+        item = queue.pop()
+        self.assertEqual(item.id, "pkg_apt:pkg0")
+        self.assertFalse(queue.items_ready)
+        # pkg1 only waits for pkg0 because apt can't run twice at once,
+        # pkg3 waits for pkg2, which can't join because of its batch key
+        batch = queue.batch_with(
+            item,
+            lambda other: (
+                isinstance(other, AptPkg) and
+                other.get_batch_key() == item.get_batch_key()
+            ),
+            limit=0,
+        )
+        self.assertEqual([batch_item.id for batch_item in batch], ["pkg_apt:pkg1"])
+        for batch_item in [item] + batch:
+            queue.item_done(batch_item.id)
+        self.assertEqual(queue.pop().id, "pkg_apt:pkg2")
+        self.assertFalse(queue.items_ready)
+
+    def test_loop(self):
+        bundle = MagicMock()
+        item1 = MockItem(bundle, "name1", {}, skip_validation=True)
+        item2 = MockItem(bundle, "name2", {}, skip_validation=True)
+        item1._deps = ["mock:name2"]
+        item2._deps = ["mock:name1"]
+        graph = deps.DependencyGraph([item1, item2]).build_edges()
+        queue = deps.ItemQueue(graph)
+        self.assertFalse(queue.items_ready)
+        self.assertEqual(queue.items_waiting, [item1, item2])
+        self.assertEqual(queue.priorities, {"mock:name1": 1, "mock:name2": 1})
@@ -150,7 +150,7 @@ class MemberTest(TestCase):
         group = Group("group1", {'members': ("node2", "node1")})
         repo.add_group(group)
         self.assertEqual(
-            set(group._nodes_from_static_members),
+            set(group.nodes),
             set((node1, node2)),
         )
 
@@ -165,7 +165,7 @@ class MemberTest(TestCase):
         repo.add_node(node4)
         repo.add_node(Node("node5"))
         self.assertEqual(
-            set(group1._nodes_from_subgroups),
+            set(group1.nodes),
             set((node3, node4)),
         )
 
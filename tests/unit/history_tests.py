@@ -0,0 +1,75 @@
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from mock import MagicMock, patch
+
+from blockwart import history
+
+
+class DurationHistoryTest(TestCase):
+    """
+    Tests blockwart.history.DurationHistory.
+    """
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.repo = MagicMock()
+        self.repo.path = "/repo"
+        self.environ = patch.dict(
+            'blockwart.history.environ',
+            {'BWHISTORYCACHE': join(self.tmpdir, "history")},
+        )
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        rmtree(self.tmpdir)
+
+    def test_disabled(self):
+        with patch.dict('blockwart.history.environ', clear=True):
+            duration_history = history.DurationHistory(self.repo)
+            duration_history.record_nodes({"node1": 10.0})
+            self.assertEqual(duration_history.node_estimates(), {})
+        self.assertFalse(exists(join(self.tmpdir, "history")))
+
+    def test_per_repo(self):
+        history.DurationHistory(self.repo).record_nodes({"node1": 10.0})
+        other_repo = MagicMock()
+        other_repo.path = "/other_repo"
+        self.assertEqual(history.DurationHistory(other_repo).node_estimates(), {})
+
+    def test_empty(self):
+        duration_history = history.DurationHistory(self.repo)
+        self.assertEqual(duration_history.item_estimates("node1"), {})
+        self.assertEqual(duration_history.node_estimates(), {})
+
+    def test_items(self):
+        history.DurationHistory(self.repo).record_items("node1", {
+            "file:/foo": 2.0,
+            "pkg_apt:bar": 10.0,
+        })
+        history.DurationHistory(self.repo).record_items("node2", {
+            "file:/foo": 5.0,
+        })
+        duration_history = history.DurationHistory(self.repo)
+        self.assertEqual(duration_history.item_estimates("node1"), {
+            "file:/foo": 2.0,
+            "pkg_apt:bar": 10.0,
+        })
+        self.assertEqual(duration_history.node_estimates(), {})
+
+    def test_moving_average(self):
+        duration_history = history.DurationHistory(self.repo)
+        duration_history.record_nodes({"node1": 10.0})
+        duration_history.record_nodes({"node1": 20.0})
+        self.assertAlmostEqual(
+            duration_history.node_estimates()["node1"],
+            10.0 + 10.0 * history.HISTORY_WEIGHT,
+        )
+
+    def test_unusable_cache_dir(self):
+        with patch.dict('blockwart.history.environ', {'BWHISTORYCACHE': "/dev/null/bw"}):
+            duration_history = history.DurationHistory(self.repo)
+            duration_history.record_nodes({"node1": 10.0})
+            self.assertEqual(duration_history.node_estimates(), {})
@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-from os import makedirs
+from os import listdir, makedirs
+from os.path import join
+import re
 from shutil import rmtree
-from tempfile import mkstemp
+import tarfile
+from tempfile import mkdtemp, mkstemp
+from threading import Thread
 from unittest import TestCase
 
 from mako.exceptions import CompileException
 from mock import call, MagicMock, patch
 
 from blockwart.exceptions import BundleError
+from blockwart.utils import sha1
 from blockwart.items import files, ItemStatus
 from blockwart.utils.text import green, red
 
@@ -33,6 +38,73 @@ class ContentProcessorMakoTest(TestCase):
         )
 
 
+class GetMakoTemplateTest(TestCase):
+    """
+    Tests blockwart.items.files.get_mako_template.
+    """
+    def setUp(self):
+        files._TEMPLATE_CACHE.clear()
+
+    def tearDown(self):
+        files._TEMPLATE_CACHE.clear()
+
+    @patch('blockwart.items.files._compile_mako_template')
+    def test_cached(self, compile_template):
+        compile_template.side_effect = lambda content, encoding: object()
+        template = files.get_mako_template("${47}", "utf-8")
+        self.assertIs(files.get_mako_template("${47}", "utf-8"), template)
+        self.assertIsNot(files.get_mako_template("${47}", "latin-1"), template)
+        self.assertEqual(compile_template.call_count, 2)
+
+    @patch('blockwart.items.files.TEMPLATE_CACHE_SIZE', 2)
+    @patch('blockwart.items.files._compile_mako_template')
+    def test_lru(self, compile_template):
+        compile_template.side_effect = lambda content, encoding: object()
+        template1 = files.get_mako_template("1", "utf-8")
+        files.get_mako_template("2", "utf-8")
+        files.get_mako_template("1", "utf-8")
+        files.get_mako_template("3", "utf-8")
+        self.assertEqual(len(files._TEMPLATE_CACHE), 2)
+        self.assertIs(files.get_mako_template("1", "utf-8"), template1)
+        self.assertEqual(compile_template.call_count, 3)
+        files.get_mako_template("2", "utf-8")
+        self.assertEqual(compile_template.call_count, 4)
+
+    @patch('blockwart.items.files.TEMPLATE_CACHE_SIZE', 4)
+    @patch('blockwart.items.files._compile_mako_template')
+    def test_threads(self, compile_template):
+        compile_template.side_effect = lambda content, encoding: object()
+        errors = []
+
+        def render_many():
+            try:
+                for i in range(500):
+                    files.get_mako_template(str(i % 7), "utf-8")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=render_many) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(files._TEMPLATE_CACHE), 4)
+
+    def test_module_dir(self):
+        cache_dir = mkdtemp()
+        try:
+            with patch.dict('os.environ', {'BWCODECACHE': cache_dir}):
+                template = files.get_mako_template("Hi from ${x}!", "utf-8")
+                self.assertEqual(template.render(x=47), "Hi from 47!")
+                files._TEMPLATE_CACHE.clear()
+                template = files.get_mako_template("Hi from ${x}!", "utf-8")
+                self.assertEqual(template.render(x=48), "Hi from 48!")
+            self.assertEqual(len(listdir(join(cache_dir, "mako"))), 2)
+        finally:
+            rmtree(cache_dir)
+
+
 class ContentProcessorTextTest(TestCase):
     """
     Tests blockwart.items.files.content_processor_text.
@@ -167,6 +239,43 @@ class FileContentHashTest(TestCase):
         self.assertEqual(f.content_hash, "47")
         hash_local_file.assert_called_once_with("/b/dir/files/foobar")
 
+    def test_render_hash(self):
+        tmpdir = mkdtemp()
+        cache_dir = join(tmpdir, "render")
+        bundle = MagicMock()
+        bundle.name = "bundle1"
+        bundle.node.name = "node1"
+        bundle.node.metadata = {'foo': 47}
+        attrs = {'content': "${node.metadata['foo']}", 'content_type': 'mako'}
+        try:
+            with patch.dict('os.environ', {'BWRENDERCACHE': cache_dir}):
+                f = files.File(bundle, "/foo", dict(attrs))
+                self.assertEqual(f.content_hash, sha1("47"))
+                self.assertEqual(len(listdir(cache_dir)), 1)
+
+                f = files.File(bundle, "/foo", dict(attrs))
+                self.assertEqual(f.content_hash, sha1("47"))
+                self.assertFalse('content' in f._cache)
+
+                bundle.node.metadata = {'foo': 48}
+                f = files.File(bundle, "/foo", dict(attrs))
+                self.assertEqual(f.content_hash, sha1("48"))
+                self.assertTrue('content' in f._cache)
+                self.assertEqual(len(listdir(cache_dir)), 2)
+
+                # nothing to gain for text files
+                f = files.File(bundle, "/bar", {'content': "47", 'content_type': 'text'})
+                self.assertEqual(f.content_hash, sha1("47"))
+                self.assertEqual(len(listdir(cache_dir)), 2)
+
+                # no reliable key for objects JSON doesn't know
+                bundle.node.metadata = {'foo': 47, 'bar': object()}
+                f = files.File(bundle, "/foo", dict(attrs))
+                self.assertEqual(f.content_hash, sha1("47"))
+                self.assertEqual(len(listdir(cache_dir)), 2)
+        finally:
+            rmtree(tmpdir)
+
 
 class FileFixTest(TestCase):
     """
@@ -261,6 +370,43 @@ class FileFixTest(TestCase):
         self.assertFalse(fix_content.called)
 
 
+class FileFixBatchTest(TestCase):
+    """
+    Tests blockwart.items.files.File.fix_batch.
+    """
+    def _status(self, *needs_fixing):
+        return ItemStatus(correct=False, info={
+            'needs_fixing': list(needs_fixing),
+            'path_info': MagicMock(),
+        })
+
+    @patch('blockwart.items.files.push_content_archive')
+    @patch('blockwart.items.files.File.fix')
+    def test_archive(self, fix, push_content_archive):
+        bundle = MagicMock()
+        f1 = files.File(bundle, "/foo", {'content': "1"})
+        f2 = files.File(bundle, "/bar", {'content': "2"})
+        f3 = files.File(bundle, "/baz", {'content': "3"})
+        f4 = files.File(bundle, "/qux", {'content': "4"})
+        files.File.fix_batch([
+            (f1, self._status('content', 'mode')),
+            (f2, self._status('mode')),
+            (f3, self._status('content')),
+            (f4, self._status('type', 'content')),
+        ])
+        push_content_archive.assert_called_once_with(bundle.node, [f1, f3])
+        self.assertEqual(fix.call_count, 2)
+
+    @patch('blockwart.items.files.push_content_archive')
+    @patch('blockwart.items.files.File.fix')
+    def test_single(self, fix, push_content_archive):
+        f1 = files.File(MagicMock(), "/foo", {'content': "1"})
+        status = self._status('content')
+        files.File.fix_batch([(f1, status)])
+        fix.assert_called_once_with(status)
+        self.assertFalse(push_content_archive.called)
+
+
 class FileFixContentTest(TestCase):
     """
     Tests blockwart.items.files.File._fix_content.
@@ -296,6 +442,9 @@ class FileFixContentTest(TestCase):
         )
         f._fix_content(MagicMock())
         node.upload.assert_called_once()
+        args, kwargs = node.upload.call_args
+        self.assertEqual(args[0].read(), b"47")
+        self.assertEqual(args[1], "/foo")
 
 
 class FileFixModeTest(TestCase):
@@ -563,6 +712,88 @@ class FileTestTest(TestCase):
         f.test()
 
 
+class FakeDeltaNode(object):
+    def __init__(self, content):
+        self.commands = []
+        self.content = content
+        self.temp_files = {}
+
+    def download(self, path, local_path):
+        local_path.write(bytes(self.temp_files[path]))
+
+    def run(self, command, may_fail=False):
+        self.commands.append(command)
+        result = MagicMock()
+        result.return_code = 0
+        lines = files._split_lines(self.content)
+        if command.startswith("split "):
+            result.stdout = "".join([
+                "{}  -\n".format(sha1(b"".join(lines[i:i + files.DIFF_BLOCK_LINES])))
+                for i in range(0, len(lines), files.DIFF_BLOCK_LINES)
+            ])
+        elif command.startswith("sed "):
+            output = b""
+            for first, last in re.findall(r"-e (\d+),(\d+)p", command):
+                output += b"".join(lines[int(first) - 1:int(last)])
+            self.temp_files[re.search(r"> (\S+) ", command).group(1)] = output
+        return result
+
+
+class GetRemoteFileContentsByDeltaTest(TestCase):
+    """
+    Tests blockwart.items.files.get_remote_file_contents_by_delta.
+    """
+    @patch('blockwart.items.files.randstr', return_value="47")
+    def test_delta(self, randstr):
+        remote_lines = ["line {}\n".format(i) for i in range(200)]
+        basis_lines = list(remote_lines)
+        basis_lines.insert(10, "new line\n")
+        basis_lines[150] = "changed line\n"
+        node = FakeDeltaNode(b"".join(remote_lines) + b"no newline")
+        self.assertEqual(
+            files.get_remote_file_contents_by_delta(
+                node,
+                "/foo",
+                b"".join(basis_lines) + b"no newline",
+            ),
+            node.content,
+        )
+        self.assertEqual(
+            node.commands[1],
+            "sed -n -e 1,32p -e 129,160p -- /foo > .blockwart_tmp_47 && "
+            "chown \"$SUDO_USER\" .blockwart_tmp_47 && chmod 0400 .blockwart_tmp_47",
+        )
+        self.assertEqual(node.commands[2], "rm -f -- .blockwart_tmp_47")
+
+    def test_unchanged(self):
+        node = FakeDeltaNode(b"foo\nbar\n")
+        self.assertEqual(
+            files.get_remote_file_contents_by_delta(node, "/foo", b"foo\nbar\n"),
+            b"foo\nbar\n",
+        )
+        self.assertEqual(len(node.commands), 1)
+
+    def test_unknown(self):
+        node = FakeDeltaNode(b"foo\n" * 70)
+        self.assertEqual(
+            files.get_remote_file_contents_by_delta(node, "/foo", b""),
+            node.content,
+        )
+        self.assertTrue(node.commands[1].startswith(
+            "sed -n -e 1,96p -- /foo > .blockwart_tmp_",
+        ))
+
+    @patch('blockwart.items.files.get_remote_file_contents', return_value="47")
+    def test_fallback(self, get_remote_file_contents):
+        node = MagicMock()
+        node.run.return_value.return_code = 1
+        self.assertEqual(
+            files.get_remote_file_contents_by_delta(node, "/foo", b""),
+            "47",
+        )
+        get_remote_file_contents.assert_called_once_with(node, "/foo")
+
+
 class HashLocalTest(TestCase):
     """
     Tests blockwart.items.files.hash_local_file.
@@ -577,6 +808,41 @@ class HashLocalTest(TestCase):
         )
 
 
+class PushContentArchiveTest(TestCase):
+    """
+    Tests blockwart.items.files.push_content_archive.
+    """
+    @patch('blockwart.items.files.randstr', return_value="47")
+    def test_archive(self, randstr):
+        bundle = MagicMock()
+        f1 = files.File(bundle, "/foo/bar", {'content': "1", 'mode': "0600"})
+        f2 = files.File(bundle, "/baz", {'content': "22", 'owner': "user"})
+        files.push_content_archive(bundle.node, [f1, f2])
+
+        archive, remote_path = bundle.node.upload.call_args[0]
+        self.assertEqual(remote_path, ".blockwart_archive_47")
+        tar = tarfile.open(fileobj=archive)
+        self.assertEqual(tar.getnames(), ["foo/.blockwart_tmp_47", ".blockwart_tmp_47"])
+        member = tar.getmember("foo/.blockwart_tmp_47")
+        self.assertEqual(member.mode, 0o600)
+        self.assertEqual(member.uid, 0)
+        self.assertEqual(tar.extractfile(member).read(), b"1")
+        member = tar.getmember(".blockwart_tmp_47")
+        self.assertEqual(member.mode, 0o600)
+        self.assertEqual(tar.extractfile(member).read(), b"22")
+        bundle.node.run.assert_called_once_with(
+            "tar --no-same-owner -xf .blockwart_archive_47 -C / && "
+            "chown root:root -- /foo/.blockwart_tmp_47 && "
+            "chmod 0600 -- /foo/.blockwart_tmp_47 && "
+            "mv -f -- /foo/.blockwart_tmp_47 /foo/bar && "
+            "chown user:root -- /.blockwart_tmp_47 && "
+            "chmod 0664 -- /.blockwart_tmp_47 && "
+            "mv -f -- /.blockwart_tmp_47 /baz ; "
+            "result=$? ; rm -f -- .blockwart_archive_47 "
+            "/foo/.blockwart_tmp_47 /.blockwart_tmp_47 ; exit $result"
+        )
+
+
 class ValidateAttributesTest(TestCase):
     """
     Tests blockwart.items.files.File.validate_attributes.
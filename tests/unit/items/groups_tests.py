@@ -3,11 +3,10 @@ from __future__ import unicode_literals
 
 from unittest import TestCase
 
-from mock import MagicMock, call
+from mock import MagicMock, call, patch
 
 from blockwart.exceptions import BundleError
 from blockwart.items import ItemStatus, groups
-from blockwart.operations import RunResult
 
 
 class ParseGroupLineTest(TestCase):
@@ -128,7 +127,8 @@ class GetStatusTest(TestCase):
     """
     Tests blockwart.items.groups.Group.get_status.
     """
-    def test_ok(self):
+    @patch('blockwart.items.groups._accounts')
+    def test_ok(self, _accounts):
         bundle = MagicMock()
         group = groups.Group(
             bundle,
@@ -136,16 +136,13 @@ class GetStatusTest(TestCase):
             { 'gid': 2345 },
         )
 
-        grep_result = RunResult()
-        grep_result.return_code = 0
-        grep_result.stdout = "blockwart:x:2345:user1,user2\n"
-
-        bundle.node.run.return_value = grep_result
+        _accounts.return_value = {'group': {'blockwart': "blockwart:x:2345:user1,user2"}}
 
         status = group.get_status()
         self.assertTrue(status.correct)
 
-    def test_gid(self):
+    @patch('blockwart.items.groups._accounts')
+    def test_gid(self, _accounts):
         bundle = MagicMock()
         group = groups.Group(
             bundle,
@@ -153,16 +150,13 @@ class GetStatusTest(TestCase):
             { 'gid': 2345 },
         )
 
-        grep_result = RunResult()
-        grep_result.return_code = 0
-        grep_result.stdout = "blockwart:x:5432:user1,user2\n"
-
-        bundle.node.run.return_value = grep_result
+        _accounts.return_value = {'group': {'blockwart': "blockwart:x:5432:user1,user2"}}
 
         status = group.get_status()
         self.assertFalse(status.correct)
 
-    def test_group_fail(self):
+    @patch('blockwart.items.groups._accounts')
+    def test_group_fail(self, _accounts):
         bundle = MagicMock()
         group = groups.Group(
             bundle,
@@ -170,10 +164,7 @@ class GetStatusTest(TestCase):
             { 'gid': 2345 },
         )
 
-        grep_result = RunResult()
-        grep_result.return_code = 1
-
-        bundle.node.run.return_value = grep_result
+        _accounts.return_value = {'group': {}}
 
         status = group.get_status()
         self.assertFalse(status.correct)
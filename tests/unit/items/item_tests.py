@@ -108,6 +108,33 @@ class ApplyTest(TestCase):
         item.apply()
         self.assertTrue(item.fix.called)
 
+
+class ApplyBatchTest(TestCase):
+    """
+    Tests blockwart.items.Item.apply_batch.
+    """
+    @patch('blockwart.items.Item.fix_batch')
+    def test_batch(self, fix_batch):
+        status_wrong = MagicMock()
+        status_wrong.correct = False
+        status_correct = MagicMock()
+        status_correct.correct = True
+        item1 = MockItem(MagicMock(), "item1", {}, skip_validation=True)
+        item1.get_status = MagicMock(side_effect=[status_wrong, status_correct])
+        item2 = MockItem(MagicMock(), "item2", {}, skip_validation=True)
+        item2.get_status = MagicMock(return_value=status_correct)
+        item3 = MockItem(MagicMock(), "item3", {}, skip_validation=True)
+        item3.get_status = MagicMock(return_value=status_wrong)
+        result = MockItem.apply_batch([item1, item2, item3])
+        fix_batch.assert_called_once_with(
+            [(item1, status_wrong), (item3, status_wrong)],
+        )
+        self.assertEqual(
+            result,
+            [Item.STATUS_FIXED, Item.STATUS_OK, Item.STATUS_FAILED],
+        )
+
+
 class InitTest(TestCase):
     """
     Tests initialization of blockwart.items.Item.
@@ -47,6 +47,30 @@ class FixTest(TestCase):
         pkg.fix(MagicMock())
 
 
+class FixBatchTest(TestCase):
+    """
+    Tests blockwart.items.pkg_apt.AptPkg.fix_batch.
+    """
+    def test_install(self):
+        bundle = MagicMock()
+        pkg1 = pkg_apt.AptPkg(bundle, "foo", {'installed': True})
+        pkg2 = pkg_apt.AptPkg(bundle, "bar", {'installed': True})
+        pkg_apt.AptPkg.fix_batch([(pkg1, MagicMock()), (pkg2, MagicMock())])
+        bundle.node.run.assert_called_once_with(
+            "DEBIAN_FRONTEND=noninteractive "
+            "apt-get -qy --no-install-recommends install foo bar"
+        )
+
+    def test_remove(self):
+        bundle = MagicMock()
+        pkg1 = pkg_apt.AptPkg(bundle, "foo", {'installed': False})
+        pkg2 = pkg_apt.AptPkg(bundle, "bar", {'installed': False})
+        pkg_apt.AptPkg.fix_batch([(pkg1, MagicMock()), (pkg2, MagicMock())])
+        bundle.node.run.assert_called_once_with(
+            "DEBIAN_FRONTEND=noninteractive apt-get -qy purge foo bar"
+        )
+
+
 class GetStatusTest(TestCase):
     """
     Tests blockwart.items.pkg_apt.AptPkg.get_status.
@@ -84,13 +108,57 @@ class PkgInstalledTest(TestCase):
     """
     Tests blockwart.items.pkg_apt.pkg_installed.
     """
+    def test_inventory(self):
+        runresult = RunResult()
+        runresult.return_code = 0
+        runresult.stdout = (
+            "foo:amd64 install ok installed\n"
+            "bar:all deinstall ok config-files\n"
+            "baz:i386 install ok half-installed\n"
+        )
+        node = MagicMock()
+        node.run.return_value = runresult
+        self.assertTrue(pkg_apt.pkg_installed(node, "foo"))
+        self.assertTrue(pkg_apt.pkg_installed(node, "foo:amd64"))
+        self.assertFalse(pkg_apt.pkg_installed(node, "foo:i386"))
+        self.assertFalse(pkg_apt.pkg_installed(node, "bar"))
+        self.assertFalse(pkg_apt.pkg_installed(node, "baz"))
+        self.assertEqual(node.run.call_count, 1)
+
+    def test_invalidation(self):
+        runresult = RunResult()
+        runresult.return_code = 0
+        runresult.stdout = "foo:amd64 install ok installed\n"
+        node = MagicMock()
+        node.run.return_value = runresult
+        self.assertTrue(pkg_apt.pkg_installed(node, "foo"))
+        pkg_apt.pkg_remove(node, "foo")
+        runresult.stdout = ""
+        self.assertFalse(pkg_apt.pkg_installed(node, "foo"))
+        self.assertEqual(node.run.call_count, 3)
+
+    @patch('blockwart.items.pkg_apt.pkg_installed_single', return_value=True)
+    def test_no_dpkg_query(self, pkg_installed_single):
+        runresult = RunResult()
+        runresult.return_code = 127
+        runresult.stdout = ""
+        node = MagicMock()
+        node.run.return_value = runresult
+        self.assertTrue(pkg_apt.pkg_installed(node, "foo"))
+        pkg_installed_single.assert_called_once_with(node, "foo")
+
+
+class PkgInstalledSingleTest(TestCase):
+    """
+    Tests blockwart.items.pkg_apt.pkg_installed_single.
+    """
     def test_installed(self):
         runresult = RunResult()
         runresult.return_code = 0
         runresult.stdout = "Status: install ok installed\n"
         node = MagicMock()
         node.run.return_value = runresult
-        self.assertTrue(pkg_apt.pkg_installed(node, "foo"))
+        self.assertTrue(pkg_apt.pkg_installed_single(node, "foo"))
 
     def test_not_installed(self):
         runresult = RunResult()
@@ -102,7 +170,7 @@ class PkgInstalledTest(TestCase):
         )
         node = MagicMock()
         node.run.return_value = runresult
-        self.assertFalse(pkg_apt.pkg_installed(node, "foo"))
+        self.assertFalse(pkg_apt.pkg_installed_single(node, "foo"))
 
 
 class ValidateAttributesTest(TestCase):
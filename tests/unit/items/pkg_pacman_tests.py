@@ -100,6 +100,17 @@ class PkgInstalledTest(TestCase):
         node.run.return_value = runresult
         self.assertFalse(pkg_pacman.pkg_installed(node, "foo"))
 
+    def test_inventory(self):
+        runresult = RunResult()
+        runresult.return_code = 0
+        runresult.stdout = "bar 2.0-1\nfoo 1.0.0-1\n"
+        node = MagicMock()
+        node.run.return_value = runresult
+        self.assertTrue(pkg_pacman.pkg_installed(node, "foo"))
+        self.assertTrue(pkg_pacman.pkg_installed(node, "bar"))
+        self.assertFalse(pkg_pacman.pkg_installed(node, "baz"))
+        self.assertEqual(node.run.call_count, 1)
+
 
 class ValidateAttributesTest(TestCase):
     """
@@ -10,20 +10,67 @@ from blockwart.items import ItemStatus, users
 from blockwart.operations import RunResult
 
 
-class GroupsForUserTest(TestCase):
+class AccountsTest(TestCase):
     """
-    Tests blockwart.items.users._groups_for_user.
+    Tests blockwart.items.users._accounts.
     """
-    def test_groups(self):
+    def test_accounts(self):
         node = MagicMock()
         result = RunResult()
-        result.stdout = "group1 group2\n"
+        result.stdout = (
+            "root:x:0:0:root:/root:/bin/bash\n"
+            "jdoe:x:1000:1000:John Doe:/home/jdoe:/bin/bash\n"
+            "\0"
+            "jdoe:secret:::::::\n"
+            "\0"
+            "jdoe:x:1000:\n"
+            "group1:x:1001:jdoe,root\n"
+        )
         node.run.return_value = result
 
-        groups = users._groups_for_user(node, "jdoe")
+        accounts = users._accounts(node)
+        self.assertEqual(accounts['passwd']['jdoe'], "jdoe:x:1000:1000:John Doe:/home/jdoe:/bin/bash")
+        self.assertEqual(accounts['shadow'], {'jdoe': "jdoe:secret:::::::"})
+        self.assertEqual(sorted(accounts['group'].keys()), ["group1", "jdoe"])
+
+        users._accounts(node)
+        self.assertEqual(node.run.call_count, 1)
+        users._accounts_changed(node)
+        users._accounts(node)
+        self.assertEqual(node.run.call_count, 2)
 
-        node.run.assert_called_once_with("id -Gn jdoe")
-        self.assertEqual(groups, ["group1", "group2"])
+
+class GroupsForUserTest(TestCase):
+    """
+    Tests blockwart.items.users._groups_for_user.
+    """
+    @patch('blockwart.items.users._accounts')
+    def test_groups(self, _accounts):
+        _accounts.return_value = {
+            'passwd': {'jdoe': "jdoe:x:1000:1002:John Doe:/home/jdoe:/bin/bash"},
+            'shadow': {},
+            'group': {
+                'group1': "group1:x:1001:root,jdoe",
+                'group2': "group2:x:1002:",
+                'group3': "group3:x:1003:root",
+            },
+        }
+        groups = users._groups_for_user(MagicMock(), "jdoe")
+        self.assertEqual(groups, ["group2", "group1"])
+
+    @patch('blockwart.items.users._accounts')
+    def test_malformed(self, _accounts):
+        _accounts.return_value = {
+            'passwd': {'jdoe': "jdoe:x:1000:1002:John Doe:/home/jdoe:/bin/bash"},
+            'shadow': {},
+            'group': {
+                'group1': "group1:x:1001:jdoe",
+                'group2': "group2:x",
+                'group3': "group3",
+            },
+        }
+        groups = users._groups_for_user(MagicMock(), "jdoe")
+        self.assertEqual(groups, ["1002", "group1"])
 
 
 class ParsePasswdLineTest(TestCase):
@@ -323,7 +370,8 @@ class GetStatusTest(TestCase):
     Tests blockwart.items.users.User.get_status.
     """
     @patch('blockwart.items.users._groups_for_user')
-    def test_ok(self, _groups_for_user):
+    @patch('blockwart.items.users._accounts')
+    def test_ok(self, _accounts, _groups_for_user):
         _groups_for_user.return_value = ["group1", "group2"]
         bundle = MagicMock()
         user = users.User(
@@ -339,25 +387,18 @@ class GetStatusTest(TestCase):
                 'uid': 1123,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"
-        shadow_grep_result = RunResult()
-        shadow_grep_result.return_code = 0
-        shadow_grep_result.stdout = "blockwart:secret:::::::"
-        results = [shadow_grep_result, passwd_grep_result]
-
-        def pop_result(*args, **kwargs):
-            return results.pop()
-
-        bundle.node.run.side_effect = pop_result
+        _accounts.return_value = {
+            'passwd': {"blockwart": "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash"},
+            'shadow': {"blockwart": "blockwart:secret:::::::"},
+            'group': {},
+        }
 
         status = user.get_status()
         self.assertTrue(status.correct)
 
     @patch('blockwart.items.users._groups_for_user')
-    def test_passwd(self, _groups_for_user):
+    @patch('blockwart.items.users._accounts')
+    def test_passwd(self, _accounts, _groups_for_user):
         _groups_for_user.return_value = ["group1", "group2"]
         bundle = MagicMock()
         user = users.User(
@@ -374,24 +415,17 @@ class GetStatusTest(TestCase):
                 'use_shadow': False,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:666:666:Blöck Wart:/home/blockwart:/bin/bash\n"
-        shadow_grep_result = RunResult()
-        shadow_grep_result.return_code = 0
-        shadow_grep_result.stdout = "blockwart:secret:::::::"
-        results = [shadow_grep_result, passwd_grep_result]
-
-        def pop_result(*args, **kwargs):
-            return results.pop()
-
-        bundle.node.run.side_effect = pop_result
+        _accounts.return_value = {
+            'passwd': {"blockwart": "blockwart:x:666:666:Blöck Wart:/home/blockwart:/bin/bash"},
+            'shadow': {"blockwart": "blockwart:secret:::::::"},
+            'group': {},
+        }
 
         status = user.get_status()
         self.assertFalse(status.correct)
 
-    def test_passwd_fail(self):
+    @patch('blockwart.items.users._accounts')
+    def test_passwd_fail(self, _accounts):
         bundle = MagicMock()
         user = users.User(
             bundle,
@@ -406,18 +440,19 @@ class GetStatusTest(TestCase):
                 'uid': 1123,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 1
-
-        bundle.node.run.return_value = passwd_grep_result
+        _accounts.return_value = {
+            'passwd': {},
+            'shadow': {},
+            'group': {},
+        }
 
         status = user.get_status()
         self.assertFalse(status.correct)
         self.assertFalse(status.info['exists'])
 
     @patch('blockwart.items.users._groups_for_user')
-    def test_shadow(self, _groups_for_user):
+    @patch('blockwart.items.users._accounts')
+    def test_shadow(self, _accounts, _groups_for_user):
         _groups_for_user.return_value = ["group1", "group2"]
         bundle = MagicMock()
         user = users.User(
@@ -433,25 +468,18 @@ class GetStatusTest(TestCase):
                 'uid': 1123,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"
-        shadow_grep_result = RunResult()
-        shadow_grep_result.return_code = 0
-        shadow_grep_result.stdout = "blockwart:topsecret:::::::"
-        results = [shadow_grep_result, passwd_grep_result]
-
-        def pop_result(*args, **kwargs):
-            return results.pop()
-
-        bundle.node.run.side_effect = pop_result
+        _accounts.return_value = {
+            'passwd': {"blockwart": "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash"},
+            'shadow': {"blockwart": "blockwart:topsecret:::::::"},
+            'group': {},
+        }
 
         status = user.get_status()
         self.assertFalse(status.correct)
 
     @patch('blockwart.items.users._groups_for_user')
-    def test_shadow_fail(self, _groups_for_user):
+    @patch('blockwart.items.users._accounts')
+    def test_shadow_fail(self, _accounts, _groups_for_user):
         _groups_for_user.return_value = ["group1", "group2"]
         bundle = MagicMock()
         user = users.User(
@@ -467,43 +495,37 @@ class GetStatusTest(TestCase):
                 'uid': 1123,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"
-        shadow_grep_result = RunResult()
-        shadow_grep_result.return_code = 1
-        results = [shadow_grep_result, passwd_grep_result]
-
-        def pop_result(*args, **kwargs):
-            return results.pop()
-
-        bundle.node.run.side_effect = pop_result
+        _accounts.return_value = {
+            'passwd': {"blockwart": "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash"},
+            'shadow': {},
+            'group': {},
+        }
 
         status = user.get_status()
         self.assertFalse(status.correct)
         self.assertEqual(status.info['shadow_hash'], None)
 
-    def test_delete(self):
+    @patch('blockwart.items.users._accounts')
+    def test_delete(self, _accounts):
         bundle = MagicMock()
         user = users.User(
             bundle,
             "blockwart",
             {'delete': True},
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"
-
-        bundle.node.run.return_value = passwd_grep_result
+        _accounts.return_value = {
+            'passwd': {"blockwart": "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash"},
+            'shadow': {},
+            'group': {},
+        }
 
         status = user.get_status()
         self.assertFalse(status.correct)
         self.assertTrue(status.info['exists'])
 
     @patch('blockwart.items.users._groups_for_user')
-    def test_groups(self, _groups_for_user):
+    @patch('blockwart.items.users._accounts')
+    def test_groups(self, _accounts, _groups_for_user):
         _groups_for_user.return_value = ["group1", "group3"]
         bundle = MagicMock()
         user = users.User(
@@ -519,19 +541,11 @@ class GetStatusTest(TestCase):
                 'uid': 1123,
             },
         )
-
-        passwd_grep_result = RunResult()
-        passwd_grep_result.return_code = 0
-        passwd_grep_result.stdout = "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash\n"
-        shadow_grep_result = RunResult()
-        shadow_grep_result.return_code = 0
-        shadow_grep_result.stdout = "blockwart:secret:::::::"
-        results = [shadow_grep_result, passwd_grep_result]
-
-        def pop_result(*args, **kwargs):
-            return results.pop()
-
-        bundle.node.run.side_effect = pop_result
+        _accounts.return_value = {
+            'passwd': {"blockwart": "blockwart:x:1123:2345:Blöck Wart:/home/blockwart:/bin/bash"},
+            'shadow': {"blockwart": "blockwart:secret:::::::"},
+            'group': {},
+        }
 
         status = user.get_status()
         self.assertFalse(status.correct)
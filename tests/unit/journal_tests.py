@@ -0,0 +1,122 @@
+import json
+from time import time
+from unittest import TestCase
+
+from mock import MagicMock, patch
+
+from blockwart import journal
+from blockwart.items import Item
+
+
+class MockItem(Item):
+    BUNDLE_ATTRIBUTE_NAME = "mock"
+    ITEM_ATTRIBUTES = {'foo': None}
+    ITEM_TYPE_NAME = "mock"
+
+    def get_witness_paths(self):
+        return ["/" + self.name]
+
+
+def get_mock_item(node, name, **attributes):
+    bundle = MagicMock()
+    bundle.node = node
+    return MockItem(bundle, name, attributes, skip_validation=True)
+
+
+def fake_stat_paths(node, paths):
+    return dict([(path, "stat of " + path) for path in paths])
+
+
+class JournalTest(TestCase):
+    """
+    Tests blockwart.journal.Journal.
+    """
+    def _node_with_journal(self, entries, swept=None):
+        node = MagicMock()
+        node.download.side_effect = lambda path, f, ignore_failure: f.write(json.dumps({
+            'items': entries,
+            'swept': time() if swept is None else swept,
+        }))
+        return node
+
+    @patch('blockwart.journal.stat_paths', side_effect=fake_stat_paths)
+    def test_load(self, stat_paths):
+        node = MagicMock()
+        item1 = get_mock_item(node, "1", foo=1)
+        item2 = get_mock_item(node, "2", foo=2)
+        item3 = get_mock_item(node, "3", foo=3)
+        item4 = get_mock_item(node, "4", triggered=True)
+        node = self._node_with_journal({
+            item1.id: [item1.get_journal_fingerprint(), [["/1", "stat of /1"]]],
+            item2.id: ["outdated", [["/2", "stat of /2"]]],
+            item3.id: [item3.get_journal_fingerprint(), [["/3", "outdated"]]],
+            item4.id: [item4.get_journal_fingerprint(), [["/4", "stat of /4"]]],
+        })
+        node_journal = journal.Journal(node)
+        node_journal.load([item1, item2, item3, item4])
+        self.assertEqual(node_journal.unchanged, set([item1.id]))
+
+    @patch('blockwart.journal.stat_paths', side_effect=fake_stat_paths)
+    def test_load_sweep(self, stat_paths):
+        node = MagicMock()
+        item1 = get_mock_item(node, "1")
+        node = self._node_with_journal(
+            {item1.id: [item1.get_journal_fingerprint(), [["/1", "stat of /1"]]]},
+            swept=time() - journal.JOURNAL_SWEEP_INTERVAL - 1,
+        )
+        node_journal = journal.Journal(node)
+        node_journal.load([item1])
+        self.assertEqual(node_journal.unchanged, set())
+
+    def test_load_missing(self):
+        node = MagicMock()
+        node_journal = journal.Journal(node)
+        node_journal.load([get_mock_item(node, "1")])
+        self.assertEqual(node_journal.unchanged, set())
+
+    def test_load_bad_swept(self):
+        node = MagicMock()
+        item1 = get_mock_item(node, "1")
+        node = self._node_with_journal(
+            {item1.id: [item1.get_journal_fingerprint(), [["/1", "stat of /1"]]]},
+            swept="yesterday",
+        )
+        node_journal = journal.Journal(node)
+        node_journal.load([item1])
+        self.assertEqual(node_journal.unchanged, set())
+
+    def test_fingerprint_unserializable(self):
+        node = MagicMock()
+        self.assertNotEqual(get_mock_item(node, "1", foo=[1]).get_journal_fingerprint(), None)
+        self.assertEqual(get_mock_item(node, "1", foo=object()).get_journal_fingerprint(), None)
+
+    @patch('blockwart.journal.time', return_value=47)
+    @patch('blockwart.journal.stat_paths', side_effect=fake_stat_paths)
+    def test_save(self, stat_paths, time):
+        node = MagicMock()
+        item1 = get_mock_item(node, "1")
+        item2 = get_mock_item(node, "2")
+        item3 = get_mock_item(node, "3")
+        node_journal = journal.Journal(node)
+        node_journal.swept = 23
+        node_journal.save(
+            [item1, item2, item3],
+            {
+                item1.id: Item.STATUS_OK,
+                item2.id: Item.STATUS_FAILED,
+                item3.id: Item.STATUS_FIXED,
+            },
+            skipped_any=False,
+        )
+        content = json.loads(node.upload.call_args[0][0].getvalue())
+        self.assertEqual(content, {
+            'items': {
+                item1.id: [item1.get_journal_fingerprint(), [["/1", "stat of /1"]]],
+                item3.id: [item3.get_journal_fingerprint(), [["/3", "stat of /3"]]],
+            },
+            'swept': 47,
+        })
+
+        node_journal.save([item1], {item1.id: Item.STATUS_OK}, skipped_any=True)
+        content = json.loads(node.upload.call_args[0][0].getvalue())
+        self.assertEqual(content['swept'], 23)
@@ -11,7 +11,7 @@ from blockwart.utils import names
 
 
 class MockNode(object):
-    pass
+    name = "mocknode"
 
 
 class MockBundle(object):
@@ -28,10 +28,37 @@ class MockItem(Item):
 
     def apply(self, *args, **kwargs):
         return self._APPLY_RESULT
+
+
+class MockBatchItem(MockItem):
+    def get_batch_key(self):
+        return True
+
+    @classmethod
+    def apply_batch(cls, items):
+        return [Item.STATUS_FIXED] * len(items)
+
+
+class MockBlockingBatchItem(MockBatchItem):
+    BLOCK_CONCURRENT = ["type1"]
 del Item.__reduce__  # we don't need the custom pickle-magic for our
                      # MockItems
 
 
+class FakeDurationHistory(object):
+    estimates = {}
+    recorded = {}
+
+    def __init__(self, repo):
+        pass
+
+    def item_estimates(self, node_name):
+        return self.estimates
+
+    def record_items(self, node_name, durations):
+        FakeDurationHistory.recorded = durations
+
+
 def get_mock_item(itype, name, deps_static, deps):
     bundle = MockBundle()
     bundle.node = MockNode()
@@ -41,6 +68,7 @@ def get_mock_item(itype, name, deps_static, deps):
     return item
 
 
+@patch('blockwart.node.DurationHistory', FakeDurationHistory)
 class ApplyItemsTest(TestCase):
     """
     Tests blockwart.node.apply_items.
@@ -108,6 +136,123 @@ class ApplyItemsTest(TestCase):
         self.assertEqual(results[1][0], "type1:name1")
         self.assertEqual(results[2][0], "type2:name3")
 
+    def test_apply_batch(self):
+        i1 = get_mock_item("type1", "name1", [], [])
+        i2 = get_mock_item("type1", "name2", [], [])
+        i3 = get_mock_item("type1", "name3", [], ["type1:name1"])
+        for item in (i1, i2, i3):
+            item.__class__ = MockBatchItem
+
+        node = MagicMock()
+        node.items = [i1, i2, i3]
+
+        results = list(apply_items(node))
+
+        # name3 is not batched with name1 since it depends on it
+        self.assertEqual(results, [
+            ("type1:name1", Item.STATUS_FIXED),
+            ("type1:name2", Item.STATUS_FIXED),
+            ("type1:name3", Item.STATUS_OK),
+        ])
+
+    def test_apply_batch_blocking(self):
+        i1 = get_mock_item("type1", "name1", [], [])
+        i2 = get_mock_item("type1", "name2", [], [])
+        i3 = get_mock_item("type1", "name3", [], [])
+        for item in (i1, i2, i3):
+            item.__class__ = MockBlockingBatchItem
+
+        node = MagicMock()
+        node.items = [i1, i2, i3]
+
+        results = list(apply_items(node, workers=2, threads=True))
+
+        # the items are chained so they don't run concurrently, but may
+        # still be applied together
+        self.assertEqual(results, [
+            ("type1:name1", Item.STATUS_FIXED),
+            ("type1:name2", Item.STATUS_FIXED),
+            ("type1:name3", Item.STATUS_FIXED),
+        ])
+
+    def test_apply_batch_limit(self):
+        batch_items = []
+        for i in range(4):
+            item = get_mock_item("type1", "name{}".format(i), [], [])
+            item.__class__ = MockBatchItem
+            batch_items.append(item)
+
+        node = MagicMock()
+        node.items = batch_items
+
+        with patch('blockwart.node.ItemQueue.batch_with') as batch_with:
+            batch_with.return_value = []
+            list(apply_items(node, workers=2, threads=True))
+        # 4 items, 2 workers: one other item may join the first one
+        self.assertEqual(batch_with.call_args_list[0][1]['limit'], 1)
+
+    @patch('blockwart.node.Journal')
+    def test_journal(self, Journal):
+        i1 = get_mock_item("type1", "name1", [], ["type1:name2"])
+        i2 = get_mock_item("type1", "name2", [], ["type1:name3"])
+        i3 = get_mock_item("type1", "name3", [], [])
+        i1._APPLY_RESULT = Item.STATUS_FIXED
+        i2._APPLY_RESULT = Item.STATUS_FIXED
+        Journal.return_value.unchanged = set(["type1:name1", "type1:name2"])
+
+        node = MagicMock()
+        node.items = [i1, i2, i3]
+
+        results = list(apply_items(node, journal=True))
+
+        self.assertEqual(results, [
+            ("type1:name3", Item.STATUS_OK),
+            ("type1:name2", Item.STATUS_OK),
+            ("type1:name1", Item.STATUS_OK),
+        ])
+        args, kwargs = Journal.return_value.save.call_args
+        self.assertEqual(args[1], dict(results))
+        self.assertEqual(kwargs, {'skipped_any': True})
+
+    @patch('blockwart.node.Journal')
+    def test_journal_after_change(self, Journal):
+        i1 = get_mock_item("type1", "name1", [], ["type1:name2"])
+        i2 = get_mock_item("type1", "name2", [], [])
+        i1._APPLY_RESULT = Item.STATUS_FIXED
+        i2._APPLY_RESULT = Item.STATUS_FIXED
+        Journal.return_value.unchanged = set(["type1:name1"])
+
+        node = MagicMock()
+        node.items = [i1, i2]
+
+        results = list(apply_items(node, journal=True))
+
+        self.assertEqual(results, [
+            ("type1:name2", Item.STATUS_FIXED),
+            ("type1:name1", Item.STATUS_FIXED),
+        ])
+
+    def test_history(self):
+        i1 = get_mock_item("type1", "name1", [], [])
+        i2 = get_mock_item("type1", "name2", [], [])
+        i3 = get_mock_item("type1", "name3", [], [])
+
+        node = MagicMock()
+        node.items = [i1, i2, i3]
+
+        FakeDurationHistory.estimates = {"type1:name3": 60}
+        try:
+            results = list(apply_items(node))
+        finally:
+            FakeDurationHistory.estimates = {}
+
+        # the slowest item goes first
+        self.assertEqual(results[0][0], "type1:name3")
+        self.assertEqual(
+            set(FakeDurationHistory.recorded.keys()),
+            set(["type1:name1", "type1:name2", "type1:name3"]),
+        )
+
     def test_apply_parallel(self):
         i1 = get_mock_item("type1", "name1", [], ["type1:name2"])
         i2 = get_mock_item("type1", "name2", [], ["type1:name3"])
@@ -137,6 +282,25 @@ class ApplyItemsTest(TestCase):
         self.assertEqual(results[1][0], "type1:name2")
         self.assertEqual(results[2][0], "type1:name1")
 
+    def test_apply_threads(self):
+        i1 = get_mock_item("type1", "name1", [], ["type1:name2"])
+        i2 = get_mock_item("type1", "name2", [], ["type1:name3"])
+        i3 = get_mock_item("type1", "name3", [], [])
+        i4 = get_mock_item("type2", "name4", [], [])
+
+        node = MagicMock()
+        node.items = [i1, i2, i3, i4]
+
+        results = list(apply_items(node, workers=2, threads=True))
+
+        result_ids = [result[0] for result in results]
+        self.assertEqual(len(result_ids), 4)
+        self.assertTrue(
+            result_ids.index("type1:name3") <
+            result_ids.index("type1:name2") <
+            result_ids.index("type1:name1")
+        )
+
 
 class ApplyResultTest(TestCase):
     """
@@ -0,0 +1,230 @@
+import errno
+from io import BytesIO
+from os import getpid
+from unittest import TestCase
+
+from mock import MagicMock, patch
+
+from blockwart import operations
+from blockwart.exceptions import RemoteException, SessionError
+
+
+class ClaimConnectionsTest(TestCase):
+    """
+    Tests blockwart.operations._claim_connections.
+    """
+    def tearDown(self):
+        operations.connections.clear()
+        del operations._INHERITED_CONNECTIONS[:]
+        operations._CONNECTIONS_PID = getpid()
+
+    @patch('blockwart.operations.getpid', return_value=47)
+    def test_forked(self, getpid):
+        operations._CONNECTIONS_PID = 46
+        operations.connections['user@host:22'] = "connection"
+        operations._claim_connections()
+        self.assertEqual(len(operations.connections), 0)
+        self.assertEqual(operations._INHERITED_CONNECTIONS, ["connection"])
+        self.assertEqual(operations._CONNECTIONS_PID, 47)
+
+    @patch('blockwart.operations.getpid', return_value=47)
+    def test_same_process(self, getpid):
+        operations._CONNECTIONS_PID = 47
+        operations.connections['user@host:22'] = "connection"
+        operations._claim_connections()
+        self.assertEqual(
+            dict(operations.connections),
+            {'user@host:22': "connection"},
+        )
+        self.assertEqual(operations._INHERITED_CONNECTIONS, [])
+
+
+class SessionTest(TestCase):
+    """
+    Tests use of agents and shell sessions in blockwart.operations.
+    """
+    def setUp(self):
+        self.agent = MagicMock()
+        operations.enable_agent('host')
+        operations._SESSIONS['host'] = self.agent
+
+    def tearDown(self):
+        operations._SESSION_FACTORIES.clear()
+        operations._SESSIONS.clear()
+
+    @patch('blockwart.operations.Agent')
+    def test_start_agent(self, Agent):
+        channel = MagicMock()
+        operations._start_agent('host', channel)
+        command = channel.exec_command.call_args[0][0]
+        self.assertTrue(command.startswith("sudo -n -- sh -c "))
+        self.assertIn(" -c ", command[len("sudo -n -- sh -c "):])
+        self.assertNotIn("/tmp", command)
+
+    def test_disable(self):
+        operations.disable_session('host')
+        self.agent.close.assert_called_once_with()
+        self.assertEqual(operations._SESSIONS, {})
+        self.assertEqual(operations._SESSION_FACTORIES, {})
+
+    def test_download(self):
+        self.agent.read.return_value = b"47"
+        target = BytesIO()
+        operations.download('host', "/foo", target)
+        self.assertEqual(target.getvalue(), b"47")
+
+    @patch('blockwart.operations.getpid', return_value=47)
+    def test_forked(self, fake_getpid):
+        operations._CONNECTIONS_PID = 46
+        try:
+            operations._claim_connections()
+            self.assertEqual(operations._SESSIONS, {})
+            self.assertTrue(self.agent in operations._INHERITED_CONNECTIONS)
+            self.assertFalse(self.agent.close.called)
+        finally:
+            del operations._INHERITED_CONNECTIONS[:]
+            operations._CONNECTIONS_PID = getpid()
+
+    def test_run(self):
+        self.agent.run.return_value = (0, b"out\n", b"err\n")
+        result = operations.run('host', "true")
+        self.agent.run.assert_called_once_with("true")
+        self.assertEqual(result.stdout, b"out")
+        self.assertEqual(result.stderr, b"err")
+
+    def test_run_failed(self):
+        self.agent.run.return_value = (1, b"", b"")
+        with self.assertRaises(RemoteException):
+            operations.run('host', "false")
+        self.assertEqual(
+            operations.run('host', "false", ignore_failure=True).return_code,
+            1,
+        )
+
+    @patch('blockwart.operations._fabric_sudo')
+    def test_run_broken(self, sudo):
+        self.agent.run.side_effect = SessionError()
+        sudo.return_value = MagicMock(return_code=1, stderr="err")
+        result = operations.run('host', "false", ignore_failure=True)
+        self.assertEqual(result.return_code, 1)
+        self.agent.close.assert_called_once_with()
+        self.assertEqual(operations._SESSIONS, {'host': None})
+        # later commands go through Fabric without trying the session
+        operations.run('host', "false", ignore_failure=True)
+        self.assertEqual(self.agent.run.call_count, 1)
+        self.assertEqual(sudo.call_count, 2)
+
+    @patch('blockwart.operations.run')
+    @patch('blockwart.operations._fabric_put')
+    def test_upload_broken(self, put, run):
+        put.return_value.failed = []
+        self.agent.write.side_effect = SessionError()
+        operations.upload('host', BytesIO(b"47"), "/foo")
+        self.assertEqual(put.call_args[1]['local_path'].read(), b"47")
+        self.assertEqual(operations._SESSIONS, {'host': None})
+
+    @patch('blockwart.operations.run')
+    @patch('blockwart.operations._fabric_put')
+    def test_shell_session_upload(self, put, run):
+        put.return_value.failed = []
+        operations._SESSIONS['host'] = MagicMock(spec=['close', 'run'])
+        source = BytesIO(b"47")
+        operations.upload('host', source, "/foo")
+        self.assertEqual(put.call_args[1]['local_path'], source)
+
+    def test_upload(self):
+        operations.upload('host', BytesIO(b"47"), "/foo", mode="0600", owner="user")
+        self.agent.write.assert_called_once_with(
+            "/foo",
+            b"47",
+            mode="0600",
+            owner="user",
+            group="",
+        )
+
+
+class DownloadTest(TestCase):
+    """
+    Tests blockwart.operations.download.
+    """
+    @patch('blockwart.operations.run')
+    @patch('blockwart.operations._sftp_get')
+    def test_direct(self, get, run):
+        target = MagicMock()
+        operations.download("host", "/foo bar", target)
+        get.assert_called_once_with("host", "/foo bar", target)
+        self.assertFalse(run.called)
+
+    @patch('blockwart.operations.randstr', return_value="47")
+    @patch('blockwart.operations.run')
+    @patch('blockwart.operations._sftp_get')
+    def test_bounce(self, get, run, randstr):
+        get.side_effect = [IOError(errno.EACCES, "Permission denied"), None]
+        run.return_value.return_code = 0
+        target = MagicMock()
+        operations.download("host", "/foo bar", target)
+        self.assertEqual(run.call_args_list[0][0], (
+            "host",
+            "cp -- '/foo bar' .blockwart_tmp_47 && "
+            "chown \"$SUDO_USER\" .blockwart_tmp_47 && "
+            "chmod 0400 .blockwart_tmp_47",
+        ))
+        self.assertEqual(get.call_args_list[1][0], ("host", ".blockwart_tmp_47", target))
+        self.assertEqual(
+            run.call_args_list[1][0],
+            ("host", "rm -f -- .blockwart_tmp_47"),
+        )
+
+    @patch('blockwart.operations.run')
+    @patch('blockwart.operations._sftp_get')
+    def test_missing(self, get, run):
+        get.side_effect = IOError(errno.ENOENT, "No such file")
+        with self.assertRaises(RemoteException):
+            operations.download("host", "/foo", MagicMock())
+        operations.download("host", "/foo", MagicMock(), ignore_failure=True)
+        self.assertFalse(run.called)
+
+    @patch('blockwart.operations.run')
+    @patch('blockwart.operations._sftp_get')
+    def test_unreadable(self, get, run):
+        get.side_effect = IOError(errno.EACCES, "Permission denied")
+        run.return_value.return_code = 1
+        with self.assertRaises(RemoteException):
+            operations.download("host", "/foo", MagicMock())
+        operations.download("host", "/foo", MagicMock(), ignore_failure=True)
+        self.assertEqual(get.call_count, 2)
+
+
+class UploadTest(TestCase):
+    """
+    Tests blockwart.operations.upload.
+    """
+    @patch('blockwart.operations.randstr', return_value="47")
+    @patch('blockwart.operations.run')
+    @patch('blockwart.operations._fabric_put')
+    def test_single_command(self, put, run, randstr):
+        put.return_value.failed = []
+        source = MagicMock()
+        operations.upload(
+            "host",
+            source,
+            "/foo bar",
+            mode="0644",
+            owner="user",
+            group="group",
+        )
+        self.assertEqual(put.call_args[1]['local_path'], source)
+        run.assert_called_once_with(
+            "host",
+            "chown user:group .blockwart_tmp_47 && "
+            "chmod 0644 .blockwart_tmp_47 && "
+            "mv -f .blockwart_tmp_47 '/foo bar'",
+        )
+
+    @patch('blockwart.operations.randstr', return_value="47")
+    @patch('blockwart.operations.run')
+    @patch('blockwart.operations._fabric_put')
+    def test_move_only(self, put, run, randstr):
+        put.return_value.failed = []
+        operations.upload("host", "/local", "/foo")
+        run.assert_called_once_with("host", "mv -f .blockwart_tmp_47 /foo")
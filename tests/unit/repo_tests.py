@@ -5,6 +5,8 @@ from shutil import rmtree
 from tempfile import mkdtemp
 from unittest import TestCase
 
+from mock import patch
+
 from blockwart import repo
 from blockwart.items import Item
 from blockwart.repo import Repository
@@ -116,3 +118,12 @@ class RepoItemClasses2Test(RepoTest):
             if hasattr(cls, 'bad'):
                 self.assertFalse(cls.bad)
             self.assertTrue(issubclass(cls, Item))
+
+    def test_lazy(self):
+        r = Repository.create(self.tmpdir)
+        with patch('blockwart.repo.items_from_path', return_value=iter([Item])) as items_from_path:
+            r.populate_from_path(self.tmpdir)
+            self.assertFalse(items_from_path.called)
+            self.assertEqual(r.item_classes, [Item])
+            self.assertEqual(r.item_classes, [Item])
+            self.assertEqual(items_from_path.call_count, 1)
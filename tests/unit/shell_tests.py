@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from subprocess import PIPE, Popen
+from unittest import TestCase
+
+from blockwart.exceptions import RemoteException
+from blockwart.shell import ShellSession
+
+
+class PipeChannel(object):
+    """
+    Provides the parts of Paramiko's channel API used by ShellSession
+    for a local process.
+    """
+    def __init__(self, process):
+        self.process = process
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+    def recv(self, length):
+        # read() on a pipe would block until length bytes are available
+        return self.process.stdout.read(1)
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+
+class ShellSessionTest(TestCase):
+    """
+    Tests blockwart.shell.ShellSession against a local shell.
+    """
+    def setUp(self):
+        self.session = ShellSession(
+            PipeChannel(Popen(["sh"], stdin=PIPE, stdout=PIPE)),
+            "localhost",
+        )
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_binary(self):
+        self.assertEqual(
+            self.session.run("printf 'a\\000b\\n'"),
+            (0, b"a\x00b\n", b""),
+        )
+
+    def test_exit(self):
+        self.assertEqual(self.session.run("exit 3"), (3, b"", b""))
+        self.assertEqual(self.session.run("cd /; pwd"), (0, b"/\n", b""))
+
+    def test_multiple(self):
+        for i in range(5):
+            self.assertEqual(
+                self.session.run("echo {}; echo err >&2; echo $LANG".format(i)),
+                (0, "{}\nC\n".format(i).encode('ascii'), b"err\n"),
+            )
+
+    def test_non_ascii(self):
+        expected = (0, "Blöck Wart\n".encode('utf-8'), b"")
+        self.assertEqual(self.session.run("echo 'Blöck Wart'"), expected)
+        self.assertEqual(
+            self.session.run("echo 'Blöck Wart'".encode('utf-8')),
+            expected,
+        )
+
+    def test_marker_in_output(self):
+        command = "echo {}:0:0:0".format(self.session.marker)
+        self.assertEqual(
+            self.session.run(command),
+            (0, "{}:0:0:0\n".format(self.session.marker).encode('ascii'), b""),
+        )
+
+    def test_not_a_shell(self):
+        channel = PipeChannel(Popen(["cat"], stdin=PIPE, stdout=PIPE))
+        try:
+            with self.assertRaises(RemoteException):
+                ShellSession(channel, "localhost")
+        finally:
+            channel.close()
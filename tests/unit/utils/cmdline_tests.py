@@ -3,7 +3,10 @@ from unittest import TestCase
 from mock import MagicMock
 
 from blockwart.exceptions import NoSuchNode, NoSuchGroup, UsageException
-from blockwart.utils import cmdline
+from blockwart.group import Group
+from blockwart.node import Node
+from blockwart.repo import Repository
+from blockwart.utils import cmdline, names
 
 
 class GetTargetNodesTest(TestCase):
@@ -67,59 +70,43 @@ class GetTargetNodesTest(TestCase):
         with self.assertRaises(UsageException):
             cmdline.get_target_nodes(repo, "node1")
 
-    def test_bundle(self):
-        bundle1 = MagicMock()
-        bundle1.name = "goodbundle"
-        bundle2 = MagicMock()
-        bundle2.name = "badbundle"
-
-        node1 = MagicMock()
-        node1.bundles = (bundle1, bundle2)
-        node2 = MagicMock()
-        node2.bundles = (bundle2,)
-
-        repo = MagicMock()
-        repo.nodes = (node1, node2)
+    def _make_repo(self):
+        repo = Repository()
+        repo.add_node(Node("node1", {'bundles': ["goodbundle"]}))
+        repo.add_node(Node("node2", {'bundles': ["badbundle"]}))
+        repo.add_node(Node("node3"))
+        repo.add_group(Group("goodgroup", {
+            'bundles': ["badbundle"],
+            'members': ["node1"],
+        }))
+        repo.add_group(Group("badgroup", {'member_patterns': [r"[23]$"]}))
+        return repo
 
+    def test_bundle(self):
+        repo = self._make_repo()
         self.assertEqual(
-            cmdline.get_target_nodes(repo, "bundle:goodbundle"),
-            [node1],
+            list(names(cmdline.get_target_nodes(repo, "bundle:goodbundle"))),
+            ["node1"],
+        )
+        self.assertEqual(
+            list(names(cmdline.get_target_nodes(repo, "bundle:badbundle"))),
+            ["node1", "node2"],
         )
 
     def test_negated_bundle(self):
-        bundle1 = MagicMock()
-        bundle1.name = "goodbundle"
-        bundle2 = MagicMock()
-        bundle2.name = "badbundle"
-
-        node1 = MagicMock()
-        node1.bundles = (bundle1,)
-        node2 = MagicMock()
-        node2.bundles = (bundle2,)
-
-        repo = MagicMock()
-        repo.nodes = (node1, node2)
-
+        repo = self._make_repo()
         self.assertEqual(
-            cmdline.get_target_nodes(repo, "!bundle:badbundle"),
-            [node1],
+            list(names(cmdline.get_target_nodes(repo, "!bundle:badbundle"))),
+            ["node3"],
         )
 
     def test_negated_group(self):
-        group1 = MagicMock()
-        group1.name = "goodgroup"
-        group2 = MagicMock()
-        group2.name = "badgroup"
-
-        node1 = MagicMock()
-        node1.groups = (group1,)
-        node2 = MagicMock()
-        node2.groups = (group2,)
-
-        repo = MagicMock()
-        repo.nodes = (node1, node2)
-
+        repo = self._make_repo()
+        self.assertEqual(
+            list(names(cmdline.get_target_nodes(repo, "!group:badgroup"))),
+            ["node1"],
+        )
         self.assertEqual(
-            cmdline.get_target_nodes(repo, "!group:badgroup"),
-            [node1],
+            list(names(cmdline.get_target_nodes(repo, "!group:nosuchgroup"))),
+            ["node1", "node2", "node3"],
         )
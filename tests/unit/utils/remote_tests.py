@@ -1,6 +1,7 @@
 from os import remove, symlink
 from platform import system
 from tempfile import mkstemp
+from threading import Thread
 from unittest import TestCase
 
 from mock import MagicMock, patch
@@ -228,3 +229,99 @@ class StatTest(TestCase):
             'mode': "0666",
             'size': 4321,
         })
+
+    @patch('blockwart.utils.remote.stat')
+    @patch('blockwart.utils.remote.get_path_type')
+    def test_prefetched(self, get_path_type, stat):
+        node = MagicMock()
+        node.name = "node1"
+        remote.prefetch_path_info(node, "/foo", (
+            'file',
+            "ASCII text",
+            {'owner': "foo", 'group': "bar", 'mode': "0644", 'size': 47},
+            "827bfc458708f0b442009c9c9836f7e4b65557fb",
+        ))
+        p = remote.PathInfo(node, "/foo")
+        self.assertFalse(get_path_type.called)
+        self.assertFalse(stat.called)
+        self.assertTrue(p.is_text_file)
+        self.assertEqual(p.owner, "foo")
+        self.assertEqual(p.sha1, "827bfc458708f0b442009c9c9836f7e4b65557fb")
+        self.assertFalse(node.run.called)
+
+        get_path_type.return_value = ('nonexistent', "")
+        p = remote.PathInfo(node, "/foo")
+        self.assertTrue(get_path_type.called)
+        self.assertFalse(p.exists)
+
+
+class NodeCacheTest(TestCase):
+    """
+    Tests blockwart.utils.remote.node_cache.
+    """
+    def test_threads(self):
+        node = MagicMock()
+        node.name = "node1"
+        remote.expire_node_cache(node)
+        remote.node_cache(node)['foo'] = 1
+        thread_caches = []
+        thread = Thread(target=lambda: thread_caches.append(dict(remote.node_cache(node))))
+        thread.start()
+        thread.join()
+        self.assertEqual(thread_caches, [{}])
+        self.assertEqual(remote.node_cache(node), {'foo': 1})
+
+
+class ProbePathsTest(TestCase):
+    """
+    Tests blockwart.utils.remote.probe_paths.
+    """
+    def test_probe(self):
+        node = MagicMock()
+        result = RunResult()
+        result.stdout = "\0".join([
+            "/foo", "0", "ASCII text", "foo:bar:644:47",
+            "827bfc458708f0b442009c9c9836f7e4b65557fb  /foo",
+            "/bar", "0", "directory", "root:root:755:4096", "",
+            "/baz", "1", "", "", "",
+        ]) + "\0"
+        node.run.return_value = result
+        self.assertEqual(
+            remote.probe_paths(node, ["/foo", "/bar", "/baz"], hash_paths=["/foo"]),
+            {
+                '/foo': (
+                    'file',
+                    "ASCII text",
+                    {'owner': "foo", 'group': "bar", 'mode': "0644", 'size': 47},
+                    "827bfc458708f0b442009c9c9836f7e4b65557fb",
+                ),
+                '/bar': (
+                    'directory',
+                    "directory",
+                    {'owner': "root", 'group': "root", 'mode': "0755", 'size': 4096},
+                    None,
+                ),
+                '/baz': ('nonexistent', "", {}, None),
+            },
+        )
+        self.assertEqual(node.run.call_count, 1)
+        self.assertIn("set -- /foo 1 /bar 0 /baz 0;", node.run.call_args[0][0])
+
+
+class StatPathsTest(TestCase):
+    """
+    Tests blockwart.utils.remote.stat_paths.
+    """
+    def test_stat(self):
+        node = MagicMock()
+        run_result = RunResult()
+        run_result.stdout = "/foo\0" "1:2:mtime:ctime\0"
+        node.run.return_value = run_result
+        self.assertEqual(
+            remote.stat_paths(node, ["/foo", "/bar baz"]),
+            {"/foo": "1:2:mtime:ctime", "/bar baz": None},
+        )
+        node.run.assert_called_once_with(
+            "stat --printf '%n\\0%i:%s:%y:%z\\0' -- /foo '/bar baz' 2>/dev/null",
+            may_fail=True,
+        )
@@ -1,3 +1,4 @@
+from os import listdir
 from os.path import join
 from shutil import rmtree
 from tempfile import mkdtemp
@@ -65,6 +66,33 @@ class GetAttrFromFileTest(TestCase):
         )
         self.assertEqual(utils.get_file_contents.call_count, 2)
 
+    @patch('blockwart.utils.get_file_contents', return_value="c = node")
+    def test_base_env(self, *args):
+        self.assertEqual(
+            utils.get_all_attrs_from_file(self.fname, base_env={'node': 1})['c'],
+            1,
+        )
+        self.assertEqual(
+            utils.get_all_attrs_from_file(self.fname, base_env={'node': 2})['c'],
+            2,
+        )
+        utils.get_file_contents.assert_called_once_with(self.fname)
+
+    def test_code_cache(self):
+        with open(self.fname, 'w') as f:
+            f.write("c = 47")
+        # created as needed
+        cache_dir = join(self.tmpdir, "cache")
+        with patch.dict('blockwart.utils.environ', {'BWCODECACHE': cache_dir}):
+            self.assertEqual(utils._load_code_cache(self.fname, "c = 47")[0], None)
+            utils.compile_file(self.fname)
+            self.assertEqual(len(listdir(cache_dir)), 1)
+            env = {}
+            exec(utils._load_code_cache(self.fname, "c = 47")[0], env)
+            self.assertEqual(env['c'], 47)
+            # same size, but different content
+            self.assertEqual(utils._load_code_cache(self.fname, "c = 48")[0], None)
+
     def test_default(self):
         with open(join(self.tmpdir, self.fname), 'w') as f:
             f.write("")